@@ -24,7 +24,7 @@ class AutoCmdDirective(Directive):
 
     def run(self):
         name = self.content[0]
-        func, add_args = main.subcommands[name]
+        func, add_args = main.load_subcommand(name)
         parser = argparse.ArgumentParser()
         add_args(parser)
         usage = parser.usage
@@ -0,0 +1,170 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A persistent agent that runs the tasks on a VM.
+
+Without the agent, every task costs a script upload, a new login shell
+and a download of the env-update file, each of them a round trip over
+ssh. The agent is started once per VM and test run by :func:`start`. It
+is a small shell script (see ``agent.sh``) that runs in a single login
+shell, reads its requests from one ssh channel, and writes back the
+output and exit status of the scripts that it runs. A task then costs one
+round trip, and no profile sourcing.
+
+The channel has no pty, so the scripts run without a terminal. Commands
+that need one, like sudo on images with "Defaults requiretty", fail.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import binascii
+
+import testmill
+from testmill import console, error
+
+
+bootstrap = "exec $SHELL -l -c 'eval \"$(dd bs=1 count={0} 2>/dev/null)\"'" \
+            " ravtest-agent {1}"
+
+
+def _encode(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return s
+
+def _decode(s):
+    if not isinstance(s, str):
+        s = s.decode('utf-8', 'replace')
+    return s
+
+
+class Agent(object):
+    """The agent on one VM.
+
+    The ``channel`` is a connection to the standard input and output of
+    the agent. It needs to provide the ``sendall()``, ``recv()`` and
+    ``close()`` methods of a Paramiko channel.
+    """
+
+    def __init__(self, channel, token):
+        self.channel = channel
+        self.token = token
+        self.marker = _encode('\n{0} '.format(token))
+        self.buffer = b''
+
+    def _fill(self):
+        data = self.channel.recv(65536)
+        if not data:
+            error.raise_error('Connection to agent closed unexpectedly.')
+        self.buffer += data
+
+    def _read_output(self, stream):
+        # Pass everything up to the trailer to ``stream``. Hold back as
+        # much as could be the start of a partial trailer.
+        keep = len(self.marker) - 1
+        while True:
+            pos = self.buffer.find(self.marker)
+            if pos >= 0:
+                output = self.buffer[:pos]
+                self.buffer = self.buffer[pos+len(self.marker):]
+            elif len(self.buffer) > keep:
+                output = self.buffer[:-keep]
+                self.buffer = self.buffer[-keep:]
+            else:
+                output = b''
+            if output and stream is not None:
+                stream.write(_decode(output))
+            if pos >= 0:
+                break
+            self._fill()
+
+    def _read_reply(self, stream=None):
+        self._read_output(stream)
+        while b'\n' not in self.buffer:
+            self._fill()
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        status, size = map(int, line.split())
+        while len(self.buffer) < size:
+            self._fill()
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return status, _decode(data)
+
+    def _request(self, typ, payload=b'', *args):
+        payload = _encode(payload)
+        header = ' '.join([typ, str(len(payload))] + list(args))
+        try:
+            self.channel.sendall(_encode(header + '\n') + payload)
+        except EnvironmentError as e:
+            error.raise_error('Connection to agent closed: {0!s}', e)
+
+    def wait_ready(self):
+        """Wait until the agent has started."""
+        ready = _encode('{0} READY\n'.format(self.token))
+        while ready not in self.buffer:
+            self._fill()
+        pos = self.buffer.find(ready)
+        self.buffer = self.buffer[pos+len(ready):]
+
+    def run(self, script, script_name, env_update=None, stream=None):
+        """Store ``script`` as ``script_name`` on the VM and run it.
+
+        The output is written to ``stream``, while the script runs. The
+        return value is a tuple with the exit status, and the contents of
+        the file ``env_update`` after the script has run.
+        """
+        self._request('RUN', script, script_name, env_update or '')
+        return self._read_reply(stream)
+
+    def setenv(self, shell_vars):
+        """Set environment variables in the agent. The ``shell_vars``
+        argument is shell code that exports them."""
+        self._request('ENV', shell_vars)
+        self._read_reply()
+
+    def close(self):
+        """Stop the agent."""
+        try:
+            self._request('EXIT')
+        except error.ProgramError:
+            pass
+        self.channel.close()
+
+
+def start(executor):
+    """Start an agent with ``executor``, and return it.
+
+    Return None if the executor cannot open a channel, or if the agent
+    could not be started. In that case, tasks are run without the agent.
+    """
+    open_channel = getattr(executor, 'open', None)
+    if open_channel is None:
+        return
+    fname = os.path.join(testmill.packagedir(), 'agent.sh')
+    with open(fname) as fin:
+        source = _encode(fin.read())
+    token = binascii.hexlify(os.urandom(16)).decode('ascii')
+    channel = None
+    try:
+        channel = open_channel(bootstrap.format(len(source), token))
+        channel.sendall(source)
+        agent = Agent(channel, token)
+        agent.wait_ready()
+    except Exception as e:
+        console.debug('Could not start agent: {0!s}', e)
+        if channel is not None:
+            channel.close()
+        return
+    return agent
@@ -0,0 +1,60 @@
+#
+# agent.sh: TestMill task agent
+#
+# This is sent to a VM over the ssh channel that it reads its requests
+# from, and evaluated by a login shell. It stays running until the end
+# of the test run, so the profile is sourced only once.
+#
+# A request is a header line "TYPE LENGTH [ARG]...", followed by LENGTH
+# bytes of payload. The reply to a request is the output it produced,
+# followed by a newline and a trailer line "TOKEN STATUS LENGTH", and
+# LENGTH bytes of reply data. TOKEN is passed as the first argument,
+# and never appears in any output.
+#
+# RUN LENGTH SCRIPT ENVFILE
+#     Store the payload in SCRIPT and run it. The reply data is the
+#     contents of ENVFILE after the script has run.
+# ENV LENGTH
+#     Evaluate the payload, which sets environment variables, in the
+#     agent. These are then inherited by all later scripts.
+# EXIT 0
+#     Exit the agent.
+
+token="$1"
+
+payload() {
+    dd bs=1 count="$1" 2>/dev/null
+}
+
+reply() {
+    if test -n "$2" && test -f "$2"; then
+        size=$(($(wc -c < "$2")))
+    else
+        size=0
+    fi
+    printf '\n%s %d %d\n' "$token" "$1" "$size"
+    test "$size" -gt 0 && cat "$2"
+}
+
+printf '%s READY\n' "$token"
+
+while read -r type length arg1 arg2; do
+    case "$type" in
+    RUN)
+        payload "$length" > "$arg1"
+        "$SHELL" "$arg1" </dev/null 2>&1
+        reply "$?" "$arg2"
+        ;;
+    ENV)
+        eval "$(payload "$length")"
+        reply 0
+        ;;
+    EXIT)
+        exit 0
+        ;;
+    *)
+        payload "$length" > /dev/null
+        reply 127
+        ;;
+    esac
+done
@@ -19,6 +19,7 @@ import sys
 import time
 import socket
 import select
+import threading
 import struct
 import errno
 import textwrap
@@ -26,7 +27,7 @@ import copy
 import functools
 
 from testmill import (cache, console, keypair, util, ravello, error,
-                      manifest, inflect)
+                      manifest, inflect, lease, tracing, sshmux)
 from testmill.state import env
 
 
@@ -60,18 +61,18 @@ def combine_states(state1, state2, ordering):
 
 def start_application(app):
     """Start up all stopped VMs in an application."""
-    for vm in app['vms']:
-        if vm['dynamicMetadata']['state'] == 'STOPPED':
-            env.api.start_vm(app, vm)
+    vms = [ vm for vm in app['vms']
+            if vm['dynamicMetadata']['state'] == 'STOPPED' ]
+    env.api.start_vms(app, vms)
     app = cache.get_application(app['id'], force_reload=True)
     return app
 
 
 def stop_application(app):
     """Stop all started VMs in an application."""
-    for vm in app['vms']:
-        if vm['dynamicMetadata']['state'] == 'STARTED':
-            env.api.stop_vm(app, vm)
+    vms = [ vm for vm in app['vms']
+            if vm['dynamicMetadata']['state'] == 'STARTED' ]
+    env.api.stop_vms(app, vms)
     app = cache.get_application(app['id'], force_reload=True)
     return app
 
@@ -119,6 +120,7 @@ def new_blueprint_name(template):
     return name
 
 
+@tracing.traced('wait')
 def wait_until_application_is_in_state(app, state, timeout=None,
                                        poll_timeout=None):
     """Wait until an application is in a given state."""
@@ -131,7 +133,11 @@ def wait_until_application_is_in_state(app, state, timeout=None,
         if time.time() > end_time:
             break
         poll_end_time = time.time() + poll_timeout
+        seqno = cache.last_change()
         app = cache.get_application(app['id'], force_reload=True)
+        for change in cache.get_changes(seqno, app['name']):
+            console.debug('VM `{0}` went from {1} to {2}.',
+                          change.vm, change.old, change.new)
         appstate = get_application_state(app)
         if appstate == state:
             return app
@@ -142,6 +148,7 @@ def wait_until_application_is_in_state(app, state, timeout=None,
     return app
 
 
+@tracing.traced('wait')
 def wait_until_blueprint_is_in_state(bp, state, timeout=None,
                                      poll_timeout=None):
     """Wait until a blueprint is in a given state."""
@@ -168,6 +175,7 @@ nb_connect_errors = set((errno.EINPROGRESS,))
 if sys.platform.startswith('win'):
     nb_connect_errors.add(errno.WSAEWOULDBLOCK)
 
+@tracing.traced('wait')
 def wait_until_application_accepts_ssh(app, vms, timeout=None,
                                        poll_timeout=None):
     """Wait until an application is reachable by ssh.
@@ -241,10 +249,96 @@ def wait_until_application_accepts_ssh(app, vms, timeout=None,
                       noun, vmnames, timeout)
 
 
+ssh_user = 'ravello'
+
+# When cloud-init is installed, the authorized keys are deployed by it. It
+# creates this file when it is done.
+cloud_init_marker = '/var/lib/cloud/instance/boot-finished'
+
+@tracing.traced('ssh')
+def check_ssh_auth(addr, timeout=None):
+    """Return whether we can log in to ``addr`` with our private key and run
+    a command. If cloud-init is installed, it must also have finished."""
+    if timeout is None:
+        timeout = 10
+    command = 'test ! -d /var/lib/cloud/instance || test -f {0}' \
+                    .format(cloud_init_marker)
+    if sshmux.supported():
+        # This also starts the master connection that later ssh sessions
+        # to this VM are multiplexed over.
+        return sshmux.run(addr, command, ssh_user, timeout) == 0
+    import paramiko
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.MissingHostKeyPolicy())
+    try:
+        client.connect(addr, username=ssh_user,
+                       key_filename=env.private_key_file, timeout=timeout,
+                       allow_agent=False, look_for_keys=False)
+        stdin, stdout, stderr = client.exec_command(command)
+        channel = stdout.channel
+        channel.status_event.wait(timeout)
+        return channel.exit_status_ready() and channel.exit_status == 0
+    except (paramiko.SSHException, socket.error, EOFError) as e:
+        console.debug('ssh to {0}: {1!s}', addr, e)
+        return False
+    finally:
+        client.close()
+
+
+@tracing.traced('wait')
+def wait_until_application_accepts_ssh_auth(app, vms, timeout=None,
+                                            poll_timeout=None):
+    """Wait until we can log in to the VMs ``vms`` of ``app`` with ssh.
+
+    This is stronger than :func:`wait_until_application_accepts_ssh`,
+    which only checks that port 22 is open. Right after an application
+    is published, sshd may already be listening while the host keys or
+    our authorized keys are still being set up.
+    """
+    if timeout is None:
+        timeout = 300
+    if poll_timeout is None:
+        poll_timeout = 2
+    waitaddrs = set((vm['dynamicMetadata']['externalIp']
+                     for vm in app['vms'] if vm['name'] in vms))
+    end_time = time.time() + timeout
+    while time.time() < end_time:
+        poll_end_time = time.time() + poll_timeout
+        results = {}
+        def check(addr):
+            results[addr] = check_ssh_auth(addr)
+        threads = [ threading.Thread(target=check, args=(addr,))
+                    for addr in waitaddrs ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(max(0, end_time - time.time()))
+        # A check that is still running counts as a failure.
+        waitaddrs = set((addr for addr in waitaddrs
+                         if not results.get(addr)))
+        if not waitaddrs:
+            return
+        console.show_progress('C')  # 'C' = Connecting
+        time.sleep(max(0, poll_end_time - time.time()))
+    unreachable = set((vm['name'] for vm in app['vms']
+                       if vm['dynamicMetadata']['externalIp'] in waitaddrs))
+    noun = inflect.plural_noun('VM', len(unreachable))
+    vmnames = '`{0}`'.format('`, `'.join(sorted(unreachable)))
+    if getattr(env, 'public_key', None) and not keypair.check_keypair():
+        error.raise_error('Could not log in to {0} {1}: public key `{2}` '
+                          'does not exist anymore.\nRun the command again '
+                          'to use a new key.', noun, vmnames,
+                          env.public_key['name'])
+    error.raise_error('Could not log in to {0} {1} within {2} seconds.',
+                      noun, vmnames, timeout)
+
+
 vm_reuse_states = ['STARTED', 'STARTING', 'STOPPED', 'PUBLISHING']
 
-def reuse_existing_application(appdef):
-    """Try to re-use an existing application."""
+def find_reusable_applications(appdef):
+    """Return a list of the existing applications that can be re-used for
+    ``appdef``, best candidates first."""
     candidates = []
     pubkey = env.public_key
     if appdef.get('blueprint'):
@@ -252,12 +346,7 @@ def reuse_existing_application(appdef):
     else:
         blueprint = None
     project = env.manifest['project']
-    for app in cache.get_applications():
-        parts = app['name'].split(':')
-        if len(parts) != 3:
-            continue
-        if parts[0] != project['name'] or parts[1] != appdef['name']:
-            continue
+    for app in cache.find_applications(project['name'], appdef['name']):
         app = cache.get_application(app['id'])
         vms = app.get('vms', [])
         if not vms:
@@ -286,10 +375,16 @@ def reuse_existing_application(appdef):
         if len(vmsfound) != len(appdef['vms']):
             continue
         candidates.append((state, app))
-    if not candidates:
-        return
     candidates.sort(key=lambda x: vm_reuse_states.index(x[0]))
-    return candidates[0][1]
+    return [ app for state, app in candidates ]
+
+
+def reuse_existing_application(appdef):
+    """Try to re-use an existing application. The application is leased,
+    so that it is not re-used by a concurrent invocation as well."""
+    for app in find_reusable_applications(appdef):
+        if lease.acquire(app):
+            return app
 
 
 # Ravello OUI = 2C-C2-60
@@ -344,6 +439,7 @@ def create_new_vm(vmdef):
     return vm
 
 
+@tracing.traced('application')
 def create_new_application(appdef, name_is_template=True):
     """Create a new application based on ``appdef``."""
     if name_is_template:
@@ -368,6 +464,7 @@ def create_new_application(appdef, name_is_template=True):
     return app
 
 
+@tracing.traced('application')
 def publish_application(app, cloud=None, region=None):
     """Publish the application ``app``."""
     req = {}
@@ -435,6 +532,7 @@ def appdef_from_app(app):
     return appdef
 
 
+@tracing.traced('application')
 def create_or_reuse_application(appdef, force_new):
     """Create a new application or re-use a suitable existing one."""
     app = None
@@ -448,6 +546,11 @@ def create_or_reuse_application(appdef, force_new):
             app = start_application(app)
     if app is None:
         app = create_new_application(appdef)
+        # The application is not published yet, so a concurrent invocation
+        # should not consider it for re-use. But be safe.
+        if not lease.acquire(app):
+            error.raise_error('New application `{0}` was leased by another '
+                              'process.', app['name'])
         app = publish_application(app)
         parts = app['name'].split(':')
         console.info('Created new application `{1}:{2}`.', *parts)
@@ -455,40 +558,34 @@ def create_or_reuse_application(appdef, force_new):
     return app
 
 
+@tracing.traced('wait')
 def wait_for_application(app, vms, timeout=None):
     """Wait until an is UP and connectable over ssh."""
     console.start_progressbar(textwrap.dedent("""\
         Waiting until application is ready...
         Progress: 'P' = Publishing, 'S' = Starting, 'C' = Connecting
         ===> """))
-    # XXX: At first boot cloud-init deploys our authorized keys file.
-    # This process can finish after ssh has started up. The images
-    # need to be fixed to ensure cloud-init has finished before ssh
-    # starts up.
+    # At first boot, ssh creates its host keys and cloud-init deploys our
+    # authorized keys file. Both can finish after ssh has started listening
+    # on port 22. So for applications that were not running yet, we also
+    # wait until we can actually log in.
     state = get_application_state(app)
     if timeout:
-        timeleft = max(120, timeout)  # anything < 120 does not make sense
-        start = time.time()
+        # anything < 120 does not make sense
+        end_time = time.time() + max(120, timeout)
+        timeleft = lambda: max(0, end_time - time.time())
     else:
-        timeleft = None
-    if state == 'PUBLISHING':
-        if timeleft:
-            timeleft -= 30
-        # Fudge factor. When an application is first started up, ssh needs to
-        # create its ssh host keys. In theory this wait should not be necessary
-        # as ssh binds to port 22 after creating the host keys. In practise,
-        # something doesn't quite work our and it is needed.  Needs more
-        # investigation to understand. For now, take the easy way..
-        extra_sleep = 30
+        timeleft = lambda: None
+    console.debug('State {0}.', state)
+    app = wait_until_application_is_in_state(app, 'STARTED', timeleft())
+    wait_until_application_accepts_ssh(app, vms, timeleft())
+    if state != 'STARTED':
+        wait_until_application_accepts_ssh_auth(app, vms, timeleft())
     else:
-        extra_sleep = 0
-    console.debug('State {0}, extra sleep {1}.', state, extra_sleep)
-    app = wait_until_application_is_in_state(app, 'STARTED', timeleft)
-    if timeleft:
-        timeleft = max(0, timeleft - (time.time()-start))
-    wait_until_application_accepts_ssh(app, vms, timeleft)
+        addrs = [ vm['dynamicMetadata']['externalIp']
+                  for vm in app['vms'] if vm['name'] in vms ]
+        sshmux.start_masters(addrs, ssh_user)
     console.end_progressbar('DONE')
-    time.sleep(extra_sleep)
     return app
 
 
@@ -0,0 +1,367 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for TestMill, and the "ravtest-bench" entry point.
+
+The benchmark suites live in the ``bench_*`` modules. Each of them can be
+run as a script, e.g. ``python -m testmill.bench_orchestration``, and has a
+``run_benchmark()`` function that returns its results as a dictionary.
+
+"ravtest-bench" runs the selected suites a number of times, appends the
+results with information about the environment to a history file, and
+compares them with a baseline. It exits with status 1 if a metric became
+significantly slower::
+
+    $ ravtest-bench --baseline bench.json --save-baseline bench.json
+    $ ravtest-bench --baseline bench.json manifest repository
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import json
+import math
+import time
+import socket
+import platform
+import argparse
+import resource
+import contextlib
+import subprocess
+import multiprocessing
+
+import testmill
+from testmill import util
+
+
+# The suites that are run by "ravtest-bench", with the parameters that are
+# used. These are sized to run in a few seconds each.
+suites = {
+    'api': ('testmill.bench_api', {'applications': 100, 'vms': 5}),
+    'manifest': ('testmill.bench_manifest', {'applications': 50, 'vms': 5,
+                                             'repeat': 1}),
+    'orchestration': ('testmill.bench_orchestration',
+                      {'vms': 20, 'tasks_per_vm': 3, 'sync_interval': 0.05}),
+    'repository': ('testmill.bench_repository', {'files': 5000})
+}
+
+
+def peak_rss(children=False):
+    """Return the peak resident set size in bytes of the current process,
+    or of its largest waited-for child process if ``children`` is set."""
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, Mac OS X reports bytes.
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+    return maxrss
+
+
+@contextlib.contextmanager
+def timed(timings, name):
+    """Context manager that adds the time spent in its body to
+    ``timings[name]``."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.time() - start
+
+
+def percentile(values, pct):
+    """Return the ``pct`` percentile of ``values``."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def summarize(values):
+    """Return the count, mean, median, 95th percentile and maximum of
+    ``values`` as a dictionary."""
+    count = len(values)
+    return {'count': count,
+            'mean': sum(values) / count if count else 0.0,
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'max': max(values) if count else 0.0}
+
+
+def format_bytes(nbytes):
+    """Format a number of bytes."""
+    for unit in ('B', 'KiB', 'MiB'):
+        if nbytes < 1024:
+            return '{0:.1f} {1}'.format(nbytes, unit)
+        nbytes /= 1024.0
+    return '{0:.1f} GiB'.format(nbytes)
+
+
+def format_results(results, stream=None):
+    """Write ``results`` as aligned "name: value" lines to ``stream``.
+    Nested dictionaries are written indented."""
+    if stream is None:
+        stream = sys.stdout
+    def write(results, indent):
+        width = max([len(key) for key in results] + [0])
+        for key in sorted(results):
+            value = results[key]
+            if isinstance(value, dict):
+                stream.write('{0}{1}:\n'.format(' ' * indent, key))
+                write(value, indent + 2)
+                continue
+            if isinstance(value, float):
+                value = '{0:.4f}'.format(value)
+            stream.write('{0}{1:<{2}}  {3}\n'.format(' ' * indent, key + ':',
+                                                      width + 1, value))
+    write(results, 0)
+    stream.flush()
+
+
+def flatten(results, prefix=''):
+    """Flatten the nested dictionary ``results`` into a dictionary that maps
+    dotted names to numbers. Values that are not numbers are left out."""
+    flat = {}
+    for key,value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def mean(values):
+    """Return the mean of ``values``."""
+    return sum(values) / float(len(values)) if values else 0.0
+
+
+def stddev(values):
+    """Return the sample standard deviation of ``values``."""
+    if len(values) < 2:
+        return 0.0
+    avg = mean(values)
+    return math.sqrt(sum((x - avg)**2 for x in values) / (len(values) - 1))
+
+
+def collect(samples):
+    """Collect the values of every metric in the list of results
+    ``samples``. Return a dictionary mapping dotted metric names to a list
+    of values."""
+    collected = {}
+    for results in samples:
+        for name,value in flatten(results).items():
+            collected.setdefault(name, []).append(value)
+    return collected
+
+
+def environment():
+    """Return a dictionary that describes the environment that the
+    benchmarks run in."""
+    try:
+        from testmill import _version
+        version = _version.version
+    except ImportError:
+        version = None
+    try:
+        git = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                               cwd=testmill.packagedir(),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, _ = git.communicate()
+        commit = stdout.strip() if git.returncode == 0 else None
+    except OSError:
+        commit = None
+    return {'time': time.time(), 'hostname': socket.gethostname(),
+            'platform': platform.platform(), 'machine': platform.machine(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'cpus': multiprocessing.cpu_count(), 'testmill': version,
+            'commit': commit}
+
+
+def load_baseline(fname, suite):
+    """Load the baseline for ``suite`` from the file ``fname``.
+
+    The baseline is a dictionary with the keys "environment" and "samples".
+    Return None if there is no baseline.
+    """
+    try:
+        with file(fname) as fin:
+            baselines = json.load(fin)
+    except IOError:
+        return
+    return baselines.get(suite)
+
+
+def save_baseline(fname, suite, samples, environ=None):
+    """Store the list of results ``samples`` as the baseline for ``suite``
+    in the file ``fname``. Baselines for other suites are kept."""
+    try:
+        with file(fname) as fin:
+            baselines = json.load(fin)
+    except IOError:
+        baselines = {}
+    baselines[suite] = {'environment': environ, 'samples': samples}
+    tmpname = '{0}.{1}-tmp'.format(fname, os.getpid())
+    with file(tmpname, 'w') as fout:
+        json.dump(baselines, fout, indent=2, sort_keys=True)
+    os.rename(tmpname, fname)
+
+
+def compare(samples, baseline, threshold=0.1, sigma=3.0, min_delta=0.001,
+            suffix=('time', '.mean', '.p95')):
+    """Compare the list of results ``samples`` with the list ``baseline``.
+
+    Only the metrics whose dotted name ends in ``suffix`` are compared.
+    These are the timings, which includes the mean and the 95th percentile
+    of the timings that were summarized with :func:`summarize`.
+    A metric has regressed if its mean increased by more than ``threshold``
+    (relative) and ``min_delta`` (absolute), and Welch's t statistic of the
+    difference exceeds ``sigma``. With a single sample on either side, the
+    noise is unknown and only the thresholds apply.
+
+    Return a dictionary mapping the metric name to a (baseline, current,
+    change, regressed) tuple, where change is the relative change of the
+    mean.
+    """
+    current = collect(samples)
+    base = collect(baseline)
+    changes = {}
+    for name,values in current.items():
+        if not name.endswith(suffix) or not mean(base.get(name, [])):
+            continue
+        bvalues = base[name]
+        bmean, cmean = mean(bvalues), mean(values)
+        change = cmean / bmean - 1.0
+        error = math.sqrt(stddev(bvalues)**2 / len(bvalues) +
+                          stddev(values)**2 / len(values))
+        significant = error == 0 or (cmean - bmean) / error > sigma
+        regressed = change > threshold and cmean - bmean > min_delta \
+                        and significant
+        changes[name] = (bmean, cmean, change, regressed)
+    return changes
+
+
+def format_changes(changes, stream=None):
+    """Write the output of :func:`compare` to ``stream``."""
+    if stream is None:
+        stream = sys.stdout
+    width = max([len(name) for name in changes] + [0])
+    for name in sorted(changes):
+        base, value, change, regressed = changes[name]
+        stream.write('{0:<{1}}  {2:10.4f}  {3:10.4f}  {4:+7.1%}{5}\n'
+                     .format(name, width, base, value, change,
+                             '  REGRESSION' if regressed else ''))
+    stream.flush()
+
+
+def _mean_value(values):
+    avg = mean(values)
+    if all(isinstance(value, int) for value in values) and avg == int(avg):
+        avg = int(avg)
+    return avg
+
+
+def history_file():
+    """Return the name of the benchmark history file."""
+    return os.path.join(util.get_config_dir(), 'bench-history.jsonl')
+
+
+def run_suite(name):
+    """Run the benchmark suite ``name`` and return its results."""
+    modname, kwargs = suites[name]
+    __import__(modname)
+    module = sys.modules[modname]
+    return module.run_benchmark(**kwargs)
+
+
+def create_parser():
+    """Create the command-line parser for "ravtest-bench"."""
+    parser = argparse.ArgumentParser(prog='ravtest-bench',
+                    description='Run the TestMill benchmarks and compare '
+                                'the results with a baseline.')
+    parser.add_argument('suites', nargs='*', metavar='suite',
+                        help='suites to run: {0} (default: all)'
+                             .format(', '.join(sorted(suites))))
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='run every suite this many times (default: 3)')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare the results with this baseline')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown that is a regression '
+                             '(default: 0.1)')
+    parser.add_argument('--sigma', type=float, default=3.0,
+                        help='required significance of a regression in '
+                             'standard errors (default: 3.0)')
+    parser.add_argument('--history', metavar='FILE',
+                        help='append the results to this file instead of '
+                             'the default history file')
+    return parser
+
+
+def main(argv=None):
+    """The "ravtest-bench" entry point."""
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    for name in args.suites:
+        if name not in suites:
+            parser.error('unknown suite: {0}'.format(name))
+    selected = args.suites or sorted(suites)
+    environ = environment()
+    results = {}
+    for name in selected:
+        sys.stdout.write('Running suite `{0}`...\n'.format(name))
+        sys.stdout.flush()
+        results[name] = [ run_suite(name) for i in range(args.repeat) ]
+    regressions = []
+    for name in selected:
+        sys.stdout.write('\n== {0}\n\n'.format(name))
+        collected = collect(results[name])
+        format_results(dict((metric, _mean_value(values))
+                            for metric,values in collected.items()))
+        baseline = load_baseline(args.baseline, name) \
+                        if args.baseline else None
+        if baseline is None:
+            continue
+        if baseline['environment'] and \
+                    baseline['environment'].get('hostname') != \
+                    environ['hostname']:
+            sys.stdout.write('\nWarning: baseline is from a different '
+                             'host.\n')
+        sys.stdout.write('\nChange with respect to the baseline:\n')
+        changes = compare(results[name], baseline['samples'], args.threshold,
+                          args.sigma)
+        format_changes(changes)
+        regressions += [ '{0}:{1}'.format(name, metric)
+                         for metric in sorted(changes)
+                         if changes[metric][3] ]
+    record = {'environment': environ, 'suites': results,
+              'regressions': regressions}
+    with file(args.history or history_file(), 'a') as fout:
+        fout.write(json.dumps(record, sort_keys=True) + '\n')
+    if args.save_baseline:
+        for name in selected:
+            save_baseline(args.save_baseline, name, results[name], environ)
+    if regressions:
+        sys.stdout.write('\n{0} regression(s): {1}\n'
+                         .format(len(regressions), ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
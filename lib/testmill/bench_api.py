@@ -0,0 +1,141 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the API client, the cache and the waiters.
+
+This runs against an in-process :mod:`testmill.fakeapi` server with a
+configurable latency, so that the client side cost can be measured
+without the network. The following are timed:
+
+* ``list``: listing all applications into the cache.
+* ``get``: fetching applications one by one.
+* ``stop`` and ``start``: stopping and starting all VMs in an application,
+  and waiting until it is in the new state. The ``overhead_time`` is the
+  time spent in excess of the time that the fake VMs take to change state.
+
+With the ``--wan-*`` options, the requests go through a
+:class:`testmill.faultproxy.FaultProxy` that simulates a slow and
+unreliable network, to see how the retries and the waiters behave. Run it
+with::
+
+    $ python -m testmill.bench_api --applications 1000 --latency 0.01
+    $ python -m testmill.bench_api --wan-latency normal:80ms,20ms \\
+            --wan-reset-rate 0.05
+"""
+
+from __future__ import absolute_import, print_function
+
+import sys
+import time
+import argparse
+
+from testmill import (bench, cache, application, fakeapi, faultproxy,
+                      ravello)
+from testmill.state import env
+
+
+def _wait(app, state, expected, poll_timeout):
+    start = time.time()
+    application.wait_until_application_is_in_state(app, state, timeout=60,
+                                                   poll_timeout=poll_timeout)
+    elapsed = time.time() - start
+    return {'time': elapsed, 'overhead_time': max(0.0, elapsed - expected)}
+
+
+def run_benchmark(applications=200, vms=10, latency=0.002, gets=50,
+                  transition_time=0.5, poll_timeout=0.1, wan=None):
+    """Run the API benchmark and return the results.
+
+    If ``wan`` is given, it is a dictionary with the conditions for a
+    :class:`testmill.faultproxy.FaultProxy` that the requests go through.
+    """
+    fake = fakeapi.FakeRavello(latency=latency, start_time=transition_time,
+                               stop_time=transition_time)
+    fake.populate(applications, vms)
+    server = fakeapi.start_server(fake)
+    url = server.url
+    proxy = None
+    if wan:
+        proxy = faultproxy.FaultProxy(url, **wan).start()
+        url = proxy.url
+    api = ravello.RavelloClient(service_url=url)
+    results = {}
+    try:
+        api.connect(url)
+        api.login('test', 'test')
+        with env.new():
+            env.quiet = True
+            env.debug = False
+            env.api = api
+            with bench.timed(results, 'list'):
+                apps = cache.get_applications()
+            apps = sorted(apps, key=lambda app: app['id'])
+            with bench.timed(results, 'get'):
+                for app in apps[:gets]:
+                    cache.get_application(app['id'], force_reload=True)
+            results['list'] = {'time': results['list'],
+                               'applications': len(apps)}
+            results['get'] = {'time': results['get'],
+                              'calls': min(gets, len(apps))}
+            app = cache.get_application(apps[0]['id'])
+            app = application.stop_application(app)
+            results['stop'] = _wait(app, 'STOPPED', transition_time,
+                                    poll_timeout)
+            app = application.start_application(app)
+            results['start'] = _wait(app, 'STARTED', transition_time,
+                                     poll_timeout)
+    finally:
+        api.close()
+        if proxy:
+            proxy.close()
+        server.shutdown()
+        server.server_close()
+    summary = api.metrics.summary()
+    results['requests'] = sum(stats['calls'] for stats in summary.values())
+    results['retries'] = sum(stats['retries'] for stats in summary.values())
+    if proxy:
+        results['resets'] = proxy.resets
+    results['peak_rss'] = bench.peak_rss()
+    return results
+
+
+def main(argv=None):
+    """Run the API benchmark from the command line."""
+    parser = argparse.ArgumentParser(description='Benchmark the API client, '
+                                     'the cache and the waiters.')
+    parser.add_argument('--applications', type=int, default=200)
+    parser.add_argument('--vms', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.002)
+    parser.add_argument('--gets', type=int, default=50)
+    parser.add_argument('--transition-time', type=float, default=0.5)
+    parser.add_argument('--poll-timeout', type=float, default=0.1)
+    parser.add_argument('--wan-latency')
+    parser.add_argument('--wan-bandwidth')
+    parser.add_argument('--wan-reset-rate', type=float, default=0.0)
+    parser.add_argument('--wan-handshake-delay', type=float, default=0.0)
+    args = parser.parse_args(argv)
+    wan = {'latency': args.wan_latency, 'bandwidth': args.wan_bandwidth,
+           'reset_rate': args.wan_reset_rate,
+           'handshake_delay': args.wan_handshake_delay}
+    if not any(wan.values()):
+        wan = None
+    results = run_benchmark(args.applications, args.vms, args.latency,
+                            args.gets, args.transition_time,
+                            args.poll_timeout, wan)
+    bench.format_results(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the manifest pipeline.
+
+This generates a large manifest with many applications and VMs, and with
+settings that are inherited from the ``defaults`` and ``languages``
+sections, and times every stage of :func:`testmill.manifest.default_manifest`
+separately. The time spent in :func:`testmill.validate.validate_node` is
+reported as well. The image names in the manifest are checked against
+a :mod:`testmill.fakeapi` server.
+
+Results can be stored as a baseline, and later runs compared to it::
+
+    $ python -m testmill.bench_manifest --applications 500 --vms 10 \\
+            --save-baseline baseline.json
+    $ python -m testmill.bench_manifest --applications 500 --vms 10 \\
+            --baseline baseline.json
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import yaml
+
+from testmill import bench, manifest, validate, fakeapi, ravello
+from testmill.state import env
+
+
+stages = ('load', 'check', 'add_defaults', 'percolate', 'expand_shorthands',
+          'complete_data', 'check_entities')
+
+
+def create_manifest(applications=100, vms=10, tasks=4, images=10):
+    """Create a manifest with ``applications`` applications of ``vms`` VMs
+    each. Every VM inherits ``tasks`` tasks from the defaults, with
+    commands that are given by the language, the application or the VM."""
+    taskdefs = [ {'name': 'task{0}'.format(i), 'quiet': True,
+                  'class': 'testmill.tasks.Task'} for i in range(tasks) ]
+    langapp = dict(('task{0}'.format(i), ['make task{0}'.format(i)])
+                   for i in range(tasks))
+    appdefs = []
+    for i in range(applications):
+        vmdefs = []
+        for j in range(vms):
+            vmdef = {'name': 'vm{0}'.format(j),
+                     'image': 'image{0}'.format((i + j) % images)}
+            if j % 2:
+                vmdef['task0'] = ['echo vm{0}'.format(j), 'true']
+            if j % 3 == 0:
+                vmdef['memory'] = 4096
+            vmdefs.append(vmdef)
+        appdef = {'name': 'app{0}'.format(i), 'vms': vmdefs}
+        if i % 2:
+            appdef['task1'] = {'commands': ['echo app{0}'.format(i)],
+                               'quiet': False}
+        appdefs.append(appdef)
+    return {'project': {'name': 'bench', 'language': 'bench'},
+            'repository': {'type': 'git',
+                           'url': 'https://example.com/bench.git'},
+            'defaults': {'applications': {'keepalive': 90},
+                         'vms': {'smp': 2, 'tasks': taskdefs},
+                         'tasks': {'interactive': False}},
+            'languages': {'bench': {'detect': ['bench.cfg'],
+                                    'applications': langapp,
+                                    'vms': {'memory': 1024},
+                                    'tasks': {'user': 'ravello'}}},
+            'applications': appdefs}
+
+
+def _timed_validate(timings):
+    """Return a replacement for ``validate.validate_node`` that records
+    the time spent in it."""
+    validate_node = validate.validate_node
+    def timed_validate_node(node, path, check):
+        start = time.time()
+        try:
+            return validate_node(node, path, check)
+        finally:
+            elapsed = time.time() - start
+            timings['calls'] += 1
+            timings['time'] += elapsed
+            timings['max'] = max(timings['max'], elapsed)
+    return timed_validate_node
+
+
+def run_pipeline(filename, timings):
+    """Run the stages of ``manifest.default_manifest`` for the manifest in
+    ``filename``, adding the time of every stage to ``timings``."""
+    manifest._parsed_files.clear()
+    with bench.timed(timings, 'load'):
+        parsed = manifest.load_manifest(filename)
+    with bench.timed(timings, 'load_cached'):
+        manifest.load_manifest(filename)
+    with bench.timed(timings, 'check'):
+        manifest.check_manifest(parsed)
+    with bench.timed(timings, 'add_defaults'):
+        manifest.add_defaults(parsed)
+    with bench.timed(timings, 'percolate'):
+        manifest.percolate_defaults(parsed)
+    with bench.timed(timings, 'expand_shorthands'):
+        manifest.expand_shorthands(parsed)
+    with bench.timed(timings, 'complete_data'):
+        manifest.complete_data(parsed)
+    with bench.timed(timings, 'check_entities'):
+        manifest.check_manifest_entities(parsed)
+    return parsed
+
+
+def run_benchmark(applications=100, vms=10, tasks=4, images=10, repeat=3):
+    """Run the manifest benchmark and return the results. The best time
+    out of ``repeat`` runs is reported for every stage."""
+    fake = fakeapi.FakeRavello()
+    for i in range(images):
+        fake.add_image('image{0}'.format(i))
+    server = fakeapi.start_server(fake)
+    tmpdir = tempfile.mkdtemp(prefix='testmill-bench-')
+    filename = os.path.join(tmpdir, '.ravello.yml')
+    with file(filename, 'w') as fout:
+        yaml.dump(create_manifest(applications, vms, tasks, images), fout,
+                  default_flow_style=False)
+    size = os.stat(filename).st_size
+    api = ravello.RavelloClient(service_url=server.url)
+    best = {}
+    validation = {'calls': 0, 'time': 0.0, 'max': 0.0}
+    saved_validate_node = validate.validate_node
+    validate.validate_node = _timed_validate(validation)
+    try:
+        api.connect(server.url)
+        api.login('test', 'test')
+        for i in range(repeat):
+            timings = {}
+            # A new environment every time, so that the images are not
+            # cached from an earlier run.
+            with env.new():
+                env.quiet = True
+                env.verbose = False
+                env.manifest = filename
+                env.api = api
+                result = run_pipeline(filename, timings)
+            for key,value in timings.items():
+                best[key] = min(best.get(key, value), value)
+    finally:
+        validate.validate_node = saved_validate_node
+        api.close()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    results = {}
+    for key,value in best.items():
+        results[key] = {'time': value}
+    results['total'] = {'time': sum(best[stage] for stage in stages)}
+    validation['calls'] //= repeat
+    validation['time'] /= repeat
+    results['validate_node'] = validation
+    nvms = sum(len(appdef['vms']) for appdef in result['applications'])
+    results['size'] = {'applications': len(result['applications']),
+                       'vms': nvms,
+                       'bytes': size}
+    results['peak_rss'] = bench.peak_rss()
+    return results
+
+
+def main(argv=None):
+    """Run the manifest benchmark from the command line."""
+    parser = argparse.ArgumentParser(description='Benchmark the manifest '
+                                     'pipeline.')
+    parser.add_argument('--applications', type=int, default=100)
+    parser.add_argument('--vms', type=int, default=10)
+    parser.add_argument('--tasks', type=int, default=4)
+    parser.add_argument('--images', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', help='compare with this baseline')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='store the results as a baseline')
+    args = parser.parse_args(argv)
+    results = run_benchmark(args.applications, args.vms, args.tasks,
+                            args.images, args.repeat)
+    bench.format_results(results)
+    if args.baseline:
+        baseline = bench.load_baseline(args.baseline, 'manifest')
+        if baseline is None:
+            sys.stderr.write('No manifest baseline in {0}.\n'
+                             .format(args.baseline))
+            return 1
+        sys.stdout.write('\nChange with respect to the baseline:\n')
+        bench.format_changes(bench.compare([results], baseline['samples']))
+    if args.save_baseline:
+        bench.save_baseline(args.save_baseline, 'manifest', [results],
+                            bench.environment())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
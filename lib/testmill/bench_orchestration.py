@@ -0,0 +1,264 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the task orchestration of "ravtest run".
+
+This runs :func:`testmill.tasks.run_all_tasks` for a synthetic application
+with many VMs and tasks, with the remote operations replaced by an
+executor that does not need any VMs:
+
+* ``simulate`` runs every task as a sleep of ``--task-time`` seconds in
+  the process of the VM.
+* ``local`` runs the generated task scripts with ``/bin/sh`` in a
+  temporary directory per VM.
+
+Everything else is real: a process per VM, the shared state in a
+``multiprocessing.Manager``, script generation and the synchronization
+between tasks. The overhead that is reported is therefore the cost of
+TestMill itself, independent of the network and the cloud::
+
+    $ python -m testmill.bench_orchestration --vms 100 --tasks 5
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import fabric.api as fab
+
+from testmill import bench, tasks
+from testmill.state import env
+
+
+class _Result(str):
+    """The result of a command, like Fabric's ``_AttributeString``."""
+
+    def __new__(cls, value, return_code):
+        result = super(_Result, cls).__new__(cls, value)
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        return result
+
+
+class SimulatedExecutor(object):
+    """An executor that sleeps ``task_time`` seconds for every command."""
+
+    def __init__(self, task_time=0.0):
+        self.task_time = task_time
+
+    def put(self, local, remote):
+        if hasattr(local, 'getvalue'):
+            local.getvalue()
+
+    def get(self, remote, local):
+        pass
+
+    def run(self, command, **kwargs):
+        if not command.endswith('.preinit') and self.task_time:
+            time.sleep(self.task_time)
+        return _Result('', 0)
+
+
+class LocalExecutor(object):
+    """An executor that runs commands with ``/bin/sh`` in a directory
+    per VM below ``directory``. This directory acts as the home directory
+    of the VM.
+
+    The pre-initialization script is not run, because it schedules a
+    shutdown. The directories that it creates are created instead.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _home(self):
+        home = os.path.join(self.directory, fab.env.host_string)
+        if not os.path.isdir(home):
+            os.makedirs(home)
+        return home
+
+    def put(self, local, remote):
+        fname = os.path.join(self._home(), remote)
+        dirname = os.path.dirname(fname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if hasattr(local, 'getvalue'):
+            contents = local.getvalue()
+        else:
+            with file(local) as fin:
+                contents = fin.read()
+        # The scripts run as the local user, not as "ravello".
+        contents = contents.replace('eval RAVELLO_HOME=~$RAVELLO_TEST_USER',
+                                    'RAVELLO_HOME=$HOME')
+        with file(fname, 'w') as fout:
+            fout.write(contents)
+
+    def get(self, remote, local):
+        fname = os.path.join(self._home(), remote)
+        if os.path.exists(fname):
+            with file(fname) as fin:
+                local.write(fin.read())
+
+    def run(self, command, **kwargs):
+        home = self._home()
+        if command.endswith('.preinit'):
+            os.makedirs(os.path.join(home, 'runs', env.test_id, '.ravello'))
+            return _Result('', 0)
+        environ = os.environ.copy()
+        environ['HOME'] = home
+        environ['SHELL'] = '/bin/sh'
+        child = subprocess.Popen(['/bin/sh', '-c', command], cwd=home,
+                                 env=environ, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        stdout, _ = child.communicate()
+        stream = kwargs.get('stdout')
+        if stream is not None:
+            stream.write(stdout)
+        return _Result(stdout, child.returncode)
+
+
+def create_manifest(nvms, ntasks, commands=None):
+    """Create a manifest with one application that has ``nvms`` VMs, with
+    ``ntasks`` tasks each. Every task runs ``commands``."""
+    if commands is None:
+        commands = ['true']
+    vms = []
+    for i in range(nvms):
+        vmtasks = [ {'name': 'task{0}'.format(j), 'quiet': True,
+                     'commands': list(commands)} for j in range(ntasks) ]
+        vms.append({'name': 'vm{0}'.format(i), 'tasks': vmtasks})
+    appdef = {'name': 'bench', 'vms': vms}
+    return {'project': {'name': 'bench'}, 'applications': [appdef],
+            'repository': {'type': None, 'url': None}}
+
+
+def create_application(appdef):
+    """Create an application with a running VM for every VM in ``appdef``."""
+    vms = []
+    for i,vmdef in enumerate(appdef['vms']):
+        ipaddr = '10.{0}.{1}.{2}'.format(i >> 16, (i >> 8) & 255, i & 255)
+        vms.append({'id': 1000 + i, 'name': vmdef['name'],
+                    'dynamicMetadata': {'externalIp': ipaddr}})
+    return {'id': 1, 'name': 'bench:{0}:1'.format(appdef['name']),
+            'vms': vms}
+
+
+class _Args(object):
+    """Command-line arguments as used by the tasks module."""
+    continue_ = False
+    interactive = False
+    no_stream = True
+    log_dir = None
+
+
+class _Client(object):
+    """The API client attributes that are used by the tasks module."""
+    _project = 'bench'
+    url = 'http://localhost/services'
+    _cookie = 'JSESSIONID=bench'
+
+
+def analyze(results, task_time=0.0):
+    """Analyze the task results of a run.
+
+    Returns the time from the start of the run until the first task
+    (startup), the time between the end of a task and the start of the
+    next task on the same VM (boundary), and the time each task took in
+    excess of ``task_time`` (task). All times are in seconds.
+    """
+    start = results['start']
+    startup = []
+    boundary = []
+    overhead = []
+    for vmname,vmresults in results['tasks'].items():
+        if not vmresults:
+            continue
+        startup.append(vmresults[0]['start'] - start)
+        for prev,result in zip(vmresults, vmresults[1:]):
+            boundary.append(result['start'] - prev['end'])
+        for result in vmresults:
+            overhead.append(result['duration'] - task_time)
+    return {'startup': bench.summarize(startup),
+            'boundary': bench.summarize(boundary),
+            'task': bench.summarize(overhead)}
+
+
+def run_benchmark(vms=10, tasks_per_vm=3, executor='simulate',
+                  task_time=0.0, sync_interval=5, commands=None):
+    """Run the orchestration benchmark and return the results.
+
+    The ``commands`` are run by every task if ``executor`` is "local".
+    """
+    manifest = create_manifest(vms, tasks_per_vm, commands)
+    appdef = manifest['applications'][0]
+    app = create_application(appdef)
+    vmnames = [ vmdef['name'] for vmdef in appdef['vms'] ]
+    tmpdir = None
+    if executor == 'local':
+        tmpdir = tempfile.mkdtemp(prefix='testmill-bench-')
+        executor = LocalExecutor(tmpdir)
+    else:
+        executor = SimulatedExecutor(task_time)
+    try:
+        with env.new():
+            env.quiet = True
+            env.verbose = False
+            env.debug = False
+            env.args = _Args()
+            env.api = _Client()
+            env.manifest = manifest
+            env.private_key_file = None
+            env.executor = executor
+            env.sync_interval = sync_interval
+            start = time.time()
+            errors = tasks.run_all_tasks(app, vmnames)
+            end = time.time()
+            task_results = env.task_results
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    results = analyze({'start': start, 'tasks': task_results}, task_time)
+    results['wall_time'] = end - start
+    results['errors'] = errors
+    results['peak_rss'] = bench.peak_rss()
+    results['peak_rss_vm'] = bench.peak_rss(children=True)
+    return results
+
+
+def main(argv=None):
+    """Run the orchestration benchmark from the command line."""
+    parser = argparse.ArgumentParser(description='Benchmark the task '
+                                     'orchestration with simulated VMs.')
+    parser.add_argument('--vms', type=int, default=10)
+    parser.add_argument('--tasks', type=int, default=3)
+    parser.add_argument('--executor', choices=('simulate', 'local'),
+                        default='simulate')
+    parser.add_argument('--task-time', type=float, default=0.0)
+    parser.add_argument('--sync-interval', type=float, default=5.0)
+    args = parser.parse_args(argv)
+    results = run_benchmark(args.vms, args.tasks, args.executor,
+                            args.task_time, args.sync_interval)
+    bench.format_results(results)
+    return 1 if results['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
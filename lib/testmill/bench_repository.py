@@ -0,0 +1,219 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the repository walk and the packaging of the deploy archive.
+
+This generates a synthetic git repository and times the stages that
+"ravtest run" goes through before it can deploy a project, separately:
+
+* ``walk``: walking the tree without any ignore files.
+* ``ignore``: the extra time needed to parse and match ``.gitignore``
+  files, at every level of the tree and with negated patterns.
+* ``hash``: reading and hashing every file that is included.
+* ``archive``: writing the gzip compressed tar archive, as is done by
+  :func:`testmill.tasks.create_archive`.
+
+The tree is generated in a temporary directory, or in ``--directory`` so
+that it can be re-used between runs::
+
+    $ python -m testmill.bench_repository --files 100000 --shape wide
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+from testmill import bench, tasks, versioncontrol
+
+
+# The (width, depth) of the directory tree for each shape.
+shapes = {'wide': (200, 1), 'deep': (2, 12), 'balanced': (10, 3)}
+
+top_gitignore = '*.o\n!keep*.o\nbuild/\n'
+nested_gitignore = '# generated by bench_repository\n*.tmp\n!keep*.tmp\n' \
+                   '/cache/\n'
+
+
+def _file_name(index):
+    """Return the name of file number ``index``. One in five files is
+    ignored, and one in ten is re-included by a negated pattern."""
+    kind = index % 10
+    if kind == 0:
+        return 'file{0}.o'.format(index)
+    elif kind == 3:
+        return 'file{0}.tmp'.format(index)
+    elif kind == 5:
+        return 'keep{0}.o'.format(index)
+    elif kind == 7:
+        return 'keep{0}.tmp'.format(index)
+    return 'file{0}.txt'.format(index)
+
+
+def _text(index, size):
+    """Return ``size`` bytes of compressible text."""
+    line = 'line {0} of a synthetic source file\n'.format(index)
+    count = size // len(line) + 1
+    return (line * count)[:size]
+
+
+def create_tree(directory, files=10000, shape='balanced', file_size=1024,
+                binaries=0, binary_size=16*1024*1024):
+    """Create a synthetic git repository in ``directory``.
+
+    The repository has ``files`` text files of ``file_size`` bytes, spread
+    over a tree with the given ``shape``, and ``binaries`` incompressible
+    files of ``binary_size`` bytes. Every directory has a ``.gitignore``
+    file. Return the number of files and bytes that were written.
+    """
+    width, depth = shapes[shape]
+    dirs = []
+    def create_dirs(dirname, level):
+        os.mkdir(dirname)
+        dirs.append(dirname)
+        if level == depth:
+            return
+        for i in range(width):
+            create_dirs(os.path.join(dirname, 'd{0}'.format(i)), level+1)
+    os.mkdir(directory)
+    os.mkdir(os.path.join(directory, '.git'))
+    with file(os.path.join(directory, '.gitignore'), 'w') as fout:
+        fout.write(top_gitignore)
+    create_dirs(os.path.join(directory, 'src'), 0)
+    for dirname in dirs[1:]:
+        with file(os.path.join(dirname, '.gitignore'), 'w') as fout:
+            fout.write(nested_gitignore)
+    nbytes = 0
+    for i in range(files):
+        dirname = dirs[i % len(dirs)]
+        with file(os.path.join(dirname, _file_name(i)), 'w') as fout:
+            fout.write(_text(i, file_size))
+        nbytes += file_size
+    build = os.path.join(directory, 'build')
+    os.mkdir(build)
+    for i in range(binaries):
+        with file(os.path.join(build, 'blob{0}.bin'.format(i)), 'wb') as fout:
+            remaining = binary_size
+            while remaining > 0:
+                chunk = os.urandom(min(remaining, 1024*1024))
+                fout.write(chunk)
+                remaining -= len(chunk)
+        with file(os.path.join(directory, 'blob{0}.bin'.format(i)), 'wb') \
+                    as fout:
+            fout.write(os.urandom(min(binary_size, 1024*1024)))
+        nbytes += binary_size + min(binary_size, 1024*1024)
+    return files + 2*binaries, nbytes
+
+
+def _rate(count, elapsed):
+    return count / elapsed if elapsed > 0 else 0.0
+
+
+def run_benchmark(files=10000, shape='balanced', file_size=1024, binaries=0,
+                  binary_size=16*1024*1024, directory=None):
+    """Run the repository benchmark and return the results.
+
+    If ``directory`` is given and exists already, the tree in it is
+    re-used. Otherwise a new tree is created and removed afterwards.
+    """
+    results = {}
+    tmpdir = None
+    if directory is None:
+        tmpdir = tempfile.mkdtemp(prefix='testmill-bench-')
+        directory = os.path.join(tmpdir, 'repo')
+    cwd = os.getcwd()
+    try:
+        if not os.path.exists(directory):
+            start = time.time()
+            create_tree(directory, files, shape, file_size, binaries,
+                        binary_size)
+            results['create_seconds'] = time.time() - start
+        os.chdir(directory)
+
+        start = time.time()
+        entries = list(versioncontrol.walk_repository('.', None))
+        walk_time = time.time() - start
+        results['walk'] = {'time': walk_time, 'entries': len(entries),
+                           'entries_per_sec': _rate(len(entries), walk_time)}
+
+        start = time.time()
+        included = list(versioncontrol.walk_repository('.', 'git'))
+        ignore_time = max(0.0, time.time() - start - walk_time)
+        excluded = len(entries) - len(included)
+        results['ignore'] = {'time': ignore_time, 'excluded': excluded,
+                             'entries_per_sec': _rate(len(entries),
+                                                      ignore_time)}
+
+        start = time.time()
+        nfiles = nbytes = 0
+        for fname in included:
+            if not os.path.isfile(fname):
+                continue
+            md = hashlib.sha1()
+            with file(fname, 'rb') as fin:
+                while True:
+                    buf = fin.read(65536)
+                    if not buf:
+                        break
+                    md.update(buf)
+                    nbytes += len(buf)
+            nfiles += 1
+        hash_time = time.time() - start
+        results['hash'] = {'time': hash_time, 'files': nfiles,
+                           'bytes': nbytes,
+                           'files_per_sec': _rate(nfiles, hash_time),
+                           'mb_per_sec': _rate(nbytes / 1e6, hash_time)}
+
+        distfile = os.path.join(tmpdir or directory, 'dist.tar.gz')
+        start = time.time()
+        tasks.write_archive(distfile, included)
+        archive_time = time.time() - start
+        results['archive'] = {'time': archive_time,
+                              'size': os.stat(distfile).st_size,
+                              'files_per_sec': _rate(nfiles, archive_time),
+                              'mb_per_sec': _rate(nbytes / 1e6,
+                                                  archive_time)}
+        os.unlink(distfile)
+    finally:
+        os.chdir(cwd)
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    results['peak_rss'] = bench.peak_rss()
+    return results
+
+
+def main(argv=None):
+    """Run the repository benchmark from the command line."""
+    parser = argparse.ArgumentParser(description='Benchmark the repository '
+                                     'walk and deploy archive.')
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--shape', choices=sorted(shapes), default='balanced')
+    parser.add_argument('--file-size', type=int, default=1024)
+    parser.add_argument('--binaries', type=int, default=0)
+    parser.add_argument('--binary-size', type=int, default=16*1024*1024)
+    parser.add_argument('--directory')
+    args = parser.parse_args(argv)
+    results = run_benchmark(args.files, args.shape, args.file_size,
+                            args.binaries, args.binary_size, args.directory)
+    bench.format_results(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,9 +14,218 @@
 
 from __future__ import absolute_import
 
+import collections
+
 from testmill.state import env
 
 
+def split_name(name):
+    """Split an object name into a (project, defname, instance) tuple.
+    Return None if ``name`` does not have this form."""
+    parts = tuple(name.split(':'))
+    if len(parts) != 3:
+        return
+    return parts
+
+
+class EntityStore(object):
+    """An in-memory store for API objects (applications, blueprints or
+    images).
+
+    Objects are indexed by id, by name, and by the project, defname and
+    instance parts of their name. The indexes are kept consistent when
+    objects are inserted, replaced or deleted.
+
+    An object is either a summary, as returned by a listing, or a detailed
+    object, as returned by a single object lookup. The store is "complete"
+    once it has been loaded with a full listing.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Remove all objects."""
+        self.byid = collections.OrderedDict()
+        self.byname = {}
+        self.byproject = {}
+        self.bydefname = {}
+        self.detailed = set()
+        self.complete = False
+
+    def __len__(self):
+        return len(self.byid)
+
+    def __contains__(self, id):
+        return id in self.byid
+
+    def values(self):
+        """Return a list of all objects."""
+        return list(self.byid.values())
+
+    def reload(self, objs):
+        """Replace the contents of the store with the full listing
+        ``objs``."""
+        self.clear()
+        for obj in objs:
+            self.insert(obj)
+        self.complete = True
+
+    def insert(self, obj, detailed=False):
+        """Insert ``obj``, replacing any object with the same id."""
+        objid = obj['id']
+        if objid in self.byid:
+            self.delete(objid)
+        self.byid[objid] = obj
+        self.byname[obj['name']] = obj
+        parts = split_name(obj['name'])
+        if parts:
+            self.byproject.setdefault(parts[0], {})[objid] = obj
+            self.bydefname.setdefault(parts[:2], {})[objid] = obj
+        if detailed:
+            self.detailed.add(objid)
+        return obj
+
+    def delete(self, id):
+        """Delete the object with id ``id``, if it is present."""
+        obj = self.byid.pop(id, None)
+        if obj is None:
+            return
+        if self.byname.get(obj['name']) is obj:
+            del self.byname[obj['name']]
+        parts = split_name(obj['name'])
+        if parts:
+            for index, key in ((self.byproject, parts[0]),
+                               (self.bydefname, parts[:2])):
+                bucket = index[key]
+                del bucket[id]
+                if not bucket:
+                    del index[key]
+        self.detailed.discard(id)
+        return obj
+
+    def get(self, id=None, name=None, detailed=False):
+        """Return an object by its id or name, or None if it is not present.
+        If ``detailed`` is true, only return detailed objects."""
+        if id is not None:
+            obj = self.byid.get(id)
+        else:
+            obj = self.byname.get(name)
+        if obj is None or detailed and obj['id'] not in self.detailed:
+            return
+        return obj
+
+    def find(self, project=None, defname=None, instance=None):
+        """Return a list of the objects whose name matches ``project``,
+        ``defname`` and ``instance``, sorted by name."""
+        if project is not None and defname is not None:
+            if instance is not None:
+                name = '{0}:{1}:{2}'.format(project, defname, instance)
+                obj = self.byname.get(name)
+                return [obj] if obj is not None else []
+            objs = self.bydefname.get((project, defname), {}).values()
+        elif project is not None:
+            objs = self.byproject.get(project, {}).values()
+        else:
+            objs = [ obj for bucket in self.byproject.values()
+                         for obj in bucket.values() ]
+        if defname is not None or instance is not None:
+            objs = [ obj for obj in objs
+                     if _name_matches(obj['name'], project, defname,
+                                      instance) ]
+        return sorted(objs, key=lambda obj: obj['name'])
+
+
+def _name_matches(name, project=None, defname=None, instance=None):
+    """Return whether the object name ``name`` matches ``project``,
+    ``defname`` and ``instance``."""
+    parts = split_name(name)
+    if parts is None:
+        return False
+    return (project is None or parts[0] == project) and \
+            (defname is None or parts[1] == defname) and \
+            (instance is None or parts[2] == instance)
+
+
+def _get_store(name):
+    """Return the store ``env._<name>``, creating it if needed."""
+    attr = '_{0}'.format(name)
+    if not hasattr(env, attr):
+        setattr(env, attr, EntityStore())
+    return getattr(env, attr)
+
+
+def _iter_store(name, stream, project=None, defname=None, instance=None):
+    """Iterate over the objects in the store ``env._<name>`` that match
+    ``project``, ``defname`` and ``instance``, in no particular order.
+
+    If the store is not complete, the full listing is streamed with
+    ``stream`` and filtered as it arrives. All objects in the listing are
+    added to the store, and once the listing has been read to the end the
+    store is marked complete so that it is not streamed again.
+    """
+    store = _get_store(name)
+    if store.complete:
+        for obj in store.find(project, defname, instance):
+            yield obj
+        return
+    seen = set()
+    for obj in stream():
+        seen.add(obj['id'])
+        cached = store.get(id=obj['id'], detailed=True)
+        if cached is None:
+            cached = store.insert(obj)
+        if _name_matches(cached['name'], project, defname, instance):
+            yield cached
+    for id in list(store.byid):
+        if id not in seen:
+            store.delete(id)
+    store.complete = True
+
+
+def _load_store(name, listing):
+    """Return the store ``env._<name>``, making sure that it is complete.
+    ``listing`` is called to get the full listing if needed."""
+    store = _get_store(name)
+    if not store.complete:
+        store.reload(listing())
+    return store
+
+
+def _lookup(store, id, name, force_reload, fetch, listing):
+    """Look up an object by id or name in ``store``, and return its
+    detailed version.
+
+    If the object is not present in detailed form, or ``force_reload``
+    is set, it is fetched with ``fetch``. The store is updated with the
+    result, including removing objects that do not exist anymore.
+    """
+    if id:
+        if not force_reload:
+            obj = store.get(id=id, detailed=True)
+            if obj is not None:
+                return obj
+    elif name:
+        if not force_reload:
+            obj = store.get(name=name, detailed=True)
+            if obj is not None:
+                return obj
+        if force_reload or not store.complete:
+            store.reload(listing())
+        obj = store.get(name=name)
+        if obj is None:
+            return
+        id = obj['id']
+    else:
+        raise ValueError('Specifiy either "id" or "name".')
+    obj = fetch(id)
+    if obj:
+        store.insert(obj, detailed=True)
+    else:
+        store.delete(id)
+    return obj
+
+
 def _fixup_image(image):
     # XXX: Strip TestMill: prefix. We keep the testmill images with this
     # prefix until we've got a hierarchical library structure where we
@@ -25,195 +234,196 @@ def _fixup_image(image):
         image['name'] = image['name'][9:]
 
 
-def _init_image_cache():
-    """Initialize the images cache."""
-    if hasattr(env, '_images'):
-        return
+def _list_images():
     images = env.api.get_images()
     for image in images:
         _fixup_image(image)
-    env._images = images
-    env._images_byid = {}
-    env._images_byname = {}
+    return images
+
+
+def _fetch_image(id):
+    image = env.api.get_image(id)
+    if image:
+        _fixup_image(image)
+    return image
 
 
 def get_images():
     """Return a list of all images."""
-    _init_image_cache()
-    return env._images
+    return _load_store('images', _list_images).values()
 
 
 def get_image(id=None, name=None):
     """Get an image based on its id or name."""
-    _init_image_cache()
-    if id:
-        img = env._images_byid.get(id)
-        if img is not None:
-            return img
-        img = env.api.get_image(id)
-        _fixup_image(img)
-        env._images_byid[img['id']] = img
-        env._images_byname[img['name']] = img
-        return img
-    elif name:
-        img = env._images_byname.get(name)
-        if img is not None:
-            return img
-        for img in env._images:
-            if img['name'] == name:
-                break
-        else:
-            return
-        img = env.api.get_image(img['id'])
-        _fixup_image(img)
-        env._images_byid[img['id']] = img
-        env._images_byname[img['name']] = img
-        return img
-    else:
-        raise ValueError('Specifiy either "id" or "name".')
+    store = _get_store('images')
+    return _lookup(store, id, name, False, _fetch_image, _list_images)
 
 
-def _init_application_cache():
-    """Initialize the applications cache."""
-    if hasattr(env, '_applications'):
-        return
-    env._applications = env.api.get_applications()
-    env._applications_byid = {}
-    env._applications_byname = {}
+def _list_applications():
+    return env.api.get_applications()
 
 
 def get_applications():
     """Return a list of all applications."""
-    _init_application_cache()
-    return env._applications
+    return _load_store('applications', _list_applications).values()
+
+
+def iter_applications(project=None, defname=None, instance=None):
+    """Iterate over the applications matching ``project``, ``defname`` and
+    ``instance``, in no particular order.
+
+    If the full list of applications is not loaded yet, the listing is
+    streamed from the API and filtered as it arrives.
+    """
+    return _iter_store('applications', env.api.iter_applications,
+                       project, defname, instance)
 
 
 def find_applications(project=None, defname=None, instance=None):
-    """Find one or more applications."""
-    _init_application_cache()
-    applications = []
-    for app in env._applications:
-        parts = app['name'].split(':')
-        if len(parts) != 3:
-            continue
-        if project is not None and parts[0] != project or \
-                defname is not None and parts[1] != defname or \
-                instance is not None and parts[2] != instance:
-            continue
-        applications.append(app)
-    return applications
+    """Find one or more applications. The result is sorted by name."""
+    apps = iter_applications(project, defname, instance)
+    return sorted(apps, key=lambda app: app['name'])
+
+
+def get_cached_applications():
+    """Return the applications that are cached in detailed form. This does
+    not make any API calls."""
+    store = _get_store('applications')
+    return [ app for app in store.values() if app['id'] in store.detailed ]
 
 
 def get_application(id=None, name=None, force_reload=False):
-    """Get an application based on its id or name."""
-    _init_application_cache()
-    if force_reload:
-        env._applicatons = env.api.get_applications()
-    if id:
-        if not force_reload:
-            app = env._applications_byid.get(id)
-            if app is not None:
-                return app
-        app = env.api.get_application(id)
-        if app:
-            env._applications_byid[app['id']] = app
-            env._applications_byname[app['name']] = app
-        elif force_reload and id in env._applications_byid:
-            oldapp = env._applications_byid[id]
-            del env._applications_byid[oldapp['id']]
-            del env._applications_byname[oldapp['name']]
-        return app
-    elif name:
-        if not force_reload:
-            app = env._applications_byname.get(name)
-            if app is not None:
-                return app
-        for app in env._applications:
-            if app['name'] == name:
-                break
-        else:
-            return
-        app = env.api.get_application(app['id'])
-        if app:
-            env._applications_byid[app['id']] = app
-            env._applications_byname[app['name']] = app
-        elif force_reload and name in env._applications_byname:
-            oldapp = env._applications_byname[name]
-            del env._applications_byid[oldapp['id']]
-            del env._applications_byname[oldapp['name']]
+    """Get an application based on its id or name.
+
+    If ``force_reload`` is set and the application is cached already, it is
+    refreshed with :func:`sync_application`.
+    """
+    store = _get_store('applications')
+    if force_reload and id and store.get(id=id, detailed=True):
+        return sync_application(id)
+    return _lookup(store, id, name, force_reload, env.api.get_application,
+                   _list_applications)
+
+
+# Change feed
+
+VMStateChange = collections.namedtuple('VMStateChange',
+                                       ('seqno', 'application', 'vm',
+                                        'old', 'new'))
+
+max_changes = 1000
+
+
+def _record_change(app, vm, old, new):
+    """Add a VM state change to the change feed."""
+    if not hasattr(env, '_changes'):
+        env._changes = collections.deque(maxlen=max_changes)
+        env._last_change = 0
+    env._last_change += 1
+    change = VMStateChange(env._last_change, app['name'], vm['name'],
+                           old, new)
+    env._changes.append(change)
+    return change
+
+
+def last_change():
+    """Return the sequence number of the last recorded change, to be
+    passed to :func:`get_changes`."""
+    return getattr(env, '_last_change', 0)
+
+
+def get_changes(since=0, application=None):
+    """Return the VM state changes recorded after sequence number
+    ``since``, optionally only for the application named ``application``.
+
+    Only the last ``max_changes`` changes are kept.
+    """
+    return [ change for change in getattr(env, '_changes', ())
+             if change.seqno > since and
+                (application is None or change.application == application) ]
+
+
+def _vm_state(vm):
+    return vm.get('dynamicMetadata', {}).get('state')
+
+
+def _merge(obj, new, skip=()):
+    """Update the fields of ``obj`` that are different in ``new``, and
+    remove those that are not in ``new`` anymore."""
+    for key in list(obj):
+        if key not in new and key not in skip:
+            del obj[key]
+    for key in new:
+        if key not in skip and obj.get(key) != new[key]:
+            obj[key] = new[key]
+
+
+def sync_application(id):
+    """Refresh the cached application ``id`` from the API.
+
+    Instead of replacing the cached application, the new version is merged
+    into it: only the application and VM fields that changed are updated,
+    so existing references remain valid. VM state transitions are recorded
+    in the change feed (see :func:`get_changes`).
+
+    Return the application, or None if it does not exist anymore.
+    """
+    store = _get_store('applications')
+    new = env.api.get_application(id)
+    if not new:
+        store.delete(id)
+        return
+    app = store.get(id=id, detailed=True)
+    if app is None:
+        app = store.insert(new, detailed=True)
         return app
+    renamed = new['name'] != app['name']
+    if renamed:
+        store.delete(id)
+    oldvms = dict(((vm['id'], vm) for vm in app.get('vms', [])))
+    newvms = new.get('vms', [])
+    if set(oldvms) != set((vm['id'] for vm in newvms)):
+        for vm in newvms:
+            old = _vm_state(oldvms[vm['id']]) if vm['id'] in oldvms else None
+            if _vm_state(vm) != old:
+                _record_change(new, vm, old, _vm_state(vm))
+        app['vms'] = newvms
     else:
-        raise ValueError('Specifiy either "id" or "name".')
+        for vm in newvms:
+            oldvm = oldvms[vm['id']]
+            if _vm_state(vm) != _vm_state(oldvm):
+                _record_change(new, vm, _vm_state(oldvm), _vm_state(vm))
+            _merge(oldvm, vm)
+    _merge(app, new, skip=('vms',))
+    if renamed:
+        store.insert(app, detailed=True)
+    return app
 
 
-def _init_blueprint_cache():
-    """Initialize the blueprints cache."""
-    if hasattr(env, '_blueprints'):
-        return
-    env._blueprints = env.api.get_blueprints()
-    env._blueprints_byid = {}
-    env._blueprints_byname = {}
+def _list_blueprints():
+    return env.api.get_blueprints()
 
 
 def get_blueprints():
     """Return a list of all blueprints."""
-    _init_blueprint_cache()
-    return env._blueprints
+    return _load_store('blueprints', _list_blueprints).values()
+
+
+def iter_blueprints(project=None, defname=None, instance=None):
+    """Iterate over the blueprints matching ``project``, ``defname`` and
+    ``instance``. See :func:`iter_applications`."""
+    return _iter_store('blueprints', env.api.iter_blueprints,
+                       project, defname, instance)
 
 
 def find_blueprints(project=None, defname=None, instance=None):
-    """Find one or more blueprints."""
-    _init_blueprint_cache()
-    blueprints = []
-    for bp in env._blueprints:
-        parts = bp['name'].split(':')
-        if len(parts) != 3:
-            continue
-        if project is not None and parts[0] != project or \
-                defname is not None and parts[1] != defname or \
-                instance is not None and parts[2] != instance:
-            continue
-        blueprints.append(bp)
-    return blueprints
+    """Find one or more blueprints. The result is sorted by name."""
+    bps = iter_blueprints(project, defname, instance)
+    return sorted(bps, key=lambda bp: bp['name'])
 
 
 def get_blueprint(id=None, name=None, force_reload=False):
     """Get an blueprint based on its id or name."""
-    _init_blueprint_cache()
-    if force_reload:
-        env._blueprints = env.api.get_blueprints()
-    if id:
-        if not force_reload:
-            bp = env._blueprints_byid.get(id)
-            if bp is not None:
-                return bp
-        bp = env.api.get_blueprint(id)
-        if bp:
-            env._blueprints_byid[bp['id']] = bp
-            env._blueprints_byname[bp['name']] = bp
-        elif force_reload  and id in env._blueprints_byid:
-            oldbp = env._blueprints_byid[id]
-            del env._blueprints_byid[oldbp['id']]
-            del env._blueprints_byname[oldbp['name']]
-        return bp
-    elif name:
-        if not force_reload:
-            bp = env._blueprints_byname.get(name)
-            if bp is not None:
-                return bp
-        for bp in env._blueprints:
-            if bp['name'] == name:
-                break
-        else:
-            return
-        bp = env.api.get_blueprint(bp['id'])
-        if bp:
-            env._blueprints_byid[bp['id']] = bp
-            env._blueprints_byname[bp['name']] = bp
-        elif force_reload  and name in env._blueprints_byname:
-            oldbp = env._blueprints_byname[name]
-            del env._blueprints_byid[oldbp['id']]
-            del env._blueprints_byname[oldbp['name']]
-        return bp
-    else:
-        raise ValueError('Specifiy either "id" or "name".')
+    store = _get_store('blueprints')
+    return _lookup(store, id, name, force_reload, env.api.get_blueprint,
+                   _list_blueprints)
@@ -0,0 +1,217 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Record and replay API requests.
+
+A cassette is a file with the requests that a :class:`RavelloClient` made
+and the responses that it got. In "record" mode, every request is passed on
+to the API and the response is added to the cassette. In "replay" mode, no
+requests are made at all and the responses are served from the cassette
+instead. This makes tests that use the API fast and deterministic, and the
+number and order of the requests can be compared by diffing cassettes.
+
+Requests are matched by method and URL. Requests for the same URL are
+answered in the order in which they were recorded. When the recorded
+responses for a URL are used up, the last one is repeated. This way, a
+polling loop that needs fewer or more iterations on replay still works.
+
+A cassette is inserted with :func:`insert` or :func:`use`, or by setting
+$TESTMILL_CASSETTE to the file name and $TESTMILL_CASSETTE_MODE to "record"
+or "replay" (the default). When $TESTMILL_CASSETTE_TIMING is set, replayed
+responses take as long as they did when they were recorded.
+
+Request bodies, credentials and session ids are not recorded.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import time
+import zlib
+import atexit
+import contextlib
+import collections
+
+
+__all__ = ('CassetteError', 'Cassette', 'NullConnection', 'active', 'insert',
+           'eject', 'use')
+
+
+class CassetteError(Exception):
+    """A request could not be replayed."""
+
+
+class CassetteResponse(object):
+    """A recorded response. This implements the parts of the
+    ``HTTPResponse`` interface that are used by :class:`RavelloClient`.
+
+    If ``stream`` is true, the :attr:`body` attribute is None and the body
+    must be read with :meth:`read`.
+    """
+
+    def __init__(self, status, reason, headers, data, stream=False):
+        self.status = status
+        self.reason = reason
+        self._headers = dict((key.lower(), value)
+                             for key, value in headers.items())
+        self._data = data
+        self._pos = 0
+        self.body = None if stream else data
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def getheaders(self):
+        return list(self._headers.items())
+
+    def read(self, amt=None):
+        if amt is None:
+            amt = len(self._data) - self._pos
+        data = self._data[self._pos:self._pos+amt]
+        self._pos += len(data)
+        return data
+
+
+class NullConnection(object):
+    """Stands in for the connection of a client that replays requests."""
+
+    def close(self):
+        pass
+
+
+# Headers that are not recorded. The body is stored uncompressed.
+_skip_headers = set(('content-encoding', 'content-length', 'date',
+                     'transfer-encoding', 'connection'))
+
+class Cassette(object):
+    """A cassette stored in ``filename``. The ``mode`` is "record" or
+    "replay". If ``timing`` is true, replayed requests take as long as
+    they did when they were recorded."""
+
+    def __init__(self, filename, mode='replay', timing=False):
+        if mode not in ('record', 'replay'):
+            raise ValueError('unknown cassette mode: {0}'.format(mode))
+        self.filename = filename
+        self.mode = mode
+        self.timing = timing
+        self.interactions = []
+        self._queues = {}
+        if mode == 'replay':
+            self.load()
+
+    def load(self):
+        """Load the cassette from its file."""
+        try:
+            with open(self.filename) as fin:
+                data = json.load(fin)
+        except IOError:
+            raise CassetteError('cannot read cassette {0}'
+                                .format(self.filename))
+        self.interactions = data['interactions']
+        self._queues = {}
+        for interaction in self.interactions:
+            key = (interaction['method'], interaction['url'])
+            queue = self._queues.setdefault(key, collections.deque())
+            queue.append(interaction)
+
+    def save(self):
+        """Save the cassette to its file."""
+        data = {'version': 1, 'interactions': self.interactions}
+        with open(self.filename, 'w') as fout:
+            json.dump(data, fout, indent=1, sort_keys=True)
+            fout.write('\n')
+
+    def record(self, method, url, response, elapsed, stream=False):
+        """Record the response to a request. The body of ``response`` is
+        read if this was not done already. Return a response that can be
+        used in its place."""
+        t1 = time.time()
+        data = response.body if response.body is not None else \
+                    response.read()
+        elapsed += time.time() - t1
+        if response.getheader('Content-Encoding') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        headers = {}
+        for key, value in response.getheaders():
+            key = key.lower()
+            if key not in _skip_headers:
+                headers[key] = value
+        recorded = headers.copy()
+        if recorded.get('set-cookie', '').startswith('JSESSIONID='):
+            recorded['set-cookie'] = 'JSESSIONID=cassette'
+        self.interactions.append({'method': method, 'url': url,
+                                  'status': response.status,
+                                  'reason': response.reason,
+                                  'headers': recorded,
+                                  'body': data.decode('utf-8'),
+                                  'elapsed': round(elapsed, 3)})
+        return CassetteResponse(response.status, response.reason, headers,
+                                data, stream)
+
+    def play(self, method, url, stream=False):
+        """Return the recorded response for a request."""
+        queue = self._queues.get((method, url))
+        if not queue:
+            raise CassetteError('no recorded response for {0} {1}'
+                                .format(method, url))
+        interaction = queue.popleft() if len(queue) > 1 else queue[0]
+        if self.timing:
+            time.sleep(interaction['elapsed'])
+        return CassetteResponse(interaction['status'], interaction['reason'],
+                                interaction['headers'],
+                                interaction['body'].encode('utf-8'), stream)
+
+
+_active = None
+_from_environment = False
+
+def active():
+    """Return the active cassette, or None."""
+    global _from_environment
+    if not _from_environment:
+        _from_environment = True
+        filename = os.environ.get('TESTMILL_CASSETTE')
+        if filename and _active is None:
+            mode = os.environ.get('TESTMILL_CASSETTE_MODE', 'replay')
+            timing = bool(os.environ.get('TESTMILL_CASSETTE_TIMING'))
+            insert(filename, mode, timing)
+            atexit.register(eject)
+    return _active
+
+
+def insert(filename, mode='replay', timing=False):
+    """Make a cassette active. Return the cassette."""
+    global _active, _from_environment
+    _from_environment = True
+    _active = Cassette(filename, mode, timing)
+    return _active
+
+
+def eject():
+    """Deactivate the active cassette. A recorded cassette is saved."""
+    global _active
+    cassette, _active = _active, None
+    if cassette is not None and cassette.mode == 'record':
+        cassette.save()
+
+
+@contextlib.contextmanager
+def use(filename, mode='replay', timing=False):
+    """Context manager that makes a cassette active."""
+    cassette = insert(filename, mode, timing)
+    try:
+        yield cassette
+    finally:
+        eject()
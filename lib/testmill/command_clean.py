@@ -18,11 +18,12 @@ import time
 import textwrap
 
 from testmill import (console, login, manifest, keypair, util, cache,
-                      inflect, application, error)
+                      inflect, application, error, ravello)
 
 
 usage = textwrap.dedent("""\
-        usage: ravtest [OPTION]... clean [-a]
+        usage: ravtest [OPTION]... clean [-a] [-b] [-j JOBS]
+                       [--older-than AGE] [--state STATE]
                ravtest clean --help
         """)
 
@@ -38,14 +39,55 @@ description = textwrap.dedent("""\
                 Clean applications for all projects.
             -b, --blueprint
                 Clean blueprints instead of applications.
+            -j JOBS, --jobs JOBS
+                Remove up to JOBS objects concurrently. The default is 8.
+            --older-than AGE
+                Only remove objects created more than AGE ago. The age is
+                a number followed by a unit, e.g. "30m", "12h" or "7d".
+            --state STATE
+                Only remove objects in state STATE, e.g. "STOPPED".
         """)
 
 
+# How many times to try removing a single object.
+max_attempts = 3
+
+
 def add_args(parser):
     parser.usage = usage
     parser.description = description
     parser.add_argument('-a', '--all', action='store_true')
     parser.add_argument('-b', '--blueprint', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int)
+    parser.add_argument('--older-than')
+    parser.add_argument('--state')
+
+
+def get_age(obj):
+    """Return the age of an application or blueprint in seconds, or None if
+    it is not known."""
+    created = obj.get('creationTime') or obj.get('publishStartTime')
+    if not created:
+        return
+    return time.time() - created/1000
+
+
+def remove_object(client, obj, blueprint):
+    """Remove a single application or blueprint, retrying on errors."""
+    for i in range(max_attempts):
+        try:
+            if blueprint:
+                client.remove_blueprint(obj)
+            else:
+                client.remove_application(obj)
+        except ravello.AuthenticationError:
+            raise
+        except ravello.RavelloError:
+            if i == max_attempts-1:
+                raise
+            time.sleep(2**i)
+        else:
+            break
 
 
 def do_clean(args, env):
@@ -60,6 +102,15 @@ def do_clean(args, env):
                           'Cannot determine current project.\n'
                           "Use 'ravtest clean -a' to clean all projects.",
                           manifest.manifest_name())
+    if args.jobs is not None and args.jobs < 1:
+        error.raise_error('Illegal number of jobs: {0}.', args.jobs)
+    if args.older_than:
+        try:
+            min_age = util.parse_timedelta(args.older_than)
+        except ValueError:
+            error.raise_error('Illegal age: {0}.', args.older_than)
+    else:
+        min_age = None
     if args.all:
         project = None
     else:
@@ -74,6 +125,12 @@ def do_clean(args, env):
         objs = cache.find_applications(project)
         objs = filter(lambda app: app['totalStartedVms'] == 0, objs)
         what = 'application'
+    if args.state:
+        state = args.state.upper()
+        objs = filter(lambda obj: obj.get('state') == state, objs)
+    if min_age is not None:
+        objs = filter(lambda obj: get_age(obj) is not None and
+                                  get_age(obj) >= min_age, objs)
 
     count = len(objs)
     noun = inflect.plural_noun(what, count)
@@ -89,11 +146,27 @@ def do_clean(args, env):
             console.writeln('Not confirmed.')
             return 0
 
-    for obj in objs:
-        if args.blueprint:
-            env.api.remove_blueprint(obj)
-        else:
-            env.api.remove_application(obj)
-
-    verb = inflect.plural_verb('was', count)
-    console.info('{0} {1} {2} succesfully removed.', count, noun, verb)
+    console.start_progressbar(textwrap.dedent("""\
+        Removing {0} {1}...
+        Progress: '.' = removed, 'E' = error
+        ===> """.format(count, noun)))
+    def show_progress(obj, result, exc):
+        console.show_progress('E' if exc else '.')
+    func = lambda client, obj: remove_object(client, obj, args.blueprint)
+    results = env.api.map(func, objs, args.jobs, show_progress)
+    console.end_progressbar('DONE')
+
+    failed = [ (obj, exc) for obj, result, exc in results if exc ]
+    for obj, exc in failed:
+        console.error('Could not remove {0} `{1}`: {2!s}', what,
+                      obj['name'], exc)
+    removed = count - len(failed)
+    noun = inflect.plural_noun(what, removed)
+    verb = inflect.plural_verb('was', removed)
+    console.info('{0} {1} {2} succesfully removed.', removed, noun, verb)
+    if failed:
+        for obj, exc in failed:
+            if isinstance(exc, ravello.AuthenticationError):
+                raise exc
+        return error.EX_SOFTWARE
+    return error.EX_OK
@@ -0,0 +1,82 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import textwrap
+from testmill import console, daemon, error, util
+
+
+usage = textwrap.dedent("""\
+        usage: ravtest [OPTION]... daemon [--foreground] start|stop|status
+               ravtest daemon --help
+        """)
+
+description = textwrap.dedent("""\
+        Start or stop the ravtest daemon.
+
+        The daemon is an optional background process that keeps API
+        sessions, public keys and parsed manifests around between
+        invocations of ravtest. When the daemon is running, the "ps",
+        "run", "lint" and "restore" commands are executed by the daemon,
+        which makes them start up a lot faster. The "save" and "clean"
+        commands are executed by the daemon only when --yes is provided.
+
+        The daemon listens on a socket in your home directory
+        ({config_dir}). It exits by itself after it has been idle for
+        {idle_minutes} minutes.
+
+        The available options are:
+            --foreground
+                Do not detach from the terminal. Only valid with "start".
+        """.format(config_dir=util.get_human_readable_config_dir(),
+                   idle_minutes=daemon.idle_timeout // 60))
+
+
+def add_args(parser):
+    parser.usage = usage
+    parser.description = description
+    parser.add_argument('--foreground', action='store_true')
+    parser.add_argument('action', choices=('start', 'stop', 'status'))
+
+
+def do_daemon(args, env):
+    """The "ravtest daemon" command."""
+    if not daemon.supported():
+        error.raise_error('The daemon is not supported on this platform.')
+    pid = daemon.ping()
+    if args.action == 'status':
+        if pid is None:
+            console.info('The daemon is not running.')
+            return 1
+        console.info('The daemon is running with PID {0}.', pid)
+    elif args.action == 'stop':
+        if not daemon.stop():
+            console.info('The daemon is not running.')
+            return error.EX_OK
+        console.info('The daemon was stopped.')
+    elif pid is not None:
+        console.info('The daemon is already running with PID {0}.', pid)
+    elif args.foreground:
+        server = daemon.Daemon()
+        server.bind()
+        server.serve()
+    else:
+        pid = daemon.start()
+        if pid is None:
+            error.raise_error('The daemon did not start up.\n'
+                              'Check {0} for errors.',
+                              util.get_human_readable_config_dir())
+        console.info('The daemon was started with PID {0}.', pid)
+    return error.EX_OK
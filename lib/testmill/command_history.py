@@ -0,0 +1,157 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import time
+import textwrap
+
+from testmill import console, history, error
+
+
+usage = textwrap.dedent("""\
+        usage: ravtest [OPTION]... history [-n <count>] [--junit <file>]
+                       [--json <file>] [<test_id>]
+               ravtest history --help
+        """)
+
+description = textwrap.dedent("""\
+        Show the history of "ravtest run".
+
+        Without <test_id>, the most recent runs are listed together with
+        the time spent in each phase. The "create" phase is the time it
+        took to create or re-use an application, "wait" is the time until
+        it was ready to execute tasks, and "tasks" is the time it took to
+        run the tasks. If <test_id> is provided, the timings and the exit
+        status of every task on every virtual machine are shown for that
+        run. The <test_id> may be abbreviated.
+
+        The available options are:
+            -n <count>, --count <count>
+                The number of runs to list. The default is 20.
+            --junit <file>
+                Export the results of the run as a JUnit XML file. If no
+                <test_id> is provided, the most recent run is exported.
+                Use "-" to write to standard output.
+            --json <file>
+                Export the record for the run as a JSON file. Use "-" to
+                write to standard output.
+        """)
+
+
+def add_args(parser):
+    parser.usage = usage
+    parser.description = description
+    parser.add_argument('-n', '--count', type=int, default=20)
+    parser.add_argument('--junit')
+    parser.add_argument('--json')
+    parser.add_argument('test_id', nargs='?')
+
+
+def write_file(fname, contents):
+    """Write ``contents`` to ``fname``, or to standard output if
+    ``fname`` is "-"."""
+    if fname == '-':
+        console.writeln(contents)
+        return
+    try:
+        with open(fname, 'w') as fout:
+            fout.write(contents)
+    except IOError as e:
+        error.raise_error('Could not write `{0}`: {1!s}', fname, e[1])
+
+
+def format_time(t):
+    """Format a time stamp."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+
+def show_runs(records):
+    """Show a list of runs."""
+    if not records:
+        console.info('No runs have been recorded yet.')
+        return
+    console.writeln('{0:12}  {1:19}  {2:20}  {3:6}  {4:>7}  {5}',
+                    'TEST ID', 'STARTED', 'APPLICATION', 'STATUS',
+                    'TIME', 'PHASES')
+    for record in reversed(records):
+        phases = ['{0} {1}'.format(name, history.format_duration(secs))
+                  for name,secs in history.get_phases(record)
+                  if name in history.run_phases]
+        appname = '{0}:{1}'.format(record['project'], record['application'])
+        console.writeln('{0:12}  {1:19}  {2:20}  {3:6}  {4:>7}  {5}',
+                        record['test_id'][:12], format_time(record['start']),
+                        appname[:20], record['status'],
+                        history.format_duration(record['duration']),
+                        ', '.join(phases))
+
+
+def show_run(record):
+    """Show the details of a single run."""
+    console.writeln('Run `{0}`:\n', record['test_id'])
+    console.writeln('    Application: {0}:{1} (`{2}`)', record['project'],
+                    record['application'], record['instance'])
+    console.writeln('    Started: {0}', format_time(record['start']))
+    console.writeln('    Status: {0} ({1} failed)', record['status'],
+                    record['errors'])
+    if record.get('failed_phase'):
+        console.writeln('    Aborted in phase: {0}', record['failed_phase'])
+    console.writeln('    Total time: {0}\n',
+                    history.format_duration(record['duration']))
+    console.writeln('    Phases:')
+    for name,secs in history.get_phases(record):
+        console.writeln('        {0:12} {1:>7}', name,
+                        history.format_duration(secs))
+    for vmname in sorted(record['vms']):
+        console.writeln('\n    Tasks on `{0}`:', vmname)
+        for task in record['vms'][vmname]['tasks']:
+            status = task['exit_code']
+            if status is None:
+                status = 'error'
+            console.writeln('        {0:12} {1:>7}  exit {2:<5}  {3} lines, '
+                            '{4} bytes', task['name'],
+                            history.format_duration(task['duration']),
+                            status, task['output_lines'],
+                            task['output_bytes'])
+    console.writeln()
+
+
+def do_history(args, env):
+    """The "ravtest history" command."""
+    if args.count < 1:
+        error.raise_error('Illegal count: {0}.', args.count)
+
+    if args.test_id:
+        record = history.find_record(args.test_id)
+        if record is None:
+            error.raise_error('No run found with test ID `{0}`.',
+                              args.test_id)
+    elif args.junit or args.json:
+        records = history.get_records(1)
+        if not records:
+            error.raise_error('No runs have been recorded yet.')
+        record = records[0]
+
+    if args.junit:
+        write_file(args.junit, history.to_junit(record))
+    if args.json:
+        write_file(args.json, history.to_json(record))
+    if args.junit or args.json:
+        return error.EX_OK
+
+    if args.test_id:
+        show_run(record)
+    else:
+        show_runs(history.get_records(args.count))
+    return error.EX_OK
@@ -0,0 +1,105 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import textwrap
+
+from testmill import (console, manifest, keypair, login, error,
+                      application, pool, inflect)
+
+
+usage = textwrap.dedent("""\
+        usage: ravtest [OPTION]... pool [--size <size>] [--wait] [--stop]
+                       fill|status <application>
+               ravtest pool --help
+        """)
+
+description = textwrap.dedent("""\
+        Manage the warm pool for an application.
+
+        The warm pool consists of published instances of <application>
+        that are ready to be re-used by "ravtest run". The "fill" action
+        creates and publishes new instances until the pool has the
+        requested size. The "status" action lists the instances in the
+        pool.
+
+        The pool size is taken from the "pool" key of the application in
+        the manifest. If the key is set, "ravtest run" refills the pool in
+        the background after it used an instance.
+
+        Note that instances in the pool are running until they are used by
+        "ravtest run", unless --stop is specified.
+
+        The available options are:
+            --size <size>
+                The number of instances to keep in the pool. This overrides
+                the size in the manifest. The default is 1.
+            --wait
+                Wait until the new instances have started up.
+            --stop
+                Stop the new instances once they have started up. Stopped
+                instances are cheaper to keep around, but take longer to
+                become available. Implies --wait.
+        """)
+
+
+def add_args(parser):
+    parser.usage = usage
+    parser.description = description
+    parser.add_argument('--size', type=int)
+    parser.add_argument('--wait', action='store_true')
+    parser.add_argument('--stop', action='store_true')
+    parser.add_argument('action', choices=('fill', 'status'))
+    parser.add_argument('application')
+
+
+def do_pool(args, env):
+    """The "ravtest pool" command."""
+    login.default_login()
+    keypair.default_keypair()
+    manif = manifest.default_manifest()
+
+    for appdef in manif.get('applications', []):
+        if appdef['name'] == args.application:
+            break
+    else:
+        error.raise_error("Unknown application `{0}`.", args.application)
+    size = args.size if args.size is not None else appdef.get('pool', 1)
+    if size < 0:
+        error.raise_error('Illegal pool size: {0}.', size)
+
+    if args.action == 'status':
+        apps = pool.get_pool(appdef)
+        what = inflect.plural_noun('instance', len(apps))
+        console.writeln('Pool for `{0}` has {1} {2} (size {3}):\n',
+                        appdef['name'], len(apps), what, size)
+        for app in apps:
+            state = application.get_application_state(app)
+            console.writeln('    `{0}`: {1}', app['name'], state)
+        return error.EX_OK
+
+    created = pool.fill_pool(appdef, size)
+    if not created:
+        console.info('The pool for `{0}` is full.', appdef['name'])
+        return error.EX_OK
+    if args.wait or args.stop:
+        for app in created:
+            app = application.wait_until_application_is_in_state(app,
+                                                                 'STARTED')
+            if args.stop:
+                application.stop_application(app)
+    what = inflect.plural_noun('instance', len(created))
+    console.info('Added {0} {1} to the pool.', len(created), what)
+    return error.EX_OK
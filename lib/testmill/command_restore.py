@@ -19,9 +19,6 @@ import sys
 import subprocess
 import textwrap
 
-import fabric
-import fabric.api as fab
-
 from testmill import (login, cache, keypair, manifest, application,
                       error, util, console, inflect)
 
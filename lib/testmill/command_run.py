@@ -14,17 +14,21 @@
 
 from __future__ import absolute_import, print_function
 
+import time
 import argparse
 import textwrap
 
 from testmill import (console, manifest, keypair, login, error,
-                      application, tasks, util, inflect)
+                      application, tasks, util, inflect, pool, output,
+                      history, sshmux)
 from testmill.state import env
 
 
 usage = textwrap.dedent("""\
         usage: ravtest [OPTION]... run [-i] [-c] [--new] [--vms <vmlist>]
-                       [--dry-run] <application> [<command>]
+                       [--dry-run] [--no-stream] [--log-dir <dir>]
+                       [--transport <transport>] [--agent]
+                       <application> [<command>]
                ravtest run --help
         """)
 
@@ -35,9 +39,15 @@ description = textwrap.dedent("""\
         (.ravello.yml). It is then created if it doesn't exist yet, and the
         runbook defined in the manifest is run.
 
+        The timings and results of every task are recorded in the run
+        history. Use "ravtest history" to show them.
+
         If --new is specified, a new application instance is always created,
         even if one exists already.
 
+        If the application has a warm pool (see "ravtest pool"), an instance
+        is taken from the pool, and the pool is refilled in the background.
+
         The available options are:
             -i, --interactive
                 Run in interactive mode. All tasks are run directly
@@ -55,7 +65,29 @@ description = textwrap.dedent("""\
             --dry-run
                 Do not execute any tasks. Useful for starting up an
                 application without doing anything yet.
-        """)
+            --no-stream
+                Show the output of a task after it has completed, instead
+                of line by line while it is running.
+            --log-dir <dir>
+                Write the full output of every task to a log file under
+                <dir>. Otherwise only the last {tail} lines of output are
+                kept for every task.
+            --transport <transport>
+                How to connect to the virtual machines. This is either
+                "fabric" (the default), or "openssh" to use the local
+                OpenSSH client. The latter is faster for large uploads and
+                for tasks with a lot of output, and uses persistent
+                connections that are shared with "ravtest ssh".
+            --agent
+                Start a task agent on the virtual machines. The agent
+                runs all tasks of a VM in a single login shell, which
+                saves a few round trips for every task. Without it, every
+                task starts a new login shell. Tasks run by the agent
+                have no terminal, so sudo fails on images that require a
+                tty for it. On such images, set "user: root" on the tasks
+                that need it. Tasks with a user and interactive tasks
+                always run with a terminal.
+        """).format(tail=output.default_tail)
 
 
 def add_args(parser):
@@ -67,12 +99,20 @@ def add_args(parser):
     parser.add_argument('--new', action='store_true')
     parser.add_argument('--vms')
     parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--no-stream', action='store_true')
+    parser.add_argument('--log-dir')
+    parser.add_argument('--transport', choices=sorted(tasks.executors),
+                        default='fabric')
+    parser.add_argument('--agent', action='store_true')
     parser.add_argument('application')
     parser.add_argument('command', nargs='?')
 
 
 def do_run(args, env):
     """The "ravello run" command."""
+    if args.transport == 'openssh' and not sshmux.supported():
+        error.raise_error('The openssh transport requires a local OpenSSH '
+                          'installation.')
     login.default_login()
     keypair.default_keypair()
     manif = manifest.default_manifest()
@@ -95,19 +135,46 @@ def do_run(args, env):
     if not vms:
         error.raise_error('No virtual machines in application.')
 
-    app = application.create_or_reuse_application(appdef, args.new)
-    app = application.wait_for_application(app, vms)
-
-    if args.command:
-        for vm in appdef['vms']:
-            for task in vm['tasks']:
-                if task['name'] == 'execute':
-                    task['commands'] = [args.command]
-    elif args.dry_run:
-        for vm in appdef['vms']:
-            vm['tasks'] = []
-
-    ret = tasks.run_all_tasks(app, vms)
+    # The run is recorded in the history even if it is aborted by an error.
+    # In that case the record has the phase in which the error happened.
+    test_id = tasks.new_test_id()
+    project = manif['project']['name']
+    phases = {}
+    app = None
+    ret = None
+    phase = 'create'
+    start = t1 = time.time()
+    try:
+        app = application.create_or_reuse_application(appdef, args.new)
+        if appdef.get('pool'):
+            pool.refill_in_background(appdef, appdef['pool'], [app['id']])
+        phases['create'] = time.time() - t1
+        phase, t1 = 'wait', time.time()
+        app = application.wait_for_application(app, vms)
+        phases['wait'] = time.time() - t1
+
+        if args.command:
+            for vm in appdef['vms']:
+                for task in vm['tasks']:
+                    if task['name'] == 'execute':
+                        task['commands'] = [args.command]
+        elif args.dry_run:
+            for vm in appdef['vms']:
+                vm['tasks'] = []
+
+        phase, t1 = 'tasks', time.time()
+        ret = tasks.run_all_tasks(app, vms, test_id)
+        phases['tasks'] = time.time() - t1
+        phase = None
+    finally:
+        end = time.time()
+        if phase:
+            phases[phase] = end - t1
+        record = history.create_record(test_id, app, appdef, project, start,
+                                       end, phases,
+                                       getattr(env, 'task_results', {}), ret,
+                                       phase)
+        history.save_record(record)
 
     console.info('\n== The following services will be available for {0} '
                  'minutes:\n', appdef['keepalive'])
@@ -19,11 +19,8 @@ import sys
 import subprocess
 import textwrap
 
-import fabric
-import fabric.api as fab
-
 from testmill import (login, cache, keypair, manifest, application,
-                      error, util, console, inflect)
+                      error, util, console, inflect, sshmux)
 
 
 usage = textwrap.dedent("""\
@@ -143,31 +140,27 @@ def do_ssh(args, env):
 
     # Now run ssh. Prefer openssh but fall back to using Fabric/Paramiko.
 
-    host = 'ravello@{0}'.format(vm['dynamicMetadata']['externalIp'])
+    addr = vm['dynamicMetadata']['externalIp']
+    host = '{0}@{1}'.format(application.ssh_user, addr)
     command = '~/bin/run {0}'.format(args.testid)
 
     openssh = util.find_openssh()
     interactive = os.isatty(sys.stdin.fileno())
 
     if interactive and openssh:
+        # The session is multiplexed over the master connection to the VM
+        # if there is one, and becomes the master otherwise.
+        options = sshmux.ssh_options(addr, application.ssh_user)
         if not sys.platform.startswith('win'):
             # On Unix use execve(). This is the most efficient.
-            argv = ['ssh', '-i', env.private_key_file,
-                    '-o', 'UserKnownHostsFile=/dev/null',
-                    '-o', 'StrictHostKeyChecking=no',
-                    '-o', 'LogLevel=quiet',
-                    '-t',  host, command]
+            argv = ['ssh'] + options + ['-t', host, command]
             console.debug('Starting {0}', ' '.join(argv))
             os.execve(openssh, argv, os.environ)
         else:
             # Windows has execve() but for some reason it does not work
             # well with arguments with spaces in it. So use subprocess
             # instead.
-            command = [openssh, '-i', env.private_key_file,
-                       '-o', 'UserKnownHostsFile=NUL',
-                       '-o', 'StrictHostKeyChecking=no',
-                       '-o', 'LogLevel=quiet',
-                       '-t', host, command]
+            command = [openssh] + options + ['-t', host, command]
             ssh = subprocess.Popen(command)
             ret = ssh.wait()
             error.exit(ret)
@@ -184,6 +177,10 @@ def do_ssh(args, env):
               be garbled (e.g. progress bars).
             """))
 
+    # Fabric is slow to import so only do that when we need it.
+    import fabric.state
+    import fabric.api as fab
+
     fab.env.host_string = host
     fab.env.key_filename = env.private_key_file
     fab.env.disable_known_hosts = True
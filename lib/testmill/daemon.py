@@ -0,0 +1,564 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The "ravtest" daemon.
+
+The daemon is an optional background process that listens on a Unix domain
+socket in the configuration directory. When it is running, "ravtest" becomes
+a thin client that forwards its command-line arguments to the daemon.
+
+The daemon keeps all modules imported, and keeps logged in API sessions,
+public keys and parsed manifests around between invocations. For every
+request it forks a worker process that runs the command. The worker's
+standard output and standard error are sent back to the client, followed by
+the exit status.
+
+NOTE: This module is imported by the main module. Keep it light.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import struct
+import pickle
+
+from testmill import util
+from testmill.state import env
+
+
+# The wire protocol is a sequence of frames. Each frame has a one byte
+# type and a 4-byte length, followed by the payload.
+
+FRAME_REQUEST = b'R'
+FRAME_STDOUT = b'O'
+FRAME_STDERR = b'E'
+FRAME_EXIT = b'X'
+FRAME_PING = b'P'
+FRAME_QUIT = b'Q'
+
+_header = struct.Struct('>cI')
+
+# Commands that are forwarded to the daemon. Commands that need a terminal
+# ("ssh", "login") or that change the session ("logout") always run locally.
+# Commands that may ask for confirmation are only forwarded with --yes.
+forwarded_commands = ('ps', 'run', 'lint', 'restore')
+confirm_commands = ('save', 'clean')
+
+session_ttl = 300
+idle_timeout = 1800
+
+
+def socket_name():
+    """Return the name of the daemon socket."""
+    cfgdir = util.get_config_dir()
+    return os.path.join(cfgdir, 'daemon.sock')
+
+
+def supported():
+    """Return whether the daemon is supported on this platform."""
+    return hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork')
+
+
+def _recvall(sock, size):
+    """Receive exactly ``size`` bytes from ``sock``."""
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def write_frame(sock, typ, payload=b''):
+    """Write a single frame to ``sock``."""
+    sock.sendall(_header.pack(typ, len(payload)) + payload)
+
+
+def read_frame(sock):
+    """Read a single frame from ``sock``. Return a (type, payload) tuple."""
+    typ, size = _header.unpack(_recvall(sock, _header.size))
+    payload = _recvall(sock, size)
+    return typ, payload
+
+
+def connect():
+    """Connect to the daemon. Return the socket, or None if the daemon is
+    not running."""
+    if not supported():
+        return
+    sockname = socket_name()
+    if not os.path.exists(sockname):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockname)
+    except socket.error:
+        sock.close()
+        return
+    return sock
+
+
+def ping():
+    """Return the process ID of the daemon if it is running, or None."""
+    sock = connect()
+    if sock is None:
+        return
+    try:
+        write_frame(sock, FRAME_PING)
+        typ, payload = read_frame(sock)
+    except (socket.error, EOFError):
+        return
+    finally:
+        sock.close()
+    return json.loads(payload.decode('utf-8'))
+
+
+def stop():
+    """Ask the daemon to exit. Return whether it was running."""
+    sock = connect()
+    if sock is None:
+        return False
+    try:
+        write_frame(sock, FRAME_QUIT)
+        read_frame(sock)
+    except (socket.error, EOFError):
+        pass
+    finally:
+        sock.close()
+    return True
+
+
+# Client side
+
+def _parse_global_args(argv):
+    """Parse the global arguments in ``argv`` without loading any
+    sub-command."""
+    from testmill import main, argparse
+    parser = main.create_parser()
+    try:
+        args = parser.parse_args(argv)
+    except argparse.ParseError as e:
+        args = e.namespace
+    return args
+
+
+def should_forward(argv):
+    """Return whether the command in ``argv`` can be forwarded."""
+    if getattr(env, '_daemon_worker', False):
+        return False
+    args = _parse_global_args(argv)
+    if args.help or args.version or not args.subcmd or args.trace \
+                or args.stats:
+        return False
+    if args.subcmd in confirm_commands:
+        return args.yes
+    if args.subcmd == 'run':
+        return '-i' not in argv and '--interactive' not in argv
+    return args.subcmd in forwarded_commands
+
+
+def forward(argv):
+    """Forward the command in ``argv`` to the daemon.
+
+    Return the exit status of the command, or None if the command could not
+    be forwarded. In that case it needs to be run locally.
+    """
+    if not supported() or not os.path.exists(socket_name()):
+        return
+    if not should_forward(argv):
+        return
+    sock = connect()
+    if sock is None:
+        return
+    request = { 'argv': argv, 'cwd': os.getcwd(),
+                'environ': dict(os.environ) }
+    status = None
+    try:
+        write_frame(sock, FRAME_REQUEST, json.dumps(request).encode('utf-8'))
+        while True:
+            typ, payload = read_frame(sock)
+            if typ == FRAME_STDOUT:
+                sys.stdout.write(payload); sys.stdout.flush()
+            elif typ == FRAME_STDERR:
+                sys.stderr.write(payload); sys.stderr.flush()
+            elif typ == FRAME_EXIT:
+                status = json.loads(payload.decode('utf-8'))
+                break
+    except (socket.error, EOFError):
+        # The daemon went away while executing the command. It is
+        # not safe to re-run it locally, as it may have had side effects.
+        sys.stderr.write('Error: lost connection to ravtest daemon.\n')
+        status = 1
+    finally:
+        sock.close()
+    return status
+
+
+# Server side
+
+def session_key(args):
+    """Return the key under which the API session for ``args`` is stored."""
+    try:
+        with open(os.path.join(util.get_config_dir(), 'api-token')) as ftok:
+            token = ftok.read().strip()
+    except IOError:
+        token = None
+    return (args.user, args.password, args.service_url, token)
+
+
+def create_session(args):
+    """Log in and load the keypair for ``args``. Return the session."""
+    from testmill import ravello, login, keypair
+    with env.new():
+        env.username = args.user
+        env.password = args.password
+        env.service_url = args.service_url
+        env.quiet = True
+        env.debug = False
+        env.api = ravello.RavelloClient(args.user, args.password,
+                                        args.service_url)
+        login.default_login()
+        pubkey = keypair.load_keypair()
+        session = { 'api': env.api, 'public_key': pubkey,
+                    'private_key_file': getattr(env, 'private_key_file', None),
+                    'created': time.time() }
+    # Keep the cookie but drop the connection. A connection cannot be
+    # shared between the workers.
+    session['api']._disconnect()
+    return session
+
+
+def restore_session():
+    """Restore the warm API session, if running in a daemon worker.
+
+    This is called when the environment is created.
+    """
+    session = getattr(env, '_daemon_session', None)
+    if session is None:
+        return
+    env.api = session['api']
+    if session['public_key']:
+        env.public_key = session['public_key']
+        env.private_key_file = session['private_key_file']
+
+
+class Daemon(object):
+    """The daemon."""
+
+    def __init__(self, sockname=None):
+        self.sockname = sockname or socket_name()
+        self.sessions = {}
+        self.pending = {}
+        self.children = set()
+        self.last_request = time.time()
+        self.listener = None
+
+    def log(self, message, *args):
+        sys.stderr.write('{0}: {1}\n'.format(time.strftime('%c'),
+                                             message.format(*args)))
+        sys.stderr.flush()
+
+    def bind(self):
+        """Bind to our socket."""
+        if ping() is not None:
+            raise RuntimeError('daemon is already running')
+        try:
+            os.unlink(self.sockname)
+        except OSError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            sock.bind(self.sockname)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        self.listener = sock
+
+    def warm_up(self):
+        """Import all modules that the sub-commands need."""
+        from testmill import main
+        for name in main.subcommands:
+            main.load_subcommand(name)
+
+    def get_session(self, request):
+        """Return the warm session for ``request``, or None if there is
+        none. A new session is created by the handler, see
+        :meth:`create_session`."""
+        args = _parse_global_args(request['argv'])
+        key = session_key(args)
+        session = self.sessions.get(key)
+        if session and time.time() - session['created'] < session_ttl:
+            return session
+        self.sessions.pop(key, None)
+
+    def create_session(self, request, fd):
+        """Create a session for ``request`` and send it to the daemon over
+        the pipe ``fd``. This runs in a handler process, so that a slow
+        login does not hold up the other clients."""
+        args = _parse_global_args(request['argv'])
+        try:
+            session = create_session(args)
+        except Exception as e:
+            # Not fatal. The worker will try to log in by itself and will
+            # report the error to the user.
+            self.log('could not create session: {0!s}', e)
+            session = None
+        else:
+            data = pickle.dumps((session_key(args), session))
+            while data:
+                data = data[os.write(fd, data):]
+        os.close(fd)
+        return session
+
+    def read_session(self, fd):
+        """Read a session that a handler sent over ``fd``."""
+        data = os.read(fd, 65536)
+        if data:
+            self.pending[fd] += data
+            return
+        os.close(fd)
+        data = self.pending.pop(fd)
+        if not data:
+            return
+        try:
+            key, session = pickle.loads(data)
+        except Exception as e:
+            self.log('could not read session: {0!s}', e)
+            return
+        self.sessions[key] = session
+
+    def parse_manifest(self, request):
+        """Pre-parse the manifest for ``request``, so that workers find it
+        in the cache."""
+        from testmill import manifest
+        args = _parse_global_args(request['argv'])
+        filename = args.manifest or manifest.default_manifest_name()
+        filename = os.path.join(request['cwd'], filename)
+        try:
+            manifest.parse_yaml_file(filename)
+        except Exception:
+            pass
+
+    def serve(self):
+        """Serve requests until we are asked to quit, or until we have been
+        idle for ``idle_timeout`` seconds."""
+        self.warm_up()
+        self.log('listening on {0}', self.sockname)
+        try:
+            while True:
+                self.reap_children()
+                if not self.children and \
+                        time.time() - self.last_request > idle_timeout:
+                    self.log('idle timeout, exiting')
+                    break
+                rfds, _, _ = select_retry([self.listener] +
+                                          list(self.pending), 5)
+                for fd in rfds:
+                    if fd in self.pending:
+                        self.read_session(fd)
+                if self.listener not in rfds:
+                    continue
+                conn, _ = self.listener.accept()
+                try:
+                    if not self.handle_connection(conn):
+                        break
+                finally:
+                    conn.close()
+        finally:
+            self.listener.close()
+            try:
+                os.unlink(self.sockname)
+            except OSError:
+                pass
+
+    def reap_children(self):
+        """Reap exited handler processes."""
+        for pid in list(self.children):
+            try:
+                pid, _ = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                self.children.discard(pid)
+                continue
+            if pid:
+                self.children.discard(pid)
+
+    def handle_connection(self, conn):
+        """Handle a new connection. Return False if we need to quit."""
+        try:
+            typ, payload = read_frame(conn)
+        except (socket.error, EOFError):
+            return True
+        if typ == FRAME_PING:
+            write_frame(conn, FRAME_PING, json.dumps(os.getpid()).encode())
+            return True
+        elif typ == FRAME_QUIT:
+            self.log('exiting at user request')
+            write_frame(conn, FRAME_QUIT)
+            return False
+        elif typ != FRAME_REQUEST:
+            return True
+        self.last_request = time.time()
+        request = json.loads(payload.decode('utf-8'))
+        self.log('request: {0}', ' '.join(request['argv']))
+        session = self.get_session(request)
+        self.parse_manifest(request)
+        if session is None:
+            session_r, session_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.listener.close()
+                for fd in self.pending:
+                    os.close(fd)
+                if session is None:
+                    os.close(session_r)
+                    session = self.create_session(request, session_w)
+                status = run_request(conn, request, session)
+            finally:
+                os._exit(status)
+        self.children.add(pid)
+        if session is None:
+            os.close(session_w)
+            self.pending[session_r] = b''
+        return True
+
+
+def select_retry(rfds, timeout=None):
+    """Like select.select() on read fds but retry on EINTR."""
+    while True:
+        try:
+            return select.select(rfds, [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+
+def run_request(conn, request, session):
+    """Run ``request`` in a worker process, and send its output and exit
+    status over ``conn``. This runs in a handler process."""
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            conn.close()
+            os.close(out_r); os.close(err_r)
+            status = run_worker(request, session, out_w, err_w)
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+    os.close(out_w); os.close(err_w)
+    frames = { out_r: FRAME_STDOUT, err_r: FRAME_STDERR }
+    try:
+        while frames:
+            rfds, _, _ = select_retry(list(frames))
+            for fd in rfds:
+                data = os.read(fd, 65536)
+                if not data:
+                    os.close(fd)
+                    del frames[fd]
+                    continue
+                write_frame(conn, frames[fd], data)
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            status = 128 + os.WTERMSIG(status)
+        else:
+            status = os.WEXITSTATUS(status)
+        write_frame(conn, FRAME_EXIT, json.dumps(status).encode())
+    except socket.error:
+        # Client went away (e.g. CTRL-C). Take the worker down too.
+        try:
+            os.kill(pid, signal.SIGINT)
+        except OSError:
+            pass
+        return 1
+    return 0
+
+
+def run_worker(request, session, out_w, err_w):
+    """Run a command in a worker process. Return the exit status."""
+    from testmill import main
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(out_w, 1)
+    os.dup2(err_w, 2)
+    os.close(devnull); os.close(out_w); os.close(err_w)
+    # Write to the pipes, also if sys.stdout or sys.stderr were replaced.
+    sys.stdout = os.fdopen(1, 'w')
+    sys.stderr = os.fdopen(2, 'w')
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    os.environ.clear()
+    os.environ.update(request['environ'])
+    os.chdir(request['cwd'])
+    try:
+        with env.new():
+            env._daemon_worker = True
+            env._daemon_session = session
+            ret = main.main(request['argv'])
+    except SystemExit as e:
+        # Raised outside main()'s error handling, e.g. for --help and
+        # usage errors. Handle it like the interpreter would.
+        ret = e.code
+        if ret is not None and not isinstance(ret, int):
+            sys.stderr.write('{0}\n'.format(ret))
+            ret = 1
+    if ret is None:
+        ret = 0
+    return ret
+
+
+def start():
+    """Start the daemon in the background. Return its process ID."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setsid()
+            if os.fork() != 0:
+                os._exit(0)
+            logname = os.path.join(util.get_config_dir(), 'daemon.log')
+            logfd = os.open(logname, os.O_WRONLY|os.O_CREAT|os.O_APPEND,
+                            0o600)
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.dup2(logfd, 1)
+            os.dup2(logfd, 2)
+            os.close(devnull); os.close(logfd)
+            daemon = Daemon()
+            daemon.bind()
+            daemon.serve()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    # Wait until the daemon accepts connections.
+    end_time = time.time() + 30
+    while time.time() < end_time:
+        pid = ping()
+        if pid is not None:
+            return pid
+        time.sleep(0.1)
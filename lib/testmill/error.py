@@ -21,6 +21,7 @@ EX_USAGE = 64
 EX_DATAERR = 65
 EX_NOINPUT = 66
 EX_SOFTWARE = 70
+EX_NOPERM = 77
 EX_INTERRUPTED = 130
 
 
@@ -61,7 +61,7 @@ __all__ = ['new_application_name', 'get_application', 'get_applications',
            'create_application', 'start_application', 'stop_application',
            'remove_application', 'new_blueprint_name', 'get_blueprint',
            'get_blueprints', 'create_blueprint', 'remove_blueprint',
-           'lookup', 'reverse_lookup', 'hosts', 'only_on']
+           'lookup', 'reverse_lookup', 'hosts', 'only_on', 'api_stats']
 
 
 def _setup_testmill():
@@ -465,7 +465,7 @@ def reverse_lookup(host):
     # without poking under the hood of this API, there is no way of getting a
     # host string without going the application ending up in the case. So
     # therefore this should be fine.
-    for app in env._applications_byid.values():
+    for app in cache.get_cached_applications():
         for vm in app.get('vms', []):
             addr = vm.get('dynamicMetadata', {}).get('externalIp')
             if addr == host:
@@ -530,3 +530,19 @@ def only_on(*names):
             return func(*args, **kwargs)
         return invoke
     return wrapper
+
+
+@with_fabric
+def api_stats():
+    """api_stats()
+
+    Return statistics for the Ravello API requests that were made so far.
+
+    The result is a dictionary mapping endpoint names like ``"GET
+    /applications/{id}"`` to a dictionary with the number of ``calls``,
+    the number of ``errors`` by exception class, the number of
+    ``retries``, the ``bytes_in`` and ``bytes_out``, and the
+    ``decode_time``, ``total_time``, ``p50``, ``p95``, ``p99`` and ``max``
+    latencies in seconds.
+    """
+    return env.api.metrics.summary()
@@ -0,0 +1,410 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A TCP proxy that simulates a slow and unreliable network.
+
+:class:`FaultProxy` sits between a client, e.g.
+:class:`testmill.ravello.RavelloClient`, and a service, e.g. a
+:mod:`testmill.fakeapi` server. It relays the bytes unmodified, so it
+works for HTTP and HTTPS alike, but it can:
+
+* delay the data in each direction with a fixed or random latency,
+* cap the bandwidth in each direction,
+* reset connections, either at random or deterministically,
+* delay the first exchanges of every connection, like a slow TLS
+  handshake.
+
+Unlike :mod:`testmill.test.networkblocker`, it does not need root
+privileges. The conditions can be changed while the proxy is running::
+
+    proxy = FaultProxy(server.url, latency='normal:50ms,10ms')
+    proxy.start()
+    api = RavelloClient(service_url=proxy.url)
+    with proxy.conditions(reset_rate=0.5):
+        ...
+
+To run it from the command line::
+
+    $ python -m testmill.faultproxy --port 8081 --latency 100ms \\
+            http://localhost:8080/services
+"""
+
+from __future__ import absolute_import, print_function
+
+import re
+import sys
+import time
+import socket
+import struct
+import random
+import argparse
+import threading
+import contextlib
+
+from testmill import compat
+
+if sys.version_info[0] == 2:
+    import urlparse
+    import Queue as queue
+else:
+    from urllib import parse as urlparse
+    import queue
+
+
+__all__ = ('FaultProxy', 'parse_latency', 'parse_size')
+
+
+def _parse_time(s):
+    """Parse a time like "50ms" or "0.05" into seconds."""
+    s = s.strip()
+    if s.endswith('ms'):
+        return float(s[:-2]) / 1000
+    elif s.endswith('s'):
+        return float(s[:-1])
+    return float(s)
+
+
+def parse_latency(spec):
+    """Parse a latency distribution and return a function that returns a
+    random latency in seconds.
+
+    The ``spec`` is a number of seconds, or a string that is either a
+    fixed time ("50ms"), "uniform:<min>,<max>", "normal:<mean>,<stddev>" or
+    "exponential:<mean>". Negative samples are returned as zero.
+    """
+    if spec is None:
+        return lambda: 0.0
+    elif callable(spec):
+        return spec
+    elif isinstance(spec, (int, float)):
+        return lambda: float(spec)
+    name, _, params = spec.partition(':')
+    if not params:
+        value = _parse_time(name)
+        return lambda: value
+    params = [ _parse_time(param) for param in params.split(',') ]
+    if name == 'uniform' and len(params) == 2:
+        return lambda: random.uniform(*params)
+    elif name == 'normal' and len(params) == 2:
+        return lambda: max(0.0, random.normalvariate(*params))
+    elif name == 'exponential' and len(params) == 1:
+        return lambda: random.expovariate(1.0 / params[0])
+    raise ValueError('Illegal latency: {0!r}'.format(spec))
+
+
+def parse_size(spec):
+    """Parse a size like "64k" or "10m" into a number of bytes."""
+    if spec is None or isinstance(spec, (int, float)):
+        return spec
+    match = re.match('^([0-9.]+)([kmg]?)b?$', spec.strip().lower())
+    if not match:
+        raise ValueError('Illegal size: {0!r}'.format(spec))
+    factor = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}[match.group(2)]
+    return int(float(match.group(1)) * factor)
+
+
+def _reset(sock):
+    """Close ``sock`` with a TCP reset."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                        struct.pack('ii', 1, 0))
+        # A thread that is blocked in recv() keeps the socket open. Wake
+        # it up first. This does not send anything to the peer.
+        sock.shutdown(socket.SHUT_RD)
+    except socket.error:
+        pass
+    sock.close()
+
+
+class _Connection(object):
+    """A proxied connection. Every direction has a reader thread that
+    timestamps the data and a writer thread that forwards it when it is
+    due."""
+
+    bufsize = 65536
+
+    def __init__(self, proxy, client, upstream, reset_after):
+        self.proxy = proxy
+        self.client = client
+        self.upstream = upstream
+        self.reset_after = reset_after
+        self.down_bytes = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        for src, dst, down in ((self.client, self.upstream, False),
+                               (self.upstream, self.client, True)):
+            chunks = queue.Queue()
+            for target, args in ((self._read, (src, chunks, down)),
+                                 (self._write, (dst, chunks, down))):
+                thread = threading.Thread(target=target, args=args)
+                thread.daemon = True
+                thread.start()
+
+    def _read(self, sock, chunks, down):
+        proxy = self.proxy
+        rounds = 0
+        while True:
+            try:
+                data = sock.recv(self.bufsize)
+            except socket.error:
+                data = b''
+            if not data:
+                chunks.put(None)
+                break
+            delay = proxy.latency()
+            if down and rounds < proxy.handshake_rounds:
+                delay += proxy.handshake_delay
+                rounds += 1
+            chunks.put((time.time() + delay, data))
+
+    def _write(self, sock, chunks, down):
+        proxy = self.proxy
+        next_free = 0.0
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            deliver_at, data = chunk
+            if down and self.reset_after is not None:
+                if self.down_bytes + len(data) > self.reset_after:
+                    self.reset()
+                    break
+            # The data is sent when it has been transmitted completely at
+            # the configured bandwidth.
+            bandwidth = proxy.bandwidth
+            send_at = max(deliver_at, next_free)
+            throttled = 0.0
+            if bandwidth:
+                throttled = float(len(data)) / bandwidth
+                send_at += throttled
+                next_free = send_at
+            wait = send_at - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                sock.sendall(data)
+            except socket.error:
+                break
+            if down:
+                self.down_bytes += len(data)
+            proxy._add_bytes(down, len(data), throttled)
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        self._close_half()
+
+    def _close_half(self):
+        with self.lock:
+            if self.closed:
+                self.upstream.close()
+                self.client.close()
+            self.closed = True
+
+    def reset(self):
+        """Reset the connection to the client."""
+        self.proxy._add_reset()
+        _reset(self.client)
+        self.upstream.close()
+
+
+class FaultProxy(object):
+    """A TCP proxy that injects latency, bandwidth limits and connection
+    resets.
+
+    The ``upstream`` argument is either a ``(host, port)`` tuple or a URL.
+    The conditions are:
+
+    * ``latency``: the one-way delay in each direction, see
+      :func:`parse_latency`.
+    * ``bandwidth``: the maximum bytes per second in each direction, or
+      None. See :func:`parse_size`.
+    * ``reset_rate``: the probability that a connection is reset.
+    * ``reset_after``: a connection that is reset is reset after a random
+      number of bytes between 0 and ``reset_after`` was sent to the client.
+      If this is 0, the connection is reset as soon as it is accepted.
+    * ``handshake_delay``: an additional delay for the first
+      ``handshake_rounds`` replies on every connection.
+
+    The counters ``connections``, ``resets``, ``bytes_up`` and
+    ``bytes_down`` show what the proxy did. The counters ``throttled_up``
+    and ``throttled_down`` are the total time in seconds that data was held
+    back because of the bandwidth limit.
+    """
+
+    def __init__(self, upstream, port=0, latency=None, bandwidth=None,
+                 reset_rate=0.0, reset_after=0, handshake_delay=0.0,
+                 handshake_rounds=2):
+        self._url = None
+        if isinstance(upstream, compat.str):
+            self._url = urlparse.urlsplit(upstream)
+            default_port = 443 if self._url.scheme == 'https' else 80
+            upstream = (self._url.hostname, self._url.port or default_port)
+        self.upstream = upstream
+        self._lock = threading.Lock()
+        self._reset_next = 0
+        self.connections = 0
+        self.resets = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.throttled_up = 0.0
+        self.throttled_down = 0.0
+        self.set(latency=latency, bandwidth=bandwidth, reset_rate=reset_rate,
+                 reset_after=reset_after, handshake_delay=handshake_delay,
+                 handshake_rounds=handshake_rounds)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', port))
+        self._socket.listen(50)
+        self.address = self._socket.getsockname()
+        self._thread = None
+
+    @property
+    def url(self):
+        """The URL of the upstream service, through the proxy."""
+        if self._url is None:
+            return
+        netloc = '{0}:{1}'.format(*self.address)
+        return urlparse.urlunsplit(self._url._replace(netloc=netloc))
+
+    def set(self, **conditions):
+        """Change the conditions. See the class documentation."""
+        for name, value in conditions.items():
+            if name == 'latency':
+                self._latency_spec = value
+                value = parse_latency(value)
+            elif name == 'bandwidth':
+                value = parse_size(value)
+            elif name not in ('reset_rate', 'reset_after', 'handshake_delay',
+                              'handshake_rounds'):
+                raise TypeError('Unknown condition: {0}'.format(name))
+            setattr(self, name, value)
+
+    @contextlib.contextmanager
+    def conditions(self, **conditions):
+        """Context manager that changes the conditions temporarily."""
+        saved = dict((name, getattr(self, name)) for name in conditions)
+        if 'latency' in saved:
+            saved['latency'] = self._latency_spec
+        self.set(**conditions)
+        try:
+            yield self
+        finally:
+            self.set(**saved)
+
+    def reset_next(self, count=1):
+        """Reset the next ``count`` connections."""
+        with self._lock:
+            self._reset_next += count
+
+    def _add_bytes(self, down, nbytes, throttled=0.0):
+        with self._lock:
+            if down:
+                self.bytes_down += nbytes
+                self.throttled_down += throttled
+            else:
+                self.bytes_up += nbytes
+                self.throttled_up += throttled
+
+    def _add_reset(self):
+        with self._lock:
+            self.resets += 1
+
+    def _should_reset(self):
+        with self._lock:
+            self.connections += 1
+            if self._reset_next > 0:
+                self._reset_next -= 1
+                return True
+        return random.random() < self.reset_rate
+
+    def _accept(self, client):
+        if self._should_reset():
+            if not self.reset_after:
+                self._add_reset()
+                _reset(client)
+                return
+            reset_after = random.randint(0, self.reset_after)
+        else:
+            reset_after = None
+        try:
+            upstream = socket.create_connection(self.upstream)
+        except socket.error:
+            _reset(client)
+            return
+        for sock in (client, upstream):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _Connection(self, client, upstream, reset_after).start()
+
+    def serve_forever(self):
+        """Accept and proxy connections until :meth:`close` is called."""
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except socket.error:
+                break
+            self._accept(client)
+
+    def start(self):
+        """Start the proxy in a background thread and return it."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop accepting connections."""
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._socket.close()
+        if self._thread:
+            self._thread.join()
+
+
+def main(argv=None):
+    """Run a fault injection proxy."""
+    parser = argparse.ArgumentParser(description='Run a TCP proxy that '
+                                     'simulates a slow and unreliable '
+                                     'network.')
+    parser.add_argument('upstream', help='URL or host:port to proxy to')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency')
+    parser.add_argument('--bandwidth')
+    parser.add_argument('--reset-rate', type=float, default=0.0)
+    parser.add_argument('--reset-after', type=parse_size, default=0)
+    parser.add_argument('--handshake-delay', type=_parse_time, default=0.0)
+    args = parser.parse_args(argv)
+    upstream = args.upstream
+    if '://' not in upstream:
+        host, _, port = upstream.rpartition(':')
+        upstream = (host, int(port))
+    proxy = FaultProxy(upstream, args.port, args.latency, args.bandwidth,
+                       args.reset_rate, args.reset_after,
+                       args.handshake_delay)
+    where = proxy.url or '{0}:{1}'.format(*proxy.address)
+    sys.stdout.write('Proxying at {0}\n'.format(where))
+    sys.stdout.flush()
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
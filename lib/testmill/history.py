@@ -0,0 +1,212 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import time
+import collections
+from xml.etree import ElementTree
+
+from testmill import util
+
+
+# The history contains one record for every "ravtest run". The records are
+# appended to a file in the configuration directory with one JSON document
+# per line. Appending a single line is safe with concurrent runs, and the
+# file can be processed with standard line oriented tools.
+#
+# A record looks like this:
+#
+#   { "test_id": "...", "project": "...", "application": "...",
+#     "instance": "...", "start": 1379000000.0, "end": 1379000100.0,
+#     "duration": 100.0, "status": "passed", "errors": 0,
+#     "failed_phase": null,
+#     "phases": {"create": 1.0, "wait": 60.0, "tasks": 39.0,
+#                "deploy": 2.0, "sysinit": 20.0, ...},
+#     "vms": {"vm1": {"tasks": [{"name": "deploy", "start": ...,
+#                                "end": ..., "duration": 2.0,
+#                                "exit_code": 0, "output_bytes": 100,
+#                                "output_lines": 2}, ...]}} }
+#
+# The status is "passed", "failed" if a task failed, or "error" if the run
+# was aborted by an error. In that case "failed_phase" is the run phase in
+# which the error happened.
+#
+# The "create", "wait" and "tasks" phases are measured by "ravtest run".
+# The other phases are named after a task, and their duration is that of
+# the slowest VM for that task.
+
+run_phases = ('create', 'wait', 'tasks')
+
+
+def history_file():
+    """Return the name of the history file."""
+    return os.path.join(util.get_config_dir(), 'history.jsonl')
+
+
+def task_result(task, start, end):
+    """Return the result of the task ``task`` that ran from ``start`` until
+    ``end`` as a dictionary."""
+    if task.output is not None:
+        nbytes = task.output.total_bytes
+        nlines = task.output.total_lines
+    else:
+        nbytes = len(task.stdout)
+        nlines = task.stdout.count('\n')
+    return {'name': task.name, 'start': start, 'end': end,
+            'duration': end - start, 'exit_code': task.return_code,
+            'output_bytes': nbytes, 'output_lines': nlines}
+
+
+def create_record(test_id, app, appdef, project, start, end, phases,
+                  results, errors, failed_phase=None):
+    """Create a new history record.
+
+    The ``phases`` argument is a dictionary with the durations of the run
+    phases. The ``results`` argument is a dictionary mapping VM names to a
+    list with the results for the tasks that were run on that VM. If the
+    run was aborted by an error, ``failed_phase`` is the phase in which
+    that happened, and ``app`` may be None.
+    """
+    phases = dict(phases)
+    vms = {}
+    for vmname,tasks in results.items():
+        vms[vmname] = {'tasks': list(tasks)}
+        for task in tasks:
+            duration = phases.get(task['name'], 0)
+            phases[task['name']] = max(duration, task['duration'])
+    if failed_phase:
+        status = 'error'
+    else:
+        status = 'failed' if errors else 'passed'
+    record = {'test_id': test_id, 'project': project,
+              'application': appdef['name'],
+              'instance': app['name'] if app else None,
+              'start': start, 'end': end, 'duration': end - start,
+              'status': status, 'errors': errors or 0,
+              'failed_phase': failed_phase, 'phases': phases, 'vms': vms}
+    return record
+
+
+def save_record(record):
+    """Append ``record`` to the history."""
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with open(history_file(), 'a') as fout:
+        fout.write(line)
+
+
+def iter_records():
+    """Iterate over the records in the history, oldest first."""
+    try:
+        fin = open(history_file())
+    except IOError:
+        return
+    with fin:
+        for line in fin:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # partially written line
+            if isinstance(record, dict) and 'test_id' in record:
+                yield record
+
+
+def get_records(count=None):
+    """Return the last ``count`` records in the history, oldest first."""
+    records = collections.deque(iter_records(), maxlen=count)
+    return list(records)
+
+
+def find_record(test_id):
+    """Return the most recent record with a test ID starting with
+    ``test_id``, or None if there is no such record."""
+    found = None
+    for record in iter_records():
+        if record['test_id'].startswith(test_id):
+            found = record
+    return found
+
+
+def get_phases(record):
+    """Return the phases in ``record`` as a list of ``(name, duration)``
+    tuples, in the order in which they were run."""
+    order = list(run_phases)
+    for vm in record['vms'].values():
+        for task in vm['tasks']:
+            if task['name'] not in order:
+                order.append(task['name'])
+    phases = record['phases']
+    return [ (name, phases[name]) for name in order if name in phases ]
+
+
+def format_duration(secs):
+    """Format a duration in seconds."""
+    if secs < 60:
+        return '{0:.1f}s'.format(secs)
+    secs = int(secs)
+    if secs < 3600:
+        return '{0}m{1:02d}s'.format(secs//60, secs%60)
+    return '{0}h{1:02d}m'.format(secs//3600, secs%3600//60)
+
+
+def to_json(record):
+    """Export ``record`` as a JSON document."""
+    return json.dumps(record, indent=2, sort_keys=True)
+
+
+def to_junit(record):
+    """Export ``record`` as a JUnit XML document.
+
+    Every VM becomes a test suite, and every task a test case.
+    """
+    root = ElementTree.Element('testsuites')
+    root.set('name', '{0}/{1}'.format(record['project'],
+                                      record['application']))
+    root.set('time', '{0:.3f}'.format(record['duration']))
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S',
+                              time.localtime(record['start']))
+    ntests = nfailures = 0
+    for vmname in sorted(record['vms']):
+        tasks = record['vms'][vmname]['tasks']
+        failures = [ task for task in tasks if task['exit_code'] != 0 ]
+        suite = ElementTree.SubElement(root, 'testsuite')
+        suite.set('name', vmname)
+        suite.set('id', record['test_id'])
+        suite.set('timestamp', timestamp)
+        suite.set('tests', str(len(tasks)))
+        suite.set('failures', str(len(failures)))
+        suite.set('errors', '0')
+        duration = sum((task['duration'] for task in tasks))
+        suite.set('time', '{0:.3f}'.format(duration))
+        for task in tasks:
+            case = ElementTree.SubElement(suite, 'testcase')
+            case.set('classname', '{0}.{1}'.format(record['application'],
+                                                   vmname))
+            case.set('name', task['name'])
+            case.set('time', '{0:.3f}'.format(task['duration']))
+            if task['exit_code'] != 0:
+                failure = ElementTree.SubElement(case, 'failure')
+                if task['exit_code'] is None:
+                    message = 'Task did not complete.'
+                else:
+                    message = 'Task exited with status {0}.' \
+                                    .format(task['exit_code'])
+                failure.set('message', message)
+        ntests += len(tasks)
+        nfailures += len(failures)
+    root.set('tests', str(ntests))
+    root.set('failures', str(nfailures))
+    return ElementTree.tostring(root, encoding='utf-8')
@@ -19,7 +19,7 @@ import stat
 import socket
 import subprocess
 
-from testmill import util, console, error, util
+from testmill import util, console, error, login
 from testmill.state import env
 
 
@@ -45,11 +45,20 @@ def load_keypair():
     with file(pubname) as fin:
         pubkey = fin.read()
     keyparts = pubkey.strip().split()
+    # Try the public key from the session metadata first. This saves us
+    # from having to list all public keys.
+    session = login.load_session()
+    pubkey = session.get('pubkey') if session else None
+    if pubkey and pubkey['name'] == keyparts[2]:
+        env.public_key = pubkey
+        env.private_key_file = privname
+        return pubkey
     pubkeys = env.api.get_pubkeys()
     for pubkey in pubkeys:
         if pubkey['name'] == keyparts[2]:
             env.public_key = pubkey
             env.private_key_file = privname
+            login.update_session(pubkey=pubkey)
             return pubkey
 
 
@@ -98,11 +107,34 @@ def create_keypair():
         fout.write(keydata)
     env.public_key = pubkey
     env.private_key_file = privname
+    login.update_session(pubkey=pubkey)
     return pubkey
 
 
+def check_keypair():
+    """Check that the public key still exists in Ravello.
+
+    The public key is cached in the session metadata, so it is normally
+    not looked up. If it does not exist anymore, it is removed from the
+    cache so that it is looked up or created again next time. Return
+    whether it exists.
+    """
+    pubkey = getattr(env, 'public_key', None)
+    if not pubkey:
+        return False
+    for key in env.api.get_pubkeys():
+        if key.get('id') == pubkey.get('id') and \
+                key.get('name') == pubkey.get('name'):
+            return True
+    login.update_session(pubkey=None)
+    return False
+
+
 def default_keypair():
     """Check if we have a keypair. If not, create it."""
+    pubkey = getattr(env, 'public_key', None)
+    if pubkey:
+        return pubkey
     pubkey = load_keypair()
     if not pubkey:
         pubkey = create_keypair()
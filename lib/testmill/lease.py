@@ -0,0 +1,136 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import errno
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from testmill import console, util
+from testmill.state import env
+
+
+# Leases prevent concurrent "ravtest run" invocations from using the same
+# application instance. A lease is an exclusive flock() on a file in the
+# "leases" directory under the configuration directory. The lock is held
+# for the lifetime of the process, and is released automatically by the
+# operating system when the process exits, even when it crashes. So there
+# are no stale leases to clean up.
+#
+# The lease file contains the process id of the holder. This is used by
+# is_leased() to check for a lease without taking the lock.
+#
+# Leases are local to a single host, which covers a CI server running
+# multiple jobs in parallel. On platforms without flock(), leases always
+# succeed.
+
+
+def lease_dir():
+    """Return the directory containing the lease files."""
+    dirname = os.path.join(util.get_config_dir(), 'leases')
+    try:
+        os.mkdir(dirname, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return dirname
+
+
+def _get_leases():
+    """Return a dictionary mapping the ids of the applications that we
+    lease to their file descriptors."""
+    if not hasattr(env, '_leases'):
+        env._leases = {}
+    return env._leases
+
+
+def _lock(app):
+    """Try to lock the lease file for ``app``. Return the file descriptor
+    if the lock was obtained, or None otherwise."""
+    fname = os.path.join(lease_dir(), '{0}.lease'.format(app['id']))
+    fd = os.open(fname, os.O_RDWR|os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+    except IOError as e:
+        os.close(fd)
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return
+    return fd
+
+
+def acquire(app):
+    """Try to lease the application ``app``. Return True if the lease was
+    obtained or if we hold it already, False if another process holds it."""
+    if fcntl is None:
+        return True
+    leases = _get_leases()
+    if app['id'] in leases:
+        return True
+    fd = _lock(app)
+    if fd is None:
+        console.debug('Application `{0}` is leased by another process.',
+                      app['name'])
+        return False
+    os.ftruncate(fd, 0)
+    os.write(fd, '{0}\n'.format(os.getpid()).encode('ascii'))
+    leases[app['id']] = fd
+    return True
+
+
+def release(app):
+    """Release the lease on ``app``, if we hold it."""
+    fd = _get_leases().pop(app['id'], None)
+    if fd is not None:
+        os.ftruncate(fd, 0)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def is_leased(app):
+    """Return whether ``app`` is leased by another process.
+
+    This does not take the lock, so that it cannot make a concurrent
+    :func:`acquire` fail. Instead, the process id in the lease file is
+    checked. The answer is only a hint: :func:`acquire` has the final say.
+    """
+    if fcntl is None or app['id'] in _get_leases():
+        return False
+    fname = os.path.join(lease_dir(), '{0}.lease'.format(app['id']))
+    try:
+        with open(fname) as fin:
+            pid = int(fin.read().strip() or '0')
+    except (IOError, OSError, ValueError):
+        return False
+    if pid in (0, os.getpid()):
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def close_inherited():
+    """Close the lease file descriptors in a child process, without
+    releasing the leases held by the parent."""
+    leases = _get_leases()
+    for fd in leases.values():
+        os.close(fd)
+    leases.clear()
@@ -15,17 +15,96 @@
 from __future__ import absolute_import
 
 import os
+import json
+import time
+import hashlib
+
 from testmill import console, error, util, ravello
 from testmill.state import env
 
 
+# Session metadata is stored next to the token. It allows us to skip the
+# token validation and the project and public key lookups on every start up.
+# The metadata is only trusted for ``session_lifetime`` seconds. Before that,
+# an expired token is detected when an API call fails with a 401. The cached
+# public key is checked again when logging in to a VM fails (see
+# keypair.check_keypair()).
+
+session_lifetime = 12 * 3600
+
+
+def _session_id(username=None, token=None):
+    """Return an identifier for the API credentials ``username`` or
+    ``token``. By default the credentials of the current API client are
+    used."""
+    if username is None and token is None:
+        username, token = env.api.username, env.api.token
+    if username:
+        ident = 'user:{0}'.format(username)
+    else:
+        ident = 'token:{0}'.format(hashlib.sha1(token or '').hexdigest())
+    return '{0} {1}'.format(env.api.url, ident)
+
+
+def load_session(username=None, token=None):
+    """Load the session metadata for the current API credentials, or for
+    the credentials ``username`` or ``token`` if provided.
+
+    Return a dictionary, or None if there is no valid metadata.
+    """
+    cfgdir = util.get_config_dir()
+    fname = os.path.join(cfgdir, 'api-session')
+    try:
+        with file(fname) as fin:
+            session = json.load(fin)
+    except (IOError, ValueError):
+        return
+    if session.get('id') != _session_id(username, token):
+        return
+    if session.get('expires', 0) < time.time():
+        return
+    return session
+
+
+def update_session(username=None, token=None, **kwargs):
+    """Update the session metadata for the current API credentials, or for
+    the credentials ``username`` or ``token`` if provided."""
+    session = load_session(username, token)
+    if session is None:
+        session = { 'id': _session_id(username, token),
+                    'expires': time.time() + session_lifetime }
+    session.update(kwargs)
+    cfgdir = util.get_config_dir()
+    fname = os.path.join(cfgdir, 'api-session')
+    tmpname = '{0}.{1}-tmp'.format(fname, os.getpid())
+    with file(tmpname, 'w') as fout:
+        json.dump(session, fout)
+    if hasattr(os, 'chmod'):
+        os.chmod(tmpname, 0o600)
+    os.rename(tmpname, fname)
+
+
+def remove_session():
+    """Remove the session metadata."""
+    cfgdir = util.get_config_dir()
+    fname = os.path.join(cfgdir, 'api-session')
+    try:
+        os.unlink(fname)
+    except OSError:
+        pass
+
+
 def password_login():
     """Try to log in with a username and password."""
+    session = load_session(username=env.username)
+    project = session.get('project') if session else None
     try:
-        env.api.login(env.username, env.password)
+        env.api.login(env.username, env.password, project=project)
     except ravello.RavelloError as e:
         error.raise_error('Could not login to Ravello ({!s})\n'
                           'Check your username and password.', e)
+    if project is None:
+        update_session(project=env.api._project)
 
 
 def token_login():
@@ -38,11 +117,18 @@ def token_login():
     except IOError:
         error.raise_error('Not logged in')
     token = token.strip()
+    # If we validated the token before, do not validate it again. Expiry is
+    # detected when it is first used (see main.main()).
+    session = load_session(token=token)
+    project = session.get('project') if session else None
     try:
-        env.api.login(token=token)
+        env.api.login(token=token, project=project, validate=project is None)
     except ravello.RavelloError as e:
+        remove_session()
         error.raise_error('Token has expired.\n'
                           "Use 'ravtest login' to refresh.")
+    if project is None:
+        update_session(project=env.api._project)
 
 
 def store_token():
@@ -54,10 +140,15 @@ def store_token():
         ftok.write('\n')
     if hasattr(os, 'chmod'):
         os.chmod(tokname, 0o600)
+    # The session metadata is keyed on the token, so the old metadata is
+    # invalid now. Keep the project as we already know it.
+    remove_session()
+    update_session(token=env.api._cookie, project=env.api._project)
 
 
 def remove_token():
     """Remove the login token."""
+    remove_session()
     cfgdir = util.get_config_dir()
     tokname = os.path.join(cfgdir, 'api-token')
     try:
@@ -70,6 +161,8 @@ def remove_token():
 def default_login():
     """Login function. Used by most sub-commands to ensure there is a valid
     connection to the Ravello API."""
+    if env.api._cookie is not None:
+        return  # already logged in, e.g. a warm session from the daemon
     if env.username and env.password:
         password_login()
     else:
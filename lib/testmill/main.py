@@ -19,13 +19,15 @@ import logging
 import textwrap
 import traceback
 
-from testmill import argparse, console, ravello, error, _version
+from testmill import (argparse, console, ravello, error, login, daemon,
+                      tracing, _version)
 from testmill.state import env
 
 
 usage = textwrap.dedent("""\
     Usage: ravtest [-u <user>] [-p <password>] [-s <service_url>] [-q] [-v]
-                   [-d] [-y] [-m <manifest>] <command> [OPTION]...
+                   [-d] [-y] [-m <manifest>] [--trace <file>] [--stats]
+                   <command> [OPTION]...
            ravtest --help [<command>]
            ravtest --version
 """)
@@ -50,6 +52,11 @@ description = textwrap.dedent("""\
             Do not ask for confirmation
         -m, --manifest
             Use a different manifest
+        --trace <file>
+            Write a trace of API requests, wait loops and remote commands
+            to <file>, in the Chrome trace event format
+        --stats
+            Show statistics for the API requests that were made
         -h, --help
             Show help and exit
         -V, --version
@@ -65,28 +72,45 @@ description = textwrap.dedent("""\
         restore     restore an appliation from a blueprint
         clean       clean up applications or blueprints
         lint        check a project manifest
+        pool        manage the warm pool for an application
+        history     show the history of runs
+        daemon      start or stop the ravtest daemon
 
     Use 'ravtest <command> --help' to get help for a command.
     """)
 
 
-from testmill import (command_login, command_ps, command_lint,
-                      command_logout, command_run, command_ssh,
-                      command_save, command_restore, command_clean)
+# The sub-commands are loaded lazily. Most of them pull in heavy modules
+# like Fabric, paramiko and yaml, and we do not want to pay for that on
+# every invocation, e.g. for "ravtest --version".
 
 subcommands = {
-    'login': (command_login.do_login, command_login.add_args),
-    'logout': (command_logout.do_logout, command_logout.add_args),
-    'ps': (command_ps.do_ps, command_ps.add_args),
-    'run': (command_run.do_run, command_run.add_args),
-    'ssh': (command_ssh.do_ssh, command_ssh.add_args),
-    'lint': (command_lint.do_lint, command_lint.add_args),
-    'save': (command_save.do_save, command_save.add_args),
-    'restore': (command_restore.do_restore, command_restore.add_args),
-    'clean': (command_clean.do_clean, command_clean.add_args)
+    'login': ('testmill.command_login', 'do_login'),
+    'logout': ('testmill.command_logout', 'do_logout'),
+    'ps': ('testmill.command_ps', 'do_ps'),
+    'run': ('testmill.command_run', 'do_run'),
+    'ssh': ('testmill.command_ssh', 'do_ssh'),
+    'lint': ('testmill.command_lint', 'do_lint'),
+    'save': ('testmill.command_save', 'do_save'),
+    'restore': ('testmill.command_restore', 'do_restore'),
+    'clean': ('testmill.command_clean', 'do_clean'),
+    'pool': ('testmill.command_pool', 'do_pool'),
+    'history': ('testmill.command_history', 'do_history'),
+    'daemon': ('testmill.command_daemon', 'do_daemon')
 }
 
 
+def load_subcommand(name):
+    """Load the sub-command ``name``.
+
+    The return value is a ``(command, add_args)`` tuple.
+    """
+    modname, funcname = subcommands[name]
+    __import__(modname)
+    module = sys.modules[modname]
+    return getattr(module, funcname), module.add_args
+
+
 def create_parser():
     """Create command-line parser."""
     if sys.platform.startswith('win'):
@@ -101,6 +125,8 @@ def create_parser():
     parser.add_argument('-d', '--debug', action='store_true')
     parser.add_argument('-y', '--yes', action='store_true')
     parser.add_argument('-m', '--manifest')
+    parser.add_argument('--trace')
+    parser.add_argument('--stats', action='store_true')
     parser.add_argument('-h', '--help', action='store_true')
     parser.add_argument('-V', '--version', action='store_true')
     parser.add_argument('subcmd')
@@ -135,7 +161,7 @@ def parse_args(parser, argv=None):
     if subcmd not in subcommands:
         console.error("Unknown command: '{0}'.", subcmd)
         error.exit(error.EX_USAGE)
-    add_args = subcommands[subcmd][1]
+    _, add_args = load_subcommand(subcmd)
     add_args(parser)
     try:
         args = parser.parse_args(argv)
@@ -163,6 +189,7 @@ def create_environment(args):
     env.always_confirm = args.yes
     env.args = args
     env.api = ravello.RavelloClient(env.username, env.password, env.service_url)
+    daemon.restore_session()
 
 
 def setup_logging():
@@ -179,19 +206,69 @@ def setup_logging():
     logger._testmill_configured = True
 
 
+def show_stats(metrics):
+    """Show the API request metrics in ``metrics``."""
+    summary = metrics.summary()
+    if not summary:
+        console.writeln_err('No API requests were made.')
+        return
+    line = '{0:40} {1:>5} {2:>4} {3:>5} {4:>7} {5:>7} {6:>7} {7:>7} ' \
+           '{8:>9} {9:>9} {10:>7}'
+    console.writeln_err(line.format('ENDPOINT', 'CALLS', 'ERR', 'RETRY',
+                                    'TOTAL', 'P50', 'P95', 'P99', 'IN',
+                                    'OUT', 'DECODE'))
+    ms = lambda secs: '{0:.0f}ms'.format(secs * 1000)
+    totals = [0, 0, 0, 0.0, 0, 0, 0.0]
+    for endpoint in sorted(summary, key=lambda ep: -summary[ep]['total_time']):
+        stats = summary[endpoint]
+        errors = sum(stats['errors'].values())
+        console.writeln_err(line.format(endpoint[:40], stats['calls'], errors,
+                stats['retries'], '{0:.2f}s'.format(stats['total_time']),
+                ms(stats['p50']), ms(stats['p95']), ms(stats['p99']),
+                stats['bytes_in'], stats['bytes_out'],
+                ms(stats['decode_time'])))
+        values = (stats['calls'], errors, stats['retries'],
+                  stats['total_time'], stats['bytes_in'], stats['bytes_out'],
+                  stats['decode_time'])
+        totals = [ x+y for x,y in zip(totals, values) ]
+    console.writeln_err(line.format('Total', totals[0], totals[1], totals[2],
+                        '{0:.2f}s'.format(totals[3]), '', '', '', totals[4],
+                        totals[5], ms(totals[6])))
+    errors = {}
+    for stats in summary.values():
+        for name,count in stats['errors'].items():
+            errors[name] = errors.get(name, 0) + count
+    if errors:
+        errors = ', '.join('{0}: {1}'.format(name, errors[name])
+                           for name in sorted(errors))
+        console.writeln_err('Errors by class: {0}'.format(errors))
+
+
 def main(argv=None):
     """The "ravtest" main entry point."""
     if sys.platform.startswith('win'):
         console.error('Windows is not currently supported by "ravtest".\n'
                       'Please use the Fabric front-end.')
         error.exit(1)
+    if argv is None:
+        argv = sys.argv[1:]
+    ret = daemon.forward(argv)
+    if ret is not None:
+        return ret
     parser = create_parser()
     args = parse_args(parser, argv)
     create_environment(args)
     setup_logging()
-    command = subcommands[args.subcmd][0]
+    command, _ = load_subcommand(args.subcmd)
     try:
-        ret = command(args, env)
+        if args.trace:
+            try:
+                tracing.enable(args.trace)
+            except EnvironmentError as e:
+                error.raise_error('Could not open trace file `{0}`: {1!s}',
+                                  args.trace, e.strerror or e)
+        with tracing.span('ravtest {0}'.format(args.subcmd)):
+            ret = command(args, env)
     except KeyboardInterrupt:
         console.complete_partial_line()
         console.writeln('Exiting at user request.')
@@ -204,6 +281,15 @@ def main(argv=None):
             console.writeln_err('Raised from:')
             console.writeln_err(''.join(lines))
         ret = e[0]
+    except ravello.AuthenticationError as e:
+        # The session metadata lets us skip validating the token at login
+        # time. So an expired token is detected here.
+        console.complete_partial_line()
+        console.error('Not authorized ({0!s}).\n'
+                      "Your token may have expired. Use 'ravtest login' "
+                      'to refresh.', e)
+        login.remove_session()
+        ret = error.EX_NOPERM
     except Exception as e:
         console.complete_partial_line()
         console.error(str(e))
@@ -214,6 +300,12 @@ def main(argv=None):
             console.writeln_err(''.join(lines))
             console.writeln_err('Environment: {!r}'.format(env))
         ret = getattr(e, 'exitstatus', error.EX_SOFTWARE)
+    finally:
+        if tracing.enabled():
+            count = tracing.finish()
+            console.info('Wrote {0} spans to `{1}`.', count, args.trace)
+        if args.stats:
+            show_stats(env.api.metrics)
     return ret
 
 
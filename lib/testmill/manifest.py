@@ -61,6 +61,25 @@ def manifest_exists(filename=None):
     return os.access(filename, os.R_OK)
 
 
+_parsed_files = {}
+
+def parse_yaml_file(filename):
+    """Parse the YAML file ``filename`` and return the parsed document.
+
+    Parsed files are cached and are only re-parsed when they change. A copy
+    is returned, so the caller may modify it.
+    """
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    key = (st.st_mtime, st.st_size)
+    cached = _parsed_files.get(filename)
+    if cached is None or cached[0] != key:
+        with file(filename) as fin:
+            parsed = yaml.load(fin)
+        cached = _parsed_files[filename] = (key, parsed)
+    return copy.deepcopy(cached[1])
+
+
 def load_manifest(filename=None):
     """Load the project manifest, merge in the default manifest,
     and return the result."""
@@ -68,24 +87,22 @@ def load_manifest(filename=None):
         filename = manifest_name()
     if not manifest_exists(filename):
         error.raise_error('Project manifest ({0}) not found.', filename)
-    with file(filename) as fin:
-        try:
-            manifest = yaml.load(fin)
-        except yaml.error.YAMLError as e:
-            if env.verbose:
-                error.raise_error('Illegal YAML in manifest.\n'
-                                  'Message from parser: {!s}', e)
-            else:
-                error.raise_error('Illegal YAML in manifest.\n'
-                                  'Try --verbose for more information.')
+    try:
+        manifest = parse_yaml_file(filename)
+    except yaml.error.YAMLError as e:
+        if env.verbose:
+            error.raise_error('Illegal YAML in manifest.\n'
+                              'Message from parser: {!s}', e)
+        else:
+            error.raise_error('Illegal YAML in manifest.\n'
+                              'Try --verbose for more information.')
     manifest['_filename'] = filename
     directory, _ = os.path.split(os.path.abspath(filename))
     _, project = os.path.split(directory)
     manifest['_directory'] = directory
     packagedir = testmill.packagedir()
     filename = os.path.join(packagedir, 'defaults.yml')
-    with file(filename) as fin:
-        defaults = yaml.load(fin)
+    defaults = parse_yaml_file(filename)
     merge(defaults, manifest)
     env.manifest = manifest
     return manifest
@@ -243,6 +260,7 @@ def check_manifest(manifest):
     check('/applications/*', compat.str + (dict,))
     check('/applications/*/!name', compat.str)
     check('/applications/*/blueprint', compat.str)
+    check('/applications/*/pool', int)
     check('/applications/*/vms', list)
     check('/applications/*/vms/*', compat.str + (dict,))
     check('/applications/*/vms/*/!name', compat.str)
@@ -0,0 +1,158 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import re
+import sys
+import errno
+import collections
+
+from testmill import console
+
+
+# The number of output lines that are kept in memory for every task.
+default_tail = 1000
+
+# Partial lines longer than this are written out as a complete line.
+max_line_length = 65536
+
+# Line breaks in task output. A carriage return on its own, as used by
+# progress bars, is a line break as well.
+_line_break = re.compile(r'\r\n|\r|\n')
+
+# ANSI colors that are used for the VM name prefixes, in this order.
+prefix_colors = ('32', '36', '35', '33', '34', '31')
+
+
+def use_color():
+    """Return whether the console supports colors."""
+    if sys.platform.startswith('win'):
+        return False
+    isatty = getattr(sys.stdout, 'isatty', None)
+    return bool(isatty and isatty())
+
+
+def format_prefix(vmname, index=0, width=None, color=None):
+    """Return the prefix for output lines of the VM ``vmname``. The VM with
+    index ``index`` gets the index'th color."""
+    if color is None:
+        color = use_color()
+    prefix = vmname.ljust(width or len(vmname)) + ' | '
+    if color:
+        code = prefix_colors[index % len(prefix_colors)]
+        prefix = '\033[{0}m{1}\033[0m'.format(code, prefix)
+    return prefix
+
+
+def log_file_name(logdir, test_id, vmname, taskname):
+    """Return the name of the log file for a task, and create the directory
+    it is in."""
+    dirname = os.path.join(logdir, test_id, vmname)
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return os.path.join(dirname, '{0}.log'.format(taskname))
+
+
+class TaskOutput(object):
+    """A file-like object that receives the output of a task while it is
+    running.
+
+    The output is split into lines at newlines or carriage returns. A
+    partial line longer than ``max_line_length`` is treated as complete.
+    Every complete line is written to the console behind ``prefix`` if
+    ``echo`` is set, and to ``logfile`` if it is provided. Only the last
+    ``tail`` lines are kept in memory.
+
+    The ``lock`` is held while writing to the console, so that lines from
+    concurrent tasks are not mixed up.
+    """
+
+    def __init__(self, prefix='', echo=False, logfile=None, tail=None,
+                 lock=None):
+        self.prefix = prefix
+        self.echo = echo
+        self.logfile = logfile
+        self.lines = collections.deque(maxlen=tail or default_tail)
+        self.lock = lock
+        self.partial = ''
+        self.total_lines = 0
+        self.total_bytes = 0
+        self._log = file(logfile, 'a') if logfile else None
+
+    def write(self, data):
+        """Add ``data`` to the output."""
+        self.total_bytes += len(data)
+        data = self.partial + data
+        # A "\r" at the end may be followed by a "\n" in the next write.
+        held = '\r' if data.endswith('\r') else ''
+        lines = _line_break.split(data[:len(data)-len(held)])
+        self.partial = lines.pop() + held
+        if len(self.partial) > max_line_length:
+            lines.append(self.partial)
+            self.partial = ''
+        if lines:
+            self._add_lines(lines)
+
+    def flush(self):
+        """Flush the log file. Partial lines are held back until they are
+        completed, or until the output is closed."""
+        if self._log:
+            self._log.flush()
+
+    def close(self):
+        """Finish the output."""
+        if self.partial:
+            self._add_lines([self.partial])
+            self.partial = ''
+        if self._log:
+            self._log.close()
+            self._log = None
+
+    def _add_lines(self, lines):
+        lines = [ line.rstrip('\r') for line in lines ]
+        self.total_lines += len(lines)
+        self.lines.extend(lines)
+        if self._log:
+            self._log.write('\n'.join(lines) + '\n')
+        if not self.echo:
+            return
+        text = ''.join([ '{0}{1}\n'.format(self.prefix, line)
+                         for line in lines ])
+        if self.lock:
+            self.lock.acquire()
+        try:
+            console.complete_partial_line()
+            console.write(text)
+            console.flush()
+        finally:
+            if self.lock:
+                self.lock.release()
+
+    @property
+    def omitted_lines(self):
+        """The number of lines that are not in the tail anymore."""
+        return self.total_lines - len(self.lines)
+
+    def getvalue(self):
+        """Return the last lines of the output."""
+        text = '\n'.join(self.lines)
+        partial = self.partial.rstrip('\r')
+        if partial:
+            text += '\n' + partial if text else partial
+        return text
@@ -0,0 +1,91 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+
+from testmill import application, console, lease, tracing, util
+from testmill.state import env
+
+
+# A warm pool is a number of published application instances for an
+# application definition that are kept ready to be re-used by "ravtest
+# run". The pool size is set with the "pool" key of an application in the
+# manifest, or on the "ravtest pool fill" command line.
+
+
+def get_pool(appdef, exclude=()):
+    """Return the instances in the pool for ``appdef``, best candidates
+    first. Instances that are leased by another process, or that have an
+    id in ``exclude``, are skipped."""
+    return [ app for app in application.find_reusable_applications(appdef)
+             if app['id'] not in exclude and not lease.is_leased(app) ]
+
+
+def fill_pool(appdef, size, exclude=()):
+    """Create and publish new instances of ``appdef`` until the pool
+    contains ``size`` instances, not counting the instances with an id in
+    ``exclude``. Return a list of the new instances."""
+    count = len(get_pool(appdef, exclude))
+    created = []
+    for i in range(count, size):
+        app = application.create_new_application(appdef)
+        app = application.publish_application(app)
+        console.info('Created new application `{0}`.', app['name'])
+        created.append(app)
+    return created
+
+
+def refill_in_background(appdef, size, exclude=()):
+    """Fill the pool for ``appdef`` up to ``size`` instances in a
+    background process. See :func:`fill_pool`.
+
+    The background process inherits our API session. Its output goes to
+    "pool.log" in the configuration directory. Return True if the
+    background process was started, or False if this is not supported on
+    this platform.
+    """
+    if not hasattr(os, 'fork'):
+        console.debug('Background pool refills are not supported.')
+        return False
+    sys.stdout.flush(); sys.stderr.flush()
+    pid = os.fork()
+    if pid != 0:
+        os.waitpid(pid, 0)
+        return True
+    try:
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0)
+        logname = os.path.join(util.get_config_dir(), 'pool.log')
+        logfd = os.open(logname, os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0o600)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(logfd, 1)
+        os.dup2(logfd, 2)
+        os.close(devnull); os.close(logfd)
+        lease.close_inherited()
+        tracing.disable()
+        # Do not close the connection: it is shared with our parent.
+        env.api.connection = None
+        env.api._pool = []
+        with env.let(quiet=False, always_confirm=True):
+            fill_pool(appdef, size, exclude)
+    except Exception as e:
+        console.error('Could not refill pool for `{0}`: {1!s}',
+                      appdef['name'], e)
+    finally:
+        os._exit(0)
@@ -13,23 +13,34 @@
 # limitations under the License.
 
 import os
+import re
 import sys
+import errno
 import json
+import math
+import base64
 import time
+import zlib
 import struct
 import socket
 import logging
 import ssl
+import threading
 
 if sys.version_info[0] == 2:
     import httplib
     import urlparse
+    import Queue as queue
 else:
     from urllib import parse as urlparse
     from http import client as httplib
+    import queue
 
+from testmill import tracing, cassette
 
-__all__ = ('random_luid', 'update_luids', 'RavelloError', 'RavelloClient')
+
+__all__ = ('random_luid', 'update_luids', 'iter_json_array', 'RavelloError',
+           'AuthenticationError', 'ApiMetrics', 'RavelloClient')
 
 
 def random_luid():
@@ -52,6 +63,263 @@ def update_luids(obj):
     return obj
 
 
+# Incremental JSON parsing
+
+class _JSONStream(object):
+    """Incremental reader over a sequence of JSON text chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.scan = self.depth = 0
+        self.instring = self.escape = False
+
+    def fill(self):
+        """Read the next chunk. Return False at the end of the input."""
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def scan_value(self):
+        """Scan ahead for the end of the JSON value at the current position.
+        Return True if it is in the buffer.
+
+        The scan continues where the previous call stopped, so that a value
+        that spans many chunks is only decoded once it is complete.
+        """
+        buf = self.buf
+        i = self.pos + self.scan
+        if buf[self.pos] not in '{["':
+            while i < len(buf) and buf[i] not in ',:]} \t\r\n':
+                i += 1
+            self.scan = i - self.pos
+            return i < len(buf)
+        while i < len(buf):
+            char = buf[i]
+            i += 1
+            if self.escape:
+                self.escape = False
+            elif self.instring:
+                if char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.instring = False
+                    if self.depth == 0:
+                        break
+            elif char == '"':
+                self.instring = True
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    break
+        self.scan = i - self.pos
+        return self.depth == 0 and not self.instring
+
+    def peek(self):
+        """Skip whitespace and return the next character, or '' at the
+        end of the input."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        """Consume and return the next character, which must be one
+        of ``chars``."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('expecting one of {0!r}, got {1!r}'
+                             .format(chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode and return the next JSON value."""
+        if not self.peek():
+            raise ValueError('unexpected end of input')
+        self.scan = self.depth = 0
+        self.instring = self.escape = False
+        while not self.scan_value():
+            if not self.fill():
+                break
+        value, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+        return value
+
+
+def iter_json_array(chunks, key=None):
+    """Incrementally parse the JSON document in the sequence of strings
+    ``chunks``, and yield the elements of the top-level array.
+
+    If ``key`` is provided, the document must be an object, and the elements
+    of the array under ``key`` are yielded instead. Only the current element
+    is kept in memory.
+    """
+    stream = _JSONStream(chunks)
+    if key is not None:
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            name = stream.value()
+            stream.expect(':')
+            if name == key:
+                break
+            stream.value()
+            if stream.expect(',}') == '}':
+                return
+    stream.expect('[')
+    if stream.peek() == ']':
+        return
+    while True:
+        yield stream.value()
+        if stream.expect(',]') == ']':
+            return
+
+
+def gunzip(body):
+    """Decompress a gzip encoded response body."""
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+
+# Request metrics
+
+_re_id = re.compile('/[0-9]+(?=/|$)')
+
+def endpoint_name(method, url):
+    """Return the name of the endpoint for a request. Numeric ids are
+    replaced by a placeholder and the query string is removed, so that
+    e.g. "GET /applications/1234" becomes "GET /applications/{id}"."""
+    url = url.split('?', 1)[0]
+    return '{0} {1}'.format(method, _re_id.sub('/{id}', url))
+
+
+class _Histogram(object):
+    """A latency histogram with logarithmic buckets.
+
+    Bucket boundaries grow by a factor of :attr:`growth`, so that a
+    percentile is accurate to within that factor. The memory used is
+    independent of the number of samples.
+    """
+
+    base = 0.001
+    growth = 2 ** 0.25
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        if value <= self.base:
+            bucket = 0
+        else:
+            bucket = int(math.ceil(math.log(value / self.base) /
+                                   math.log(self.growth)))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, pct):
+        """Return the ``pct`` percentile (0-100). The upper bound of the
+        bucket is returned, but never more than the maximum value."""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(math.ceil(self.count * pct / 100.0)))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                break
+        return min(self.max, self.base * self.growth ** bucket)
+
+
+class ApiMetrics(object):
+    """Metrics for the requests made by a :class:`RavelloClient`, per
+    endpoint. The metrics are shared with the clients that are used for
+    concurrent requests, and are thread safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+    def _get(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = {
+                    'calls': 0, 'latency': _Histogram(), 'retries': 0,
+                    'errors': {}, 'bytes_in': 0, 'bytes_out': 0,
+                    'decode_time': 0.0 }
+        return stats
+
+    def add_call(self, endpoint, latency, error=None):
+        """Record a call to ``endpoint``. If the call failed, ``error``
+        is the exception."""
+        with self._lock:
+            stats = self._get(endpoint)
+            stats['calls'] += 1
+            stats['latency'].add(latency)
+            if error is not None:
+                name = type(error).__name__
+                stats['errors'][name] = stats['errors'].get(name, 0) + 1
+
+    def add_retry(self, endpoint):
+        """Record a retry for ``endpoint``."""
+        with self._lock:
+            self._get(endpoint)['retries'] += 1
+
+    def add_transfer(self, endpoint, bytes_in=0, bytes_out=0,
+                     decode_time=0.0):
+        """Record the bytes transferred for a call, and the time it took
+        to decompress and parse the response."""
+        with self._lock:
+            stats = self._get(endpoint)
+            stats['bytes_in'] += bytes_in
+            stats['bytes_out'] += bytes_out
+            stats['decode_time'] += decode_time
+
+    def reset(self):
+        """Forget all metrics."""
+        with self._lock:
+            self.endpoints = {}
+
+    def summary(self):
+        """Return a summary of the metrics. This is a dictionary mapping
+        endpoint names to dictionaries with the keys "calls", "errors"
+        (the number of errors by exception class), "retries", "bytes_in",
+        "bytes_out", "decode_time", "total_time", "p50", "p95", "p99" and
+        "max". Times are in seconds."""
+        result = {}
+        with self._lock:
+            for endpoint,stats in self.endpoints.items():
+                latency = stats['latency']
+                summary = dict(stats)
+                summary['errors'] = dict(stats['errors'])
+                del summary['latency']
+                summary['total_time'] = latency.total
+                summary['max'] = latency.max
+                for pct in (50, 95, 99):
+                    summary['p{0}'.format(pct)] = latency.percentile(pct)
+                result[endpoint] = summary
+        return result
+
+
 # The API client
 
 class RavelloError(Exception):
@@ -64,14 +332,26 @@ class RavelloError(Exception):
             return self.args[0]
 
 
+class AuthenticationError(RavelloError):
+    """The API refused our credentials or session (401)."""
+
+
 def should_retry(exc):
-    """Return whether to retry an API call that raised exception `e'."""
+    """Return whether to retry an API call that raised exception `e'.
+
+    Timeouts are retried, and so are connections that were reset or
+    closed by the other side, e.g. a keep-alive connection that timed out.
+    """
     if isinstance(exc, socket.timeout):
         return True
     elif isinstance(exc, ssl.SSLError):
         # XXX: This is not a great way to check for a timeout.
         # However, e.errno is unset...
         return 'time' in exc[0]
+    elif isinstance(exc, socket.error):
+        return exc.errno in (errno.ECONNRESET, errno.EPIPE)
+    elif isinstance(exc, (httplib.BadStatusLine, httplib.IncompleteRead)):
+        return True
     return False
 
 def idempotent(method):
@@ -86,6 +366,7 @@ class RavelloClient(object):
 
     default_retries = 3
     default_timeout = 30
+    default_jobs = 8
     default_url = 'https://cloud.ravellosystems.com/services'
 
     def __init__(self, username=None, password=None, service_url=None,
@@ -101,12 +382,18 @@ class RavelloClient(object):
         self.connection = None
         self._cookie = None
         self._project = None
+        self._validate_token = True
         self._total_retries = 0
+        self.metrics = ApiMetrics()
+        self._pool = []
+        self._bulk_supported = True
 
     def __getstate__(self):
         """Pickle protocol."""
         state = self.__dict__.copy()
         state['logger'] = None
+        state['_pool'] = []
+        state['metrics'] = None
         if state['connection']:
             state['connection'] = True
         return state
@@ -115,6 +402,7 @@ class RavelloClient(object):
         """Pickle protocol."""
         self.__dict__.update(state)
         self.logger = logging.getLogger('ravello')
+        self.metrics = ApiMetrics()
         if self.connection:
             self._connect()
 
@@ -137,7 +425,7 @@ class RavelloClient(object):
         if parsed.scheme not in ('', 'http', 'https'):
             raise ValueError('unknown scheme: %s' % self.scheme)
         self.scheme = parsed.scheme or 'http'
-        self.host = parsed.netloc
+        self.host = parsed.hostname or parsed.netloc
         self.path = parsed.path.rstrip('/')
         if parsed.port:
             self.port = parsed.port
@@ -147,40 +435,107 @@ class RavelloClient(object):
             self.port = httplib.HTTPS_PORT
         self.url = url
 
-    def _retry_request(self, method, url, body, headers):
-        """Retry a request up to self.retry times."""
+    def _retry_request(self, method, url, body, headers, stream=False):
+        """Retry a request up to self.retry times.
+
+        If ``stream`` is true, the response body is not read.
+
+        If a cassette is active (see :mod:`testmill.cassette`), the request
+        is either recorded or replayed.
+        """
         log = self.logger
+        tape = cassette.active()
+        if tape is not None and tape.mode == 'replay':
+            with tracing.span('replay', 'api'):
+                response = tape.play(method, url, stream)
+            return response
         for i in range(self.retries):
             try:
                 if self.connection is None:
                     self._connect()
-                    self._login()
+                    # A session cookie survives a reconnect, unless it
+                    # was reset by close().
+                    if self._cookie is None:
+                        self._login()
+                        # The headers were made before close(), without
+                        # a cookie. Add the new one.
+                        if self._cookie is not None:
+                            headers['Cookie'] = self._cookie
                 t1 = time.time()
-                self.connection.request(method, url, body, dict(headers))
-                response = self.connection.getresponse()
-                response.body = response.read()
+                with tracing.span('http', 'api', attempt=i):
+                    self.connection.request(method, url, body, dict(headers))
+                    response = self.connection.getresponse()
+                    response.body = None if stream else response.read()
+                    if tape is not None:
+                        response = tape.record(method, url, response,
+                                               time.time() - t1, stream)
                 t2 = time.time()
                 log.debug('got response in {0:.2f} secs'.format(t2-t1))
             except Exception as error:
-                self.close()
+                # Keep the session. It is still valid on a new connection,
+                # and logging in again might hit the same network problem.
+                self._disconnect()
                 if not should_retry(error) or not idempotent(method):
                     raise
             else:
                 return response
             self._total_retries += 1
+            self.metrics.add_retry(endpoint_name(method, url[len(self.path):]))
             log.debug('operation timed out, reset connection and retry')
         log.debug('maximum retries reached, giving up')
         raise RavelloError('maximum retries reached making API call')
 
-    def _make_request(self, method, url, body=None, headers=None):
+    def _make_request(self, method, url, body=None, headers=None,
+                      stream=False):
         """Make a single HTTP request to the API and return the
-        HTTPResponse object."""
+        HTTPResponse object.
+
+        If the session has expired and we have a username and password, log
+        in again and retry the request once.
+
+        If ``stream`` is true, the body of a successful JSON response is not
+        read or parsed. Its ``body`` attribute is set to None, and the caller
+        must read it from the response itself (see :meth:`_iter_request`).
+        """
+        endpoint = endpoint_name(method, url)
+        response = error = None
+        t1 = time.time()
+        try:
+            with tracing.span(endpoint, 'api', url=url):
+                try:
+                    response = self._do_request(method, url, body,
+                                                list(headers or []), stream)
+                    return response
+                except AuthenticationError:
+                    if not self.username or not self.password \
+                                or url == '/login':
+                        raise
+                self.logger.debug('session expired, logging in again')
+                self.close()
+                response = self._do_request(method, url, body,
+                                            list(headers or []), stream)
+                return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if response is not None and response.body is None:
+                # The call is recorded by _iter_request() once the body
+                # has been read.
+                response.latency = time.time() - t1
+            else:
+                self.metrics.add_call(endpoint, time.time() - t1, error)
+
+    def _do_request(self, method, url, body, headers, stream=False):
+        """Make a single HTTP request without re-authenticating."""
         log = self.logger
+        endpoint = endpoint_name(method, url)
         url = self.path + url
         if headers is None:
             headers = []
         headers.append(('User-Agent', 'TestMill/1.0'))
         headers.append(('Accept', 'application/json, */*'))
+        headers.append(('Accept-Encoding', 'gzip'))
         if self._cookie is not None:
             headers.append(('Cookie', self._cookie))
         if body is None:
@@ -190,21 +545,41 @@ class RavelloClient(object):
             headers.append(('Content-Type', 'application/json'))
         try:
             log.debug('API request: %s %s, %d bytes', method, url, len(body))
-            response = self._retry_request(method, url, body, dict(headers))
+            response = self._retry_request(method, url, body, dict(headers),
+                                           stream)
+            ctype = response.getheader('Content-Type')
+            if stream and (not 200 <= response.status < 300 or
+                           ctype != 'application/json'):
+                response.body = response.read()
         except (socket.error, ssl.SSLError, httplib.HTTPException) as e:
             log.error('error making API call: %s', str(e))
             raise RavelloError(str(e))
+        if response.body is None:
+            log.debug('API response: {0}, streaming, ({1})'
+                            .format(response.status, ctype))
+            self.metrics.add_transfer(endpoint, bytes_out=len(body))
+            response.entity = None
+            response.endpoint = endpoint
+            return response
+        bytes_in, bytes_out = len(response.body), len(body)
+        t1 = time.time()
+        if response.getheader('Content-Encoding') == 'gzip':
+            response.body = gunzip(response.body)
+        self.metrics.add_transfer(endpoint, bytes_in, bytes_out,
+                                  time.time() - t1)
         body = response.body
-        ctype = response.getheader('Content-Type')
         log.debug('API response: {0}, {1} bytes, ({2})' \
                 .format(response.status, len(body), ctype))
         if 200 <= response.status < 300:
             if ctype == 'application/json':
+                t1 = time.time()
                 try:
                     parsed = json.loads(body)
                 except Exception:
                     log.error('response body contains invalid JSON')
                     return
+                self.metrics.add_transfer(endpoint,
+                                          decode_time=time.time() - t1)
                 response.entity = parsed
             else:
                 response.entity = None
@@ -215,6 +590,12 @@ class RavelloClient(object):
             # The second part of the clause above is completely bogus but
             # we need it until our API returns a 404 for a not found error.
             response.entity = None
+        elif response.status == 401:
+            # Only a 401 means the session expired. A 403 is a permission
+            # error, which is reported like any other error below.
+            message = 'API call failed with {0} {1}' \
+                            .format(response.status, response.reason)
+            raise AuthenticationError(message)
         else:
             error = response.getheader('error-code')
             message = response.getheader('error-message', '')
@@ -223,7 +604,9 @@ class RavelloClient(object):
             if not message:
                 message = 'API call failed with {0} {1}'\
                                 .format(response.status, response.reason)
-            raise RavelloError(message)
+            error = RavelloError(message)
+            error.status = response.status
+            raise error
         return response
 
     def connect(self, url=None):
@@ -239,6 +622,10 @@ class RavelloClient(object):
     def _connect(self):
         """Low-level connect."""
         log = self.logger
+        tape = cassette.active()
+        if tape is not None and tape.mode == 'replay':
+            self.connection = cassette.NullConnection()
+            return
         if self.scheme == 'http':
             conn_class = httplib.HTTPConnection
         else:
@@ -249,18 +636,172 @@ class RavelloClient(object):
         log.debug('connected')
         self.connection = connection
 
-    def close(self):
-        """Close the connection."""
+    def _iter_body(self, response, stats, bufsize=65536):
+        """Iterate over the body of a streamed response in chunks. The
+        number of bytes read and the time spent reading them are added to
+        ``stats``."""
+        decompressor = None
+        if response.getheader('Content-Encoding') == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            t1 = time.time()
+            chunk = response.read(bufsize)
+            stats['read_time'] += time.time() - t1
+            if not chunk:
+                break
+            stats['bytes_in'] += len(chunk)
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            yield chunk
+        if decompressor:
+            yield decompressor.flush()
+
+    def _iter_request(self, url, key=None):
+        """Make a GET request for ``url`` and iterate over the elements of
+        the JSON array in the response, or of the array under ``key``.
+
+        The response is parsed while it is being received. If the iteration
+        is abandoned early, the connection is dropped (but the session is
+        kept) because it cannot be reused.
+        """
+        response = self._make_request('GET', url, stream=True)
+        if response.body is not None:
+            # Not a streamed JSON response, e.g. a 404 or an error page.
+            raise RavelloError('API call failed with {0} {1}'
+                               .format(response.status, response.reason))
+        # The call is recorded when the stream is finished. Its latency
+        # includes the time spent reading and parsing the body, but not the
+        # time spent by the caller between elements.
+        stats = {'bytes_in': 0, 'read_time': 0.0}
+        elements = iter_json_array(self._iter_body(response, stats), key)
+        busy = 0.0
+        complete = False
+        error = None
+        try:
+            while True:
+                t1 = time.time()
+                try:
+                    elem = next(elements)
+                except StopIteration:
+                    break
+                finally:
+                    busy += time.time() - t1
+                yield elem
+            complete = True
+        except (socket.error, ssl.SSLError, httplib.HTTPException) as e:
+            self.logger.error('error reading API response: %s', str(e))
+            error = RavelloError(str(e))
+            raise error
+        except ValueError:
+            error = RavelloError('response body contains invalid JSON')
+            raise error
+        finally:
+            if not complete:
+                self._disconnect()
+            decode_time = max(0.0, busy - stats['read_time'])
+            self.metrics.add_transfer(response.endpoint, stats['bytes_in'],
+                                      decode_time=decode_time)
+            self.metrics.add_call(response.endpoint, response.latency + busy,
+                                  error)
+
+    def _disconnect(self):
+        """Close the connection but keep the session. The next request
+        will reconnect."""
         if self.connection:
             try:
                 self.connection.close()
             except Exception:
                 pass
         self.connection = None
+
+    def close(self):
+        """Close the connection."""
+        self._disconnect()
         self._cookie = None
+        for client in self._pool:
+            client.close()
+        del self._pool[:]
 
-    def login(self, username=None, password=None, token=None):
-        """Log in to the API."""
+    def _clone(self):
+        """Return a client that shares our session but that has its own
+        connection."""
+        if self._pool:
+            return self._pool.pop()
+        # Not copy.copy(): that uses the pickle protocol, which would
+        # connect the clone and give it its own metrics.
+        clone = object.__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        clone.connection = None
+        clone._pool = []
+        return clone
+
+    def map(self, func, items, jobs=None, callback=None):
+        """Call ``func(client, item)`` for each element of ``items``, with
+        up to ``jobs`` calls running concurrently.
+
+        Each concurrent call gets its own client that shares the session
+        with this client. These clients are kept in a pool and are re-used
+        by later calls. If ``callback`` is provided, it is called in the
+        calling thread as ``callback(item, result, exc)`` after each call
+        completes.
+
+        The return value is a list of ``(item, result, exc)`` tuples in the
+        order of ``items``, where ``exc`` is the exception raised by the
+        call, if any.
+        """
+        items = list(items)
+        jobs = min(jobs or self.default_jobs, len(items))
+        results = [None] * len(items)
+        todo = queue.Queue()
+        done = queue.Queue()
+        for pos, item in enumerate(items):
+            todo.put((pos, item))
+        def worker(client):
+            try:
+                while True:
+                    try:
+                        pos, item = todo.get_nowait()
+                    except queue.Empty:
+                        break
+                    try:
+                        result = func(client, item)
+                    except Exception as e:
+                        done.put((pos, (item, None, e)))
+                    else:
+                        done.put((pos, (item, result, None)))
+            finally:
+                client._disconnect()
+                self._pool.append(client)
+        clients = [ self._clone() for i in range(jobs) ]
+        threads = []
+        for client in clients:
+            thread = threading.Thread(target=worker, args=(client,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for i in range(len(items)):
+            # Use a timeout so that we remain interruptible.
+            while True:
+                try:
+                    pos, result = done.get(timeout=1)
+                except queue.Empty:
+                    continue
+                break
+            results[pos] = result
+            if callback:
+                callback(*result)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def login(self, username=None, password=None, token=None, project=None,
+              validate=True):
+        """Log in to the API.
+
+        If *project* is provided, it is used as the default project instead
+        of looking it up. If *validate* is False, a token is not checked
+        until it is first used.
+        """
         if self._cookie is not None:
             raise RuntimeError('already logged in')
         if username is not None:
@@ -272,6 +813,9 @@ class RavelloClient(object):
             self.password = password
         elif token is not None:
             self.token = token
+        if project is not None:
+            self._project = project
+        self._validate_token = validate
         self._login()
 
     def _login(self):
@@ -280,7 +824,7 @@ class RavelloClient(object):
         if self.username:
             log.debug('performing a new login')
             auth = '{0}:{1}'.format(self.username, self.password)
-            auth = auth.encode('base64')
+            auth = base64.b64encode(auth.encode('utf-8')).decode('ascii')
             headers = [('Authorization', 'Basic %s' % auth)]
             response = self._make_request('POST', '/login', headers=headers)
             # XXX: cookie hard-coded to be "JSESSIONID"
@@ -297,8 +841,9 @@ class RavelloClient(object):
         elif self.token:
             log.debug('logging in with token')
             self._cookie = self.token
-            self.hello()  # Make sure the token works
-            log.debug('token is valid')
+            if self._validate_token:
+                self.hello()  # Make sure the token works
+                log.debug('token is valid')
         else:
             raise RuntimeError('cannot login: no username/password or token')
         # Also figure out the default project.
@@ -368,16 +913,25 @@ class RavelloClient(object):
             return
         return response.entity['value']
 
-    def get_images(self):
-        """Return a list of all images."""
-        images = []
-        response = self._make_request('GET', '/images/private')
-        for image in response.entity.get('imageMetadata', []):
-            images.append(dict(image, public=False))
-        response = self._make_request('GET', '/images/public')
-        for image in response.entity.get('imageMetadata', []):
-            images.append(dict(image, public=True))
-        return images
+    def iter_images(self, public=None, prefix=None):
+        """Iterate over the images.
+
+        If ``public`` is True or False, only public or private images are
+        returned. If ``prefix`` is provided, only images whose name starts
+        with it are returned.
+        """
+        for kind in ('private', 'public'):
+            if public is not None and public != (kind == 'public'):
+                continue
+            url = '/images/{0}'.format(kind)
+            for image in self._iter_request(url, 'imageMetadata'):
+                if prefix and not image['name'].startswith(prefix):
+                    continue
+                yield dict(image, public=(kind == 'public'))
+
+    def get_images(self, public=None, prefix=None):
+        """Return a list of all images. See :meth:`iter_images`."""
+        return list(self.iter_images(public, prefix))
 
     # Applications
 
@@ -393,10 +947,17 @@ class RavelloClient(object):
         application.update(application.pop('appMetadata'))
         return application
 
-    def get_applications(self):
-        """Return all applications."""
-        response = self._make_request('GET', '/applications')
-        return response.entity
+    def iter_applications(self, prefix=None):
+        """Iterate over the applications. If ``prefix`` is provided, only
+        applications whose name starts with it are returned."""
+        for application in self._iter_request('/applications'):
+            if prefix and not application['name'].startswith(prefix):
+                continue
+            yield application
+
+    def get_applications(self, prefix=None):
+        """Return all applications. See :meth:`iter_applications`."""
+        return list(self.iter_applications(prefix))
 
     def create_application(self, application):
         """Create a new application."""
@@ -433,6 +994,62 @@ class RavelloClient(object):
         url = '/applications/{0}/vms/{1}/stop'.format(application['id'], vm['id'])
         self._make_request('POST', url)
 
+    def _application_action(self, application, action):
+        """Perform an application level VM action. Return False if this is
+        not supported by the service."""
+        if not self._bulk_supported:
+            return False
+        url = '/applications/{0}/{1}'.format(application['id'], action)
+        try:
+            response = self._make_request('POST', url)
+        except RavelloError as e:
+            if getattr(e, 'status', None) != 405:
+                raise
+            missing = True
+        else:
+            if response.status != 404:
+                return True
+            # A 404 with an error message is about the application, not
+            # about the endpoint. Fall back for this call only.
+            missing = not response.getheader('error-message')
+        if missing:
+            self.logger.debug('application level {0} not supported'
+                              .format(action))
+            self._bulk_supported = False
+        return False
+
+    def _vms_action(self, application, vms, action, jobs=None):
+        """Perform ``action`` on the VMs ``vms`` of ``application``."""
+        vms = list(vms)
+        if not vms:
+            return
+        allvms = set((vm['id'] for vm in application.get('vms', [])))
+        if set((vm['id'] for vm in vms)) == allvms and \
+                self._application_action(application, action):
+            return
+        method = '{0}_vm'.format(action)
+        func = lambda client, vm: getattr(client, method)(application, vm)
+        if len(vms) == 1:
+            func(self, vms[0])
+            return
+        for vm, result, exc in self.map(func, vms, jobs):
+            if exc is not None:
+                raise exc
+
+    def start_vms(self, application, vms, jobs=None):
+        """Start the virtual machines ``vms`` in ``application``.
+
+        If these are all the VMs in the application, the application is
+        started with a single request. Otherwise, or if that is not
+        supported, up to ``jobs`` VMs are started concurrently.
+        """
+        self._vms_action(application, vms, 'start', jobs)
+
+    def stop_vms(self, application, vms, jobs=None):
+        """Stop the virtual machines ``vms`` in ``application``. See
+        :meth:`start_vms`."""
+        self._vms_action(application, vms, 'stop', jobs)
+
     # Blueprints
 
     def get_blueprint(self, id):
@@ -444,10 +1061,17 @@ class RavelloClient(object):
         blueprint.update(blueprint.pop('appMetadata'))
         return blueprint
 
-    def get_blueprints(self):
-        """Return all blueprints."""
-        response = self._make_request('GET', '/blueprints')
-        return response.entity
+    def iter_blueprints(self, prefix=None):
+        """Iterate over the blueprints. If ``prefix`` is provided, only
+        blueprints whose name starts with it are returned."""
+        for blueprint in self._iter_request('/blueprints'):
+            if prefix and not blueprint['name'].startswith(prefix):
+                continue
+            yield blueprint
+
+    def get_blueprints(self, prefix=None):
+        """Return all blueprints. See :meth:`iter_blueprints`."""
+        return list(self.iter_blueprints(prefix))
 
     def create_blueprint(self, name, application):
         """Create a new blueprint ``name`` based on ``application``."""
@@ -0,0 +1,256 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent multiplexed ssh connections to the VMs.
+
+For every VM, an OpenSSH master connection (see ControlMaster in
+ssh_config(5)) is started once and kept in the background for
+``default_persist`` seconds after it was last used. Its control socket
+lives under ``~/.ravello/ssh``. Subsequent ssh sessions to the same VM,
+including those from later "ravtest" invocations, are multiplexed over
+the master connection and skip the TCP connect, the key exchange and the
+authentication.
+
+This needs a local OpenSSH, and is not available on Windows.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import stat
+import time
+import hashlib
+import subprocess
+
+from testmill import util, console, error
+from testmill.state import env
+
+
+default_user = 'ravello'
+default_persist = 1800
+
+
+def find_openssh():
+    """Return the path of the local OpenSSH client if it supports
+    multiplexing, or None."""
+    if not hasattr(env, '_openssh'):
+        if sys.platform.startswith('win'):
+            env._openssh = None
+        else:
+            env._openssh = util.find_openssh()
+    return env._openssh
+
+
+def supported():
+    """Return whether multiplexed connections are supported."""
+    return bool(find_openssh())
+
+
+def control_dir():
+    """Return the directory with the control sockets, creating it if
+    it doesn't exist."""
+    dirname = os.path.join(util.get_config_dir(), 'ssh')
+    try:
+        st = os.stat(dirname)
+    except OSError:
+        os.mkdir(dirname, 0o700)
+    else:
+        if not stat.S_ISDIR(st.st_mode):
+            error.raise_error('Path `{0}` exists but is not a directory.',
+                              dirname)
+    return dirname
+
+
+def control_path(host, user=None):
+    """Return the path of the control socket for ``user`` at ``host``.
+
+    The file name is a digest of the user and host, so that the path stays
+    well within the limit on the length of a Unix socket path.
+    """
+    if user is None:
+        user = default_user
+    name = '{0}@{1}'.format(user, host).encode('utf-8')
+    digest = hashlib.sha1(name).hexdigest()[:16]
+    return os.path.join(control_dir(), digest)
+
+
+def ssh_options(host, user=None, persist=None, master=True):
+    """Return the command-line options for ssh to connect to ``host``
+    as ``user``, using a master connection if there is one.
+
+    If ``master`` is true, ssh starts a master connection if there is
+    none. Otherwise it connects directly. Note that a master started this
+    way keeps the stdin, stdout and stderr of the ssh that started it.
+    """
+    if persist is None:
+        persist = default_persist
+    devnull = 'NUL' if sys.platform.startswith('win') else '/dev/null'
+    options = ['-i', env.private_key_file,
+               '-o', 'UserKnownHostsFile={0}'.format(devnull),
+               '-o', 'StrictHostKeyChecking=no',
+               '-o', 'LogLevel=quiet',
+               '-o', 'ServerAliveInterval=30']
+    if supported():
+        path = control_path(host, user)
+        options += ['-o', 'ControlPath={0}'.format(path)]
+        if master:
+            options += ['-o', 'ControlMaster=auto',
+                        '-o', 'ControlPersist={0}'.format(int(persist))]
+        else:
+            options += ['-o', 'ControlMaster=no']
+    return options
+
+
+def _ssh(args, wait=True, timeout=None):
+    """Run ssh with ``args``. If ``wait`` is true, wait for it to exit and
+    return its exit status. If that takes longer than ``timeout`` seconds,
+    it is killed, and a negative status is returned."""
+    argv = [find_openssh()] + args
+    console.debug('Starting {0}', ' '.join(argv))
+    with open(os.devnull, 'r+') as devnull:
+        proc = subprocess.Popen(argv, stdin=devnull, stdout=devnull,
+                                stderr=devnull)
+    if not wait:
+        return proc
+    if timeout is not None:
+        # ConnectTimeout only covers the TCP connect, not authentication
+        # or the command.
+        end_time = time.time() + timeout
+        while proc.poll() is None and time.time() < end_time:
+            time.sleep(0.05)
+        if proc.returncode is None:
+            console.debug('ssh timed out after {0} seconds', timeout)
+            proc.kill()
+    return proc.wait()
+
+
+def _reap_masters():
+    """Reap the ssh processes that were started in the background by
+    :func:`start_master` and that have exited. With "-f", ssh exits as
+    soon as the master connection is up."""
+    procs = getattr(env, '_master_procs', [])
+    env._master_procs = [ proc for proc in procs if proc.poll() is None ]
+    return env._master_procs
+
+
+def master_running(host, user=None):
+    """Return whether a master connection to ``host`` is running."""
+    if not supported():
+        return False
+    _reap_masters()
+    path = control_path(host, user)
+    if not os.path.exists(path):
+        return False
+    ret = _ssh(['-o', 'ControlPath={0}'.format(path), '-O', 'check',
+                host], timeout=10)
+    return ret == 0
+
+
+def start_master(host, user=None, persist=None, timeout=10, wait=True):
+    """Start a master connection to ``host``, unless one is running
+    already.
+
+    If ``wait`` is true, return whether the master connection is up.
+    Otherwise, start it in the background and return immediately.
+    """
+    if not supported():
+        return False
+    if master_running(host, user):
+        return True
+    if user is None:
+        user = default_user
+    args = ssh_options(host, user, persist)
+    args += ['-o', 'BatchMode=yes',
+             '-o', 'ConnectTimeout={0}'.format(int(timeout)),
+             '-M', '-N', '-f', '{0}@{1}'.format(user, host)]
+    ret = _ssh(args, wait, 2 * timeout)
+    if wait:
+        return ret == 0
+    _reap_masters().append(ret)
+    return True
+
+
+def start_masters(hosts, user=None, persist=None):
+    """Start master connections to ``hosts`` in the background. The ssh
+    processes are reaped by later calls into this module."""
+    for host in hosts:
+        start_master(host, user, persist, wait=False)
+
+
+def stop_master(host, user=None):
+    """Stop the master connection to ``host``, if any."""
+    if not master_running(host, user):
+        return
+    path = control_path(host, user)
+    _ssh(['-o', 'ControlPath={0}'.format(path), '-O', 'exit', host],
+         timeout=10)
+
+
+def find_scp():
+    """Return the path of the scp that comes with the local OpenSSH."""
+    openssh = find_openssh()
+    if not openssh:
+        return
+    scp = os.path.join(os.path.dirname(openssh), 'scp')
+    if os.access(scp, os.X_OK):
+        return scp
+    return util.which('scp')
+
+
+def ssh_command(host, command, user=None, tty=False):
+    """Return the command line to run ``command`` on ``host`` over the
+    master connection. If there is no master connection, ssh connects
+    directly. Use :func:`start_master` to start one."""
+    if user is None:
+        user = default_user
+    argv = [find_openssh()] + ssh_options(host, user, master=False)
+    argv += ['-o', 'BatchMode=yes', '-tt' if tty else '-T',
+             '{0}@{1}'.format(user, host), command]
+    return argv
+
+
+def scp_command(source, dest, user=None):
+    """Return the command line to copy ``source`` to ``dest`` with scp.
+
+    One of the two needs to be a remote path in the form "host:path". The
+    copy goes over the master connection to that host, if there is one.
+    """
+    if user is None:
+        user = default_user
+    remote = dest if ':' in dest else source
+    host = remote.split(':')[0]
+    if ':' in dest:
+        dest = '{0}@{1}'.format(user, dest)
+    else:
+        source = '{0}@{1}'.format(user, source)
+    argv = [find_scp(), '-q'] + ssh_options(host, user, master=False)
+    argv += ['-o', 'BatchMode=yes', source, dest]
+    return argv
+
+
+def run(host, command, user=None, timeout=10):
+    """Run ``command`` on ``host`` over the master connection, starting it
+    if needed, and return its exit status.
+
+    The connect times out after ``timeout`` seconds, and ssh is killed if
+    it has not finished after twice that.
+    """
+    if user is None:
+        user = default_user
+    args = ssh_options(host, user)
+    args += ['-o', 'BatchMode=yes',
+             '-o', 'ConnectTimeout={0}'.format(int(timeout)),
+             '{0}@{1}'.format(user, host), command]
+    return _ssh(args, timeout=2 * timeout)
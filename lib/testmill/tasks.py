@@ -20,6 +20,7 @@ import time
 import stat
 import tarfile
 import hashlib
+import subprocess
 import multiprocessing
 import traceback
 
@@ -29,7 +30,8 @@ import fabric.network
 import fabric.api as fab
 
 import testmill
-from testmill import console, versioncontrol, util, error, inflect, console
+from testmill import (console, versioncontrol, util, error, inflect,
+                      output, history, tracing, sshmux, agent)
 from testmill.state import env
 
 if sys.version_info[0] == 3:
@@ -38,8 +40,14 @@ else:
     import StringIO as io
 
 
-def run_all_tasks(app, vms):
-    """Run the runbook for an application ``app``."""
+def new_test_id():
+    """Return a new random test ID."""
+    return os.urandom(16).encode('hex')
+
+
+def run_all_tasks(app, vms, test_id=None):
+    """Run the runbook for an application ``app``. A new test ID is
+    generated unless ``test_id`` is provided."""
     hosts = []
     host_info = {}
     appname = app['name'].split(':')[1]
@@ -56,7 +64,7 @@ def run_all_tasks(app, vms):
         hosts.append(ipaddr)
         host_info[ipaddr] = vm['name']
 
-    env.test_id = os.urandom(16).encode('hex')
+    env.test_id = test_id or new_test_id()
     console.info('Starting run `{0}`.', env.test_id)
     env.host_info = host_info
     env.start_time = int(time.time())
@@ -68,10 +76,13 @@ def run_all_tasks(app, vms):
         vmstate['exited'] = False
         vmstate['completed_tasks'] = {}
         vmstate['shell_env_update'] = {}
+        vmstate['task_results'] = []
         env.shared_state[vmname] = vmstate
     env.appdef = appdef
     env.application = app
     env.vms = vms
+    env.use_color = output.use_color()
+    env.prefix_width = max((len(name) for name in vms))
 
     fab.env.user = 'ravello'
     fab.env.key_filename = env.private_key_file
@@ -88,11 +99,14 @@ def run_all_tasks(app, vms):
     noun = inflect.plural_noun('virtual machine', len(vms))
     console.info('Executing tasks on {0} {1}...', len(vms), noun)
 
-    fabric.tasks.execute(run_tasklist, env)
+    with tracing.span('execute', 'task'):
+        fabric.tasks.execute(run_tasklist, env)
 
     errors = set()
+    env.task_results = {}
     for vmname in vms:
         vmstate = env.shared_state[vmname]
+        env.task_results[vmname] = vmstate['task_results']
         for taskname,status in vmstate['completed_tasks'].items():
             if status != 0:
                 errors.add('`{0}` on `{1}`'.format(taskname, vmname))
@@ -108,6 +122,7 @@ def run_all_tasks(app, vms):
     return len(errors)
 
 
+@tracing.traced('task')
 def preinit():
     """Prepare the VM before any tasks are run."""
     packagedir = testmill.packagedir()
@@ -128,23 +143,58 @@ def preinit():
                            api_cookie=env.api._cookie,
                            shutdown_urls=shutdown_urls)
     script_name = '{0}.preinit'.format(env.test_id)
-    fab.put(io.StringIO(script), script_name)
-    command = 'exec $SHELL {0}'.format(script_name)
-    fab.run(command, shell=False, pty=True, quiet=not env.debug)
+    executor = get_executor()
+    env.agent = None
+    if getattr(env.args, 'agent', False):
+        with tracing.span('start', 'agent'):
+            env.agent = agent.start(executor)
+    status = None
+    if env.agent is not None:
+        # The agent saves the upload and a login. But it has no pty, and
+        # this script uses sudo, which may need one.
+        with tracing.span('run', 'agent', script=script_name):
+            status, _ = env.agent.run(script, script_name)
+        if status != 0:
+            console.debug('Pre-initialization by the agent failed with '
+                          'status {0}, running it with a pty.', status)
+    if status != 0:
+        with tracing.span('put', 'ssh', remote=script_name):
+            executor.put(io.StringIO(script), script_name)
+        command = 'exec $SHELL {0}'.format(script_name)
+        with tracing.span('run', 'ssh', command=command):
+            executor.run(command, shell=False, pty=True, quiet=not env.debug)
+    if env.agent is not None:
+        env.agent.setenv(shell_vars(env.shell_env))
 
 
 def show_output(task):
-    """Show output for a completed task."""
+    """Show output for a completed task.
+
+    Nothing is shown for a task whose output was streamed to the console
+    already, unless it failed. In that case, the last lines of its output
+    are shown again.
+    """
     if task.interactive:
         return
-    if task.quiet and not env.debug:
+    if task.quiet and not env.debug and task.return_code == 0:
+        return
+    if task.streamed and task.return_code == 0:
         return
-    output = task.stdout
-    if (not output or output.isspace()) and not env.debug:
+    stdout = task.stdout
+    if (not stdout or stdout.isspace()) and not env.debug:
         return
-    console.writeln('\n== Output for task `{0}` on VM `{1}`:\n',
-                    task.name, env.vm['name'])
-    console.writeln(output)
+    if task.streamed:
+        console.writeln('\n== Last output for failed task `{0}` on VM `{1}`:'
+                        '\n', task.name, env.vm['name'])
+    else:
+        console.writeln('\n== Output for task `{0}` on VM `{1}`:\n',
+                        task.name, env.vm['name'])
+    if task.output.omitted_lines:
+        console.writeln('[{0} earlier lines not shown]',
+                        task.output.omitted_lines)
+    console.writeln(stdout)
+    if task.output.logfile:
+        console.writeln('[full output in {0}]', task.output.logfile)
     console.writeln()
 
 
@@ -152,6 +202,9 @@ def synchronize_on_task(taskname, timeout=600):
     """Wait until all instances of ``taskname`` have completed.
     Returns a dictionary with the shared state of the VMs that
     were waited for.
+
+    The shared state is polled every ``env.sync_interval`` seconds,
+    5 by default.
     """
     waitfor = set()
     for vmdef in env.appdef['vms']:
@@ -177,7 +230,7 @@ def synchronize_on_task(taskname, timeout=600):
         if vmstate['exited'] or not waitfor:
             break
         console.debug('Waiting for %s' % repr(waitfor))
-        time.sleep(5)
+        time.sleep(getattr(env, 'sync_interval', 5))
         if time.time() > end_time:
             error.raise_error("Timeout waiting for task `{0}`.", taskname)
     return state
@@ -209,6 +262,7 @@ def run_tasklist(passed_env):
             break
 
     env.vm = vm
+    env.agent = None
     shell_env = env.shell_env = {}
     shell_env['RAVELLO_TEST_ID'] = env.test_id
     shell_env['RAVELLO_TEST_USER'] = 'ravello'
@@ -221,11 +275,16 @@ def run_tasklist(passed_env):
     shell_env['RAVELLO_VM_ID'] = vm['id']
     shell_env['RAVELLO_VM_NAME'] = vm['name']
 
+    vmnames = [ vmdef['name'] for vmdef in env.appdef['vms'] ]
+    env.output_prefix = output.format_prefix(vmname, vmnames.index(vmname),
+                                             env.prefix_width, env.use_color)
+
     def debug(message, *args, **kwargs):
         message = message.format(*args, **kwargs)
         console.debug('[VM {0}] {1}', vmname, message)
 
     debug('Running task list for `{0}`', host)
+    tracing.set_process_name('VM {0}'.format(vmname))
 
     try:
         debug('Pre-initialize VM')
@@ -258,7 +317,15 @@ def run_tasklist(passed_env):
                     debug('Stopping due to failed task on VM `{0}`.', name)
                     break
 
-            task.run()
+            start = time.time()
+            try:
+                with tracing.span(task.name, 'task'):
+                    task.run()
+            finally:
+                result = history.task_result(task, start, time.time())
+                vmstate = env.shared_state[vmname]
+                vmstate['task_results'].append(result)
+                env.shared_state[vmname] = vmstate  # sync shared state
 
             vmstate = env.shared_state[vmname]
             vmstate['completed_tasks'][task.name] = task.return_code
@@ -280,6 +347,226 @@ def run_tasklist(passed_env):
         vmstate['exited'] = True
         env.shared_state[vmname] = vmstate  # sync
 
+    finally:
+        if env.agent is not None:
+            env.agent.close()
+            env.agent = None
+
+
+class FabricExecutor(object):
+    """Execute remote operations with Fabric.
+
+    This is the default executor. A different executor can be set as
+    ``env.executor``. It needs to provide the same three methods. This is
+    used to benchmark the orchestration without any VMs.
+    """
+
+    def put(self, local, remote):
+        return fab.put(local, remote)
+
+    def get(self, remote, local):
+        return fab.get(remote, local)
+
+    def run(self, command, **kwargs):
+        return fab.run(command, **kwargs)
+
+    def open(self, command):
+        """Start ``command`` and return a channel to its standard input
+        and output. Its standard error is merged into the output."""
+        client = fabric.state.connections[fab.env.host_string]
+        channel = client.get_transport().open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        return channel
+
+
+class _Result(str):
+    """The output of a remote command, with its exit status."""
+
+    return_code = None
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+
+class _Pipe(object):
+    """A channel to the standard input and output of a subprocess."""
+
+    def __init__(self, proc):
+        self.proc = proc
+
+    def sendall(self, data):
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
+
+    def recv(self, size):
+        return os.read(self.proc.stdout.fileno(), size)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+class OpenSSHExecutor(object):
+    """Execute remote operations with the local OpenSSH client.
+
+    This is selected with "ravtest run --transport=openssh". The
+    encryption is done in native code by ssh and scp, which is a lot
+    cheaper than with paramiko for uploads and for tasks with a lot of
+    output. All commands to a VM are multiplexed over a single master
+    connection, see :mod:`testmill.sshmux`.
+
+    The host and user are taken from Fabric's ``env``, which Fabric sets
+    for every VM before calling :func:`run_tasklist`.
+    """
+
+    def _host(self):
+        host, user = fab.env.host_string, fab.env.user
+        if not hasattr(env, '_ssh_masters'):
+            env._ssh_masters = set()
+        if (host, user) not in env._ssh_masters:
+            # Our ssh and scp commands never become a master themselves,
+            # because a master would inherit their pipes and keep them
+            # open. So make sure that there is one.
+            sshmux.start_master(host, user)
+            env._ssh_masters.add((host, user))
+        return host, user
+
+    def _check(self, ret, what):
+        if ret != 0:
+            host, _ = self._host()
+            error.raise_error('{0} failed on `{1}` with exit status {2}.',
+                              what, host, ret)
+
+    def put(self, local, remote):
+        host, user = self._host()
+        if hasattr(local, 'read'):
+            command = 'cat > {0}'.format(util.shell_escape(remote))
+            argv = sshmux.ssh_command(host, command, user)
+            data = local.read()
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            proc = subprocess.Popen(argv, stdin=subprocess.PIPE)
+            proc.communicate(data)
+        else:
+            argv = sshmux.scp_command(local, '{0}:{1}'.format(host, remote),
+                                      user)
+            proc = subprocess.Popen(argv)
+            proc.wait()
+        self._check(proc.returncode, 'Upload to `{0}`'.format(remote))
+
+    def get(self, remote, local):
+        host, user = self._host()
+        if hasattr(local, 'write'):
+            command = 'cat {0}'.format(util.shell_escape(remote))
+            argv = sshmux.ssh_command(host, command, user)
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+            stdout, _ = proc.communicate()
+            if not isinstance(stdout, str):
+                stdout = stdout.decode('utf-8', 'replace')
+            local.write(stdout)
+        else:
+            argv = sshmux.scp_command('{0}:{1}'.format(host, remote), local,
+                                      user)
+            proc = subprocess.Popen(argv)
+            proc.wait()
+        self._check(proc.returncode, 'Download of `{0}`'.format(remote))
+
+    def run(self, command, shell=True, pty=True, warn_only=False,
+            quiet=False, stdout=None, stderr=None, capture_buffer_size=None):
+        """Run ``command``. The arguments have the same meaning as for
+        ``fabric.api.run()``. With a pty, stderr is merged into stdout,
+        and the "\\r\\n" line endings of the pty are changed to "\\n"."""
+        host, user = self._host()
+        if shell:
+            command = '/bin/bash -l -c {0}'.format(util.shell_escape(command))
+        argv = sshmux.ssh_command(host, command, user, tty=pty)
+        if stdout is None and not quiet:
+            stdout = sys.stdout
+        # Keep stdin open but unused, like Fabric does for parallel runs.
+        proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        chunks = []
+        size = 0
+        pending = ''
+        fd = proc.stdout.fileno()
+        while True:
+            data = os.read(fd, 8192)
+            eof = not data
+            if not isinstance(data, str):
+                data = data.decode('utf-8', 'replace')
+            if pty:
+                # A "\r" at the end may be followed by a "\n" in the
+                # next chunk.
+                data = pending + data
+                pending = ''
+                if data.endswith('\r') and not eof:
+                    data, pending = data[:-1], '\r'
+                data = data.replace('\r\n', '\n')
+            if data:
+                if stdout is not None:
+                    stdout.write(data)
+                chunks.append(data)
+                size += len(data)
+                if capture_buffer_size and size > 2 * capture_buffer_size:
+                    data = ''.join(chunks)[-capture_buffer_size:]
+                    chunks = [data]
+                    size = len(data)
+            if eof:
+                break
+        proc.stdin.close()
+        proc.wait()
+        captured = ''.join(chunks)
+        if capture_buffer_size:
+            captured = captured[-capture_buffer_size:]
+        result = _Result(captured.strip())
+        result.return_code = proc.returncode
+        if not (warn_only or quiet):
+            self._check(proc.returncode, 'Command `{0}`'.format(command))
+        return result
+
+    def open(self, command):
+        """Start ``command`` and return a channel to its standard input
+        and output. Its standard error is merged into the output."""
+        host, user = self._host()
+        argv = sshmux.ssh_command(host, command, user)
+        proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        return _Pipe(proc)
+
+
+executors = { 'fabric': FabricExecutor, 'openssh': OpenSSHExecutor }
+
+def get_executor():
+    """Return the executor for remote operations.
+
+    This is ``env.executor`` if it is set, and otherwise the executor for
+    the transport selected with "ravtest run --transport".
+    """
+    executor = getattr(env, 'executor', None)
+    if executor is None:
+        args = getattr(env, 'args', None)
+        transport = getattr(args, 'transport', None) or 'fabric'
+        executor = executors[transport]()
+    return executor
+
+
+def shell_vars(variables):
+    """Return shell code that exports ``variables``."""
+    lines = []
+    tmpl = '{0}={1}; export {0}'
+    for key,value in variables.items():
+        escaped = util.shell_escape(str(value))
+        lines.append(tmpl.format(key, escaped))
+    return '\n'.join(lines)
+
 
 def create_script(taskname, commands):
     """Create the script to execute ``commands``."""
@@ -287,18 +574,12 @@ def create_script(taskname, commands):
     fname = os.path.join(packagedir, 'runtask.sh')
     with file(fname) as fin:
         script = fin.read()
-    lines = []
-    tmpl = '{0}={1}; export {0}'
-    for key,value in env.shell_env.items():
-        escaped = util.shell_escape(str(value))
-        lines.append(tmpl.format(key, escaped))
-    shell_vars = '\n'.join(lines)
     if env.args.continue_:
         tmpl = '{0}\n'
     else:
         tmpl = '{0}\ntest "$?" -ne "0" && exit 1\n'
     shell_commands = '\n'.join([tmpl.format(cmd) for cmd in commands])
-    script = script.format(shell_vars=shell_vars,
+    script = script.format(shell_vars=shell_vars(env.shell_env),
                            shell_commands=shell_commands)
     return script
 
@@ -335,6 +616,8 @@ class Task(fabric.tasks.Task):
         for key in kwargs:
             setattr(self, key, kwargs[key])
         self.stdout = ''
+        self.output = None
+        self.streamed = False
         self.env_update = None
         self.return_code = None
 
@@ -345,31 +628,103 @@ class Task(fabric.tasks.Task):
         upload it, and execute that. This allows us more control over
         the environment, and is also faster in case many commands are
         executed.
+
+        If the agent is running (see "ravtest run --agent"), it runs the
+        script. The agent has no pty, so neither do these scripts. Tasks
+        with a ``user``, and interactive tasks, are run with a pty, without
+        the agent.
         """
         if commands is None:
             commands = self.commands
         script_name = 'runs/{0}/.ravello/{1}.sh'.format(env.test_id, self.name)
         script = create_script(self.name, commands)
-        fab.put(io.StringIO(script), script_name)
-        runargs = {'shell': False, 'pty': True, 'warn_only': True}
-        show_output = env.debug or (self.interactive and not self.quiet)
-        runargs['quiet'] = not show_output
+        remote_name = 'runs/{0}/.ravello/{1}.env-update' \
+                    .format(env.test_id, self.name)
         if user is None:
             user = self.user
+        agent = getattr(env, 'agent', None)
+        if agent is not None and not user and not self.interactive:
+            self.run_agent(agent, script, script_name, remote_name)
+            return
+        executor = get_executor()
+        with tracing.span('put', 'ssh', remote=script_name):
+            executor.put(io.StringIO(script), script_name)
+        runargs = {'shell': False, 'pty': True, 'warn_only': True}
         if user:
             invoke = 'sudo -u {user} $SHELL -l {script_name}'
         else:
             invoke = 'exec $SHELL -l {script_name}'
         invoke_args = {'user': user, 'script_name': script_name}
         command = invoke.format(**invoke_args)
-        ret = fab.run(command, **runargs)
-        self.stdout = ret
+        if self.interactive:
+            # Interactive tasks are directly connected to the console.
+            runargs['quiet'] = self.quiet and not env.debug
+            with tracing.span('run', 'ssh', command=command):
+                ret = executor.run(command, **runargs)
+            self.stdout = ret
+            self.return_code = ret.return_code
+        else:
+            self.run_streamed(command, runargs)
         update = io.StringIO()
-        remote_name = 'runs/{0}/.ravello/{1}.env-update' \
-                    .format(env.test_id, self.name)
-        fab.get(remote_name, update)
+        with tracing.span('get', 'ssh', remote=remote_name):
+            executor.get(remote_name, update)
         update = parse_env_update(update.getvalue())
         self.env_update = update
+
+    def open_output(self):
+        """Return a :class:`testmill.output.TaskOutput` for the output
+        of this task.
+
+        The output is shown on the console line by line while the task
+        is running, unless the task is quiet or streaming is disabled. If a
+        log directory is configured, the output is logged there as well.
+        Only the last lines of the output are kept in memory.
+        """
+        logdir = getattr(env.args, 'log_dir', None)
+        if logdir:
+            logfile = output.log_file_name(logdir, env.test_id,
+                                           env.vm['name'], self.name)
+        else:
+            logfile = None
+        echo = (env.debug or not self.quiet) and \
+                    not getattr(env.args, 'no_stream', False)
+        return output.TaskOutput(env.output_prefix, echo, logfile,
+                                 lock=env.lock)
+
+    def run_agent(self, agent, script, script_name, remote_name):
+        """Run ``script`` with the agent. This needs only a single round
+        trip, which also returns the env-update file."""
+        stream = self.open_output()
+        try:
+            with tracing.span('run', 'agent', script=script_name):
+                status, update = agent.run(script, script_name, remote_name,
+                                           stream)
+        finally:
+            stream.close()
+        self.output = stream
+        self.streamed = stream.echo
+        self.stdout = stream.getvalue()
+        self.return_code = status
+        self.env_update = parse_env_update(update)
+
+    def run_streamed(self, command, runargs):
+        """Run ``command`` and pass its output through the stream from
+        :meth:`open_output`."""
+        stream = self.open_output()
+        runargs['stdout'] = runargs['stderr'] = stream
+        # Fabric keeps the output in memory as well. Limit this.
+        runargs['capture_buffer_size'] = 4096
+        try:
+            with fab.settings(fab.hide('running', 'warnings'),
+                              fab.show('stdout', 'stderr'),
+                              output_prefix=False), \
+                        tracing.span('run', 'ssh', command=command):
+                ret = get_executor().run(command, **runargs)
+        finally:
+            stream.close()
+        self.output = stream
+        self.streamed = stream.echo
+        self.stdout = stream.getvalue()
         self.return_code = ret.return_code
 
 
@@ -393,6 +748,7 @@ class SysinitTask(Task):
         super(SysinitTask, self).run(commands=commands, user='root')
 
 
+@tracing.traced('task')
 def create_archive():
     ravello_dir = util.get_ravello_dir()
     try:
@@ -411,15 +767,19 @@ def create_archive():
         st = None
     if st and st.st_mtime >= env.start_time:
         return distfile
-    archive = tarfile.TarFile.open(distfile, 'w:gz')
     repotype = env.manifest['repository']['type']
     files = versioncontrol.walk_repository('.', repotype)
+    files = (fname for fname in files if not fname.startswith(ravello_dir))
+    write_archive(distfile, files)
+    return distfile
+
+
+def write_archive(distfile, files):
+    """Write ``files`` to the gzip compressed tar archive ``distfile``."""
+    archive = tarfile.TarFile.open(distfile, 'w:gz')
     for fname in files:
-        if fname.startswith(ravello_dir):
-            continue
         archive.add(fname, recursive=False)
     archive.close()
-    return distfile
 
 
 class DeployTask(Task):
@@ -431,7 +791,8 @@ class DeployTask(Task):
             # creates the archive
             distpath = create_archive()
         remote_dir = 'runs/{0}/.ravello'.format(env.test_id)
-        fab.put(distpath, remote_dir)
+        with tracing.span('put', 'ssh', remote=remote_dir):
+            get_executor().put(distpath, remote_dir)
         _, distname = os.path.split(distpath)
         command = 'tar xpfz .ravello/{0}'.format(distname)
         super(DeployTask, self).run(commands=[command])
@@ -18,7 +18,9 @@ import tempfile
 import shutil
 import argparse
 
+import mock
 from nose import SkipTest
+from testmill import cassette
 from testmill.ravello import RavelloClient
 from testmill.state import env, _Environment
 
@@ -74,6 +76,14 @@ def create_test_environment():
     testenv.service_url = config_var('service_url') or RavelloClient.default_url
     testenv.network_blocking = config_var('network_blocking')
     testenv.sudo_password = config_var('sudo_password')
+    testenv.cassette_dir = config_var('cassette_dir')
+    testenv.cassette_mode = config_var('cassette_mode', 'replay')
+    if testenv.cassette_dir:
+        testenv.cassette_dir = os.path.join(topdir, testenv.cassette_dir)
+    if testenv.cassette_dir and testenv.cassette_mode == 'replay':
+        # Credentials are not recorded, and not needed to replay.
+        testenv.username = testenv.username or 'replay'
+        testenv.password = testenv.password or 'replay'
     testenv.topdir = topdir
     testenv.testdir = testdir
 
@@ -201,12 +211,54 @@ def create_environment(args):
     env.api = RavelloClient(env.username, env.password, env.service_url)
 
 
+def insert_cassette(cls):
+    """Insert the cassette for the test suite ``cls``, if cassettes are
+    enabled in test.cfg. All API requests made by the suite are recorded
+    to it, or replayed from it."""
+    if not testenv.cassette_dir:
+        return
+    if not (getattr(cls, 'integrationtest', False) or
+            getattr(cls, 'systemtest', False)):
+        return
+    fname = '{0}.{1}.json'.format(cls.__module__.split('.')[-1], cls.__name__)
+    fname = os.path.join(testenv.cassette_dir, fname)
+    if testenv.cassette_mode == 'record' and \
+                not os.path.isdir(testenv.cassette_dir):
+        os.makedirs(testenv.cassette_dir)
+    cassette.insert(fname, testenv.cassette_mode)
+    testenv._patchers = []
+    if testenv.cassette_mode == 'replay':
+        # Nothing to wait for when replaying, and the VMs are not there.
+        for name in ('time.sleep',
+                     'testmill.application.wait_until_application_accepts_ssh',
+                     'testmill.application.check_ssh_auth',
+                     'testmill.sshmux.start_masters'):
+            patcher = mock.patch(name, return_value=True)
+            patcher.start()
+            testenv._patchers.append(patcher)
+
+
+def eject_cassette():
+    """Eject the cassette inserted by :func:`insert_cassette`."""
+    if cassette.active() is None:
+        return
+    cassette.eject()
+    for patcher in testenv._patchers:
+        patcher.stop()
+    testenv._patchers = []
+
+
 class TestSuite(object):
     """Base for test suites."""
 
     @classmethod
     def setup_class(cls):
         os.chdir(testenv.testdir)
+        insert_cassette(cls)
+
+    @classmethod
+    def teardown_class(cls):
+        eject_cassette()
 
     def setup(self):
         unittest = getattr(self, 'unittest', False)
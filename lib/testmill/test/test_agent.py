@@ -0,0 +1,158 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import subprocess
+
+import mock
+from nose.tools import assert_raises
+
+from testmill import agent, tasks, error
+from testmill.state import env
+from testmill.test import *
+
+if sys.version_info[0] == 3:
+    import io
+else:
+    import StringIO as io
+
+
+class LocalExecutor(object):
+    """Open channels to local commands, in a temporary home directory."""
+
+    def __init__(self, home):
+        self.home = home
+
+    def open(self, command):
+        environ = os.environ.copy()
+        environ['HOME'] = self.home
+        environ['SHELL'] = '/bin/sh'
+        proc = subprocess.Popen(['/bin/sh', '-c', command], cwd=self.home,
+                                env=environ, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        return tasks._Pipe(proc)
+
+
+@unittest
+class TestAgent(TestSuite):
+    """Test the task agent."""
+
+    def setup(self):
+        super(TestAgent, self).setup()
+        env.debug = False
+        self.agent = agent.start(LocalExecutor(testenv.tempdir))
+        assert self.agent is not None
+
+    def teardown(self):
+        self.agent.close()
+        super(TestAgent, self).teardown()
+
+    def test_run(self):
+        stream = io.StringIO()
+        script = 'echo hello\necho oops >&2\necho X=1 > env-update\nexit 3\n'
+        status, update = self.agent.run(script, 'task.sh', 'env-update',
+                                        stream)
+        assert status == 3
+        assert update == 'X=1\n'
+        assert stream.getvalue() == 'hello\noops\n'
+        with open(os.path.join(testenv.tempdir, 'task.sh')) as fin:
+            assert fin.read() == script
+
+    def test_output(self):
+        # Output without a final newline, and output that looks like the
+        # start of a trailer are passed through.
+        stream = io.StringIO()
+        partial = '\\n{0}'.format(self.agent.token[:10])
+        script = 'printf "a\\nb"\nprintf "{0}"\n'.format(partial)
+        status, update = self.agent.run(script, 'task.sh', stream=stream)
+        assert status == 0
+        assert update == ''
+        assert stream.getvalue() == 'a\nb\n' + self.agent.token[:10]
+        stream = io.StringIO()
+        script = 'seq 100000\n'
+        status, update = self.agent.run(script, 'task.sh', stream=stream)
+        assert stream.getvalue().splitlines()[-1] == '100000'
+
+    def test_setenv(self):
+        self.agent.setenv(tasks.shell_vars({'FOO': "it's"}))
+        stream = io.StringIO()
+        for i in range(3):
+            self.agent.run('echo "$FOO"\n', 'task.sh', stream=stream)
+        assert stream.getvalue() == "it's\n" * 3
+
+    def test_closed(self):
+        self.agent.channel.proc.kill()
+        self.agent.channel.proc.wait()
+        assert_raises(error.ProgramError, self.agent.run, 'true\n', 'x.sh')
+
+    def test_start_failed(self):
+        assert agent.start(object()) is None
+        executor = LocalExecutor(os.path.join(testenv.tempdir, 'nonexistent'))
+        assert agent.start(executor) is None
+
+
+@unittest
+class TestPreinit(TestSuite):
+    """Test the VM pre-initialization, with and without the agent."""
+
+    def setup(self):
+        super(TestPreinit, self).setup()
+        env.debug = False
+        env.test_id = 'abc'
+        env.application = {'id': 1, 'vms': [{'id': 10}]}
+        env.vm = {'id': 10}
+        env.appdef = {}
+        env.api = mock.Mock(url='https://api', _cookie='cookie')
+        env.shell_env = {'FOO': 'bar'}
+        self.executor = mock.Mock()
+        self.agent = mock.Mock()
+        self.agent.run.return_value = (0, '')
+        self.patchers = [mock.patch('testmill.tasks.get_executor',
+                                    return_value=self.executor),
+                         mock.patch('testmill.agent.start',
+                                    return_value=self.agent)]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def teardown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        super(TestPreinit, self).teardown()
+
+    def test_without_agent(self):
+        env.args = mock.Mock(agent=False)
+        tasks.preinit()
+        assert env.agent is None
+        assert self.executor.put.call_args[0][1] == 'abc.preinit'
+        assert self.executor.run.call_args[1]['pty']
+
+    def test_with_agent(self):
+        env.args = mock.Mock(agent=True)
+        tasks.preinit()
+        assert env.agent is self.agent
+        assert self.agent.run.call_args[0][1] == 'abc.preinit'
+        assert not self.executor.put.called
+        assert not self.executor.run.called
+        assert self.agent.setenv.called
+
+    def test_agent_fallback(self):
+        env.args = mock.Mock(agent=True)
+        self.agent.run.return_value = (1, '')
+        tasks.preinit()
+        assert env.agent is self.agent
+        assert self.executor.run.call_args[1]['pty']
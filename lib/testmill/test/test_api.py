@@ -15,14 +15,19 @@
 from __future__ import absolute_import, print_function
 
 import sys
+import json
 import time
 import socket
 import threading
 import pickle
 
+import mock
+
 from nose import SkipTest
 from nose.tools import assert_raises
 from testmill import RavelloClient, RavelloError
+from testmill.ravello import AuthenticationError
+from testmill.ravello import iter_json_array, endpoint_name, _Histogram
 from testmill.state import env
 from testmill.test import *
 from testmill.test import networkblocker
@@ -189,3 +194,214 @@ class TestAPI(TestSuite):
             assert isinstance(blueprint, dict)
             assert 'id' in blueprint
             assert isinstance(blueprint['id'], int)
+
+
+@unittest
+class TestJSONStream(TestSuite):
+    """Test the incremental JSON parser."""
+
+    def split(self, doc, size):
+        return [ doc[i:i+size] for i in range(0, len(doc), size) ]
+
+    def test_array(self):
+        doc = '[{"id": 1, "name": "a"}, {"id": 22}, 333, "x,]", [4, {}],' \
+              ' {"s": "\\"}{[\\\\"}, true, -1.5e3, null]'
+        expected = json.loads(doc)
+        for size in range(1, len(doc)+1):
+            chunks = self.split(doc, size)
+            assert list(iter_json_array(chunks)) == expected
+
+    def test_array_under_key(self):
+        doc = ' { "other": {"key": [1, 2]}, "imageMetadata" : [ {"id": 1},' \
+              ' {"id": 2} ], "more": [3] } '
+        expected = json.loads(doc)['imageMetadata']
+        for size in range(1, len(doc)+1):
+            chunks = self.split(doc, size)
+            result = list(iter_json_array(chunks, 'imageMetadata'))
+            assert result == expected
+
+    def test_empty(self):
+        assert list(iter_json_array(['[', ' ]'])) == []
+        assert list(iter_json_array(['{}'], 'key')) == []
+        assert list(iter_json_array(['{"a": 1}'], 'key')) == []
+
+    def test_incremental(self):
+        # The first element must be available before the rest is read.
+        def chunks():
+            yield '[{"id": 1}, '
+            raise AssertionError('read too far')
+        elements = iter_json_array(chunks())
+        assert next(elements) == {'id': 1}
+
+    def test_decode_once(self):
+        # A value spanning many chunks is only decoded once it is complete.
+        doc = '[{0}]'.format(json.dumps({'key': 'x' * 1000}))
+        decoder = json.JSONDecoder()
+        with mock.patch('json.JSONDecoder.raw_decode',
+                        side_effect=decoder.raw_decode) as raw_decode:
+            result = list(iter_json_array(self.split(doc, 10)))
+        assert result == json.loads(doc)
+        assert raw_decode.call_count == 1
+
+    def test_invalid(self):
+        assert_raises(ValueError, list, iter_json_array(['[1, 2']))
+        assert_raises(ValueError, list, iter_json_array(['{"a": 1}']))
+        assert_raises(ValueError, list, iter_json_array(['[1 2]']))
+
+
+@unittest
+class TestParallel(TestSuite):
+    """Test concurrent API calls."""
+
+    def test_map(self):
+        api = RavelloClient()
+        seen = []
+        def func(client, item):
+            assert client is not api
+            if item == 3:
+                raise ValueError(item)
+            return item * 2
+        def callback(item, result, exc):
+            seen.append(item)
+        results = api.map(func, range(10), jobs=4, callback=callback)
+        assert len(api._pool) == 4
+        assert sorted(seen) == list(range(10))
+        assert [ res[0] for res in results ] == list(range(10))
+        assert results[2] == (2, 4, None)
+        assert isinstance(results[3][2], ValueError)
+        api.map(func, [1, 2], jobs=4)
+        assert len(api._pool) == 4
+        api.close()
+        assert api._pool == []
+
+    def test_start_vms(self):
+        api = RavelloClient()
+        api._make_request = mock.Mock()
+        api._make_request.return_value.status = 404
+        api._make_request.return_value.getheader.return_value = None
+        app = { 'id': 1, 'vms': [ {'id': 10}, {'id': 11}, {'id': 12} ] }
+        api.start_vms(app, app['vms'])
+        urls = sorted(call[0][1] for call in api._make_request.call_args_list)
+        assert urls == ['/applications/1/start',
+                        '/applications/1/vms/10/start',
+                        '/applications/1/vms/11/start',
+                        '/applications/1/vms/12/start']
+        assert not api._bulk_supported
+        api._make_request.reset_mock()
+        api.stop_vms(app, app['vms'][:1])
+        assert api._make_request.call_count == 1
+
+    def test_start_vms_fallback(self):
+        api = RavelloClient()
+        api._make_request = mock.Mock()
+        api._make_request.return_value.status = 404
+        api._make_request.return_value.getheader.return_value = \
+                'Application 1 does not exist'
+        app = { 'id': 1, 'vms': [ {'id': 10}, {'id': 11} ] }
+        api.start_vms(app, app['vms'])
+        assert api._make_request.call_count == 3
+        assert api._bulk_supported
+        error = RavelloError('method not allowed')
+        error.status = 405
+        api._make_request.side_effect = [error, None, None]
+        api.start_vms(app, app['vms'])
+        assert not api._bulk_supported
+
+
+@unittest
+class TestMetrics(TestSuite):
+    """Test the API request metrics."""
+
+    def test_endpoint_name(self):
+        assert endpoint_name('GET', '/applications/12;deployment') == \
+                    'GET /applications/12;deployment'
+        assert endpoint_name('POST', '/applications/12/vms/3/start') == \
+                    'POST /applications/{id}/vms/{id}/start'
+        assert endpoint_name('GET', '/images/123?prefix=x') == \
+                    'GET /images/{id}'
+
+    def test_histogram(self):
+        hist = _Histogram()
+        assert hist.percentile(50) == 0.0
+        for i in range(1, 101):
+            hist.add(i / 100.0)
+        assert hist.count == 100
+        assert hist.max == 1.0
+        for pct in (50, 95, 99):
+            value = hist.percentile(pct)
+            assert pct / 100.0 <= value <= pct / 100.0 * hist.growth
+        assert hist.percentile(100) == 1.0
+
+    def test_make_request(self):
+        api = RavelloClient()
+        api._do_request = mock.Mock()
+        api._make_request('GET', '/applications/1')
+        api._make_request('GET', '/applications/2')
+        api._do_request.side_effect = RavelloError('failed')
+        assert_raises(RavelloError, api._make_request, 'GET',
+                      '/applications/3')
+        summary = api.metrics.summary()
+        stats = summary['GET /applications/{id}']
+        assert stats['calls'] == 3
+        assert stats['errors'] == {'RavelloError': 1}
+        assert stats['p50'] <= stats['max']
+        # Clones share the metrics
+        clone = api._clone()
+        clone.metrics.add_retry('GET /applications/{id}')
+        assert api.metrics.summary()['GET /applications/{id}']['retries'] == 1
+        del api._do_request
+        api2 = pickle.loads(pickle.dumps(api))
+        assert api2.metrics.summary() == {}
+
+    def test_stream_metrics(self):
+        doc = '[{"id": 1}, {"id": 2}, {"id": 3}]'
+        chunks = [doc[:10], doc[10:], '']
+        response = mock.Mock(body=None, endpoint='GET /applications')
+        response.read.side_effect = lambda size: chunks.pop(0)
+        response.getheader.return_value = None
+        api = RavelloClient()
+        api._do_request = mock.Mock(return_value=response)
+        elements = api._iter_request('/applications')
+        assert next(elements) == {'id': 1}
+        # Not recorded until the stream is finished
+        assert api.metrics.summary() == {}
+        assert list(elements) == [{'id': 2}, {'id': 3}]
+        stats = api.metrics.summary()['GET /applications']
+        assert stats['calls'] == 1
+        assert stats['bytes_in'] == len(doc)
+        assert stats['errors'] == {}
+
+
+@unittest
+class TestStatus(TestSuite):
+    """Test how API status codes are mapped to errors."""
+
+    def _response(self, status, reason):
+        response = mock.Mock(status=status, reason=reason, body=b'')
+        response.getheader.side_effect = lambda name, default=None: default
+        return response
+
+    def test_unauthorized(self):
+        api = RavelloClient()
+        api._retry_request = mock.Mock()
+        api._retry_request.return_value = self._response(401, 'Unauthorized')
+        assert_raises(AuthenticationError, api._do_request, 'GET',
+                      '/applications', None, None)
+
+    def test_forbidden(self):
+        api = RavelloClient()
+        api._retry_request = mock.Mock()
+        api._retry_request.return_value = self._response(403, 'Forbidden')
+        try:
+            api._do_request('GET', '/applications', None, None)
+        except RavelloError as e:
+            assert not isinstance(e, AuthenticationError)
+            assert '403' in str(e)
+        else:
+            assert False, 'no error raised'
+
+    def test_iter_request_not_streamed(self):
+        api = RavelloClient()
+        api._make_request = mock.Mock()
+        api._make_request.return_value = self._response(404, 'Not Found')
+        assert_raises(RavelloError, list, api._iter_request('/applications'))
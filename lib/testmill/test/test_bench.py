@@ -0,0 +1,144 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+
+import mock
+
+from testmill import (bench, bench_orchestration, bench_repository,
+                      bench_manifest, bench_api)
+from testmill.test import *
+
+
+@unittest
+class TestBench(TestSuite):
+    """Test the benchmark helpers."""
+
+    def test_summarize(self):
+        stats = bench.summarize([ i / 10.0 for i in range(11) ])
+        assert stats['count'] == 11
+        assert abs(stats['mean'] - 0.5) < 1e-9
+        assert stats['p50'] == 0.5
+        assert stats['max'] == 1.0
+        assert bench.summarize([])['max'] == 0.0
+
+    def test_timed(self):
+        timings = {}
+        with bench.timed(timings, 'a'):
+            pass
+        with bench.timed(timings, 'a'):
+            pass
+        assert list(timings) == ['a']
+        assert timings['a'] >= 0.0
+
+    def test_baseline(self):
+        fname = os.path.join(testenv.tempdir, 'baseline.json')
+        assert bench.load_baseline(fname, 'suite') is None
+        samples = [{'a': {'time': 2.0}, 'b': 'x'}]
+        bench.save_baseline(fname, 'suite', samples, {'hostname': 'h'})
+        bench.save_baseline(fname, 'other', [{'a': {'time': 1.0}}])
+        baseline = bench.load_baseline(fname, 'suite')
+        assert baseline['samples'] == samples
+        assert baseline['environment'] == {'hostname': 'h'}
+        changes = bench.compare([{'a': {'time': 3.0, 'calls': 10}}],
+                                baseline['samples'])
+        assert changes == {'a.time': (2.0, 3.0, 0.5, True)}
+
+    def test_compare_noise(self):
+        baseline = [ {'time': t} for t in (1.0, 1.4, 0.8, 1.2) ]
+        # A 15% slowdown that is well within the noise.
+        samples = [ {'time': t} for t in (1.6, 0.9, 1.4, 1.2) ]
+        changes = bench.compare(samples, baseline, threshold=0.1)
+        assert changes['time'][2] > 0.1
+        assert not changes['time'][3]
+        samples = [ {'time': t} for t in (2.0, 2.1, 1.9, 2.0) ]
+        changes = bench.compare(samples, baseline, threshold=0.1)
+        assert changes['time'][3]
+        # Tiny absolute differences are ignored.
+        changes = bench.compare([{'time': 0.0002}], [{'time': 0.0001}])
+        assert not changes['time'][3]
+
+    def test_main(self):
+        fname = os.path.join(testenv.tempdir, 'baseline.json')
+        history = os.path.join(testenv.tempdir, 'history.jsonl')
+        args = ['-n', '1', '--history', history, 'orchestration']
+        bench.save_baseline(fname, 'orchestration',
+                            [{'wall_time': 0.001}], {})
+        with mock.patch('sys.stdout'):
+            status = bench.main(args + ['--baseline', fname])
+        assert status == 1
+        with mock.patch('sys.stdout'):
+            status = bench.main(args + ['--baseline', fname,
+                                        '--save-baseline', fname])
+        assert status == 1
+        with mock.patch('sys.stdout'):
+            status = bench.main(args + ['--baseline', fname,
+                                        '--threshold', '10'])
+        assert status == 0
+        with file(history) as fin:
+            records = [ json.loads(line) for line in fin ]
+        assert len(records) == 3
+        assert records[0]['regressions'] == ['orchestration:wall_time']
+        assert records[2]['regressions'] == []
+        assert 'python' in records[0]['environment']
+
+    def test_orchestration(self):
+        results = bench_orchestration.run_benchmark(vms=3, tasks_per_vm=2,
+                                                    sync_interval=0.01)
+        assert results['errors'] == 0
+        assert results['startup']['count'] == 3
+        assert results['boundary']['count'] == 3
+        assert results['task']['count'] == 6
+        assert results['wall_time'] > 0
+        assert results['peak_rss'] > 0
+
+    def test_orchestration_local(self):
+        results = bench_orchestration.run_benchmark(vms=2, tasks_per_vm=2,
+                                    executor='local', sync_interval=0.01)
+        assert results['errors'] == 0
+        assert results['task']['count'] == 4
+        results = bench_orchestration.run_benchmark(vms=2, tasks_per_vm=2,
+                                    executor='local', sync_interval=0.01,
+                                    commands=['false'])
+        assert results['errors'] == 2
+        assert results['task']['count'] == 2
+
+    def test_repository(self):
+        results = bench_repository.run_benchmark(files=40, binaries=1,
+                                                 binary_size=1000)
+        # 8 ignored files, and build/ with one binary in it.
+        assert results['ignore']['excluded'] == 10
+        assert results['hash']['files'] > 0
+        assert results['archive']['size'] > 0
+
+    def test_manifest(self):
+        results = bench_manifest.run_benchmark(applications=3, vms=2,
+                                               repeat=1)
+        assert results['size']['vms'] == 6
+        for stage in bench_manifest.stages:
+            assert stage in results
+        assert results['validate_node']['calls'] > 0
+
+    def test_api(self):
+        results = bench_api.run_benchmark(applications=5, vms=2, gets=2,
+                                          transition_time=0.1,
+                                          poll_timeout=0.05,
+                                          wan={'latency': '1ms'})
+        assert results['list']['applications'] == 5
+        assert results['get']['calls'] == 2
+        assert results['start']['time'] >= 0.1
+        assert results['resets'] == 0
@@ -0,0 +1,163 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import mock
+
+from testmill import cache
+from testmill.state import env
+from testmill.test import *
+
+
+def make_apps():
+    return [ {'id': 1, 'name': 'proj:app:1'},
+             {'id': 2, 'name': 'proj:app:2'},
+             {'id': 3, 'name': 'proj:other:1'},
+             {'id': 4, 'name': 'other:app:1'},
+             {'id': 5, 'name': 'not-a-testmill-app'} ]
+
+
+@unittest
+class TestEntityStore(TestSuite):
+    """Test the indexed entity store."""
+
+    def test_find(self):
+        store = cache.EntityStore()
+        store.reload(make_apps())
+        assert store.complete
+        assert len(store) == 5
+        ids = lambda objs: [ obj['id'] for obj in objs ]
+        assert ids(store.find()) == [4, 1, 2, 3]
+        assert ids(store.find('proj')) == [1, 2, 3]
+        assert ids(store.find('proj', 'app')) == [1, 2]
+        assert ids(store.find('proj', 'app', '2')) == [2]
+        assert ids(store.find('proj', 'app', '3')) == []
+        assert ids(store.find(defname='app')) == [4, 1, 2]
+        assert ids(store.find('nope')) == []
+
+    def test_insert_and_delete(self):
+        store = cache.EntityStore()
+        store.reload(make_apps())
+        store.insert({'id': 2, 'name': 'proj:renamed:2', 'vms': []},
+                     detailed=True)
+        assert store.get(name='proj:app:2') is None
+        assert store.get(id=2)['name'] == 'proj:renamed:2'
+        assert store.get(id=2, detailed=True) is not None
+        assert [ app['id'] for app in store.find('proj', 'app') ] == [1]
+        store.delete(2)
+        assert store.get(id=2) is None
+        assert store.get(name='proj:renamed:2') is None
+        assert 2 not in store.detailed
+        assert ('proj', 'renamed') not in store.bydefname
+        store.delete(2)
+        store.delete(1)
+        store.delete(3)
+        assert 'proj' not in store.byproject
+
+
+@unittest
+class TestCache(TestSuite):
+    """Test the cache functions."""
+
+    def setup(self):
+        super(TestCache, self).setup()
+        env.api = mock.Mock()
+        env.api.get_applications.side_effect = make_apps
+        env.api.iter_applications.side_effect = lambda: iter(make_apps())
+        env.api.get_application.side_effect = \
+                lambda id: dict(make_apps()[id-1], vms=[])
+
+    def test_find_applications(self):
+        apps = cache.find_applications('proj', 'app')
+        assert [ app['id'] for app in apps ] == [1, 2]
+        assert env.api.iter_applications.call_count == 1
+        apps = cache.find_applications()
+        assert [ app['id'] for app in apps ] == [4, 1, 2, 3]
+        apps = cache.find_applications('other')
+        assert [ app['id'] for app in apps ] == [4]
+        assert env.api.iter_applications.call_count == 1
+        assert env.api.get_applications.call_count == 0
+
+    def test_iter_applications_abandoned(self):
+        apps = cache.iter_applications('proj')
+        assert next(apps)['id'] == 1
+        apps.close()
+        assert not cache._get_store('applications').complete
+        cache.find_applications('proj')
+        assert env.api.iter_applications.call_count == 2
+        assert cache._get_store('applications').complete
+
+    def test_get_application(self):
+        app = cache.get_application(3)
+        assert app['vms'] == []
+        assert env.api.get_applications.call_count == 0
+        assert cache.get_application(3) is app
+        assert env.api.get_application.call_count == 1
+        assert cache.get_cached_applications() == [app]
+        app = cache.get_application(name='proj:app:1')
+        assert app['id'] == 1
+        assert env.api.get_applications.call_count == 1
+
+    def test_get_application_removed(self):
+        cache.get_applications()
+        env.api.get_application.side_effect = lambda id: None
+        assert cache.get_application(2, force_reload=True) is None
+        names = [ app['name'] for app in cache.get_applications() ]
+        assert 'proj:app:2' not in names
+
+    def test_sync_application(self):
+        def get_application(id):
+            return { 'id': id, 'name': 'proj:app:1', 'totalStartedVms': 0,
+                     'vms': [ {'id': 10, 'name': 'web',
+                               'dynamicMetadata': {'state': states[0]}},
+                              {'id': 11, 'name': 'db',
+                               'dynamicMetadata': {'state': states[1]}} ] }
+        env.api.get_application.side_effect = get_application
+        states = ['STOPPED', 'STOPPED']
+        app = cache.get_application(1)
+        vms = app['vms']
+        seqno = cache.last_change()
+        states[0] = 'STARTING'
+        assert cache.get_application(1, force_reload=True) is app
+        assert app['vms'] is vms
+        assert vms[0]['dynamicMetadata']['state'] == 'STARTING'
+        changes = cache.get_changes(seqno)
+        assert len(changes) == 1
+        assert changes[0][2:] == ('web', 'STOPPED', 'STARTING')
+        seqno = cache.last_change()
+        cache.sync_application(1)
+        assert cache.get_changes(seqno) == []
+        states[:] = ['STARTED', 'STARTED']
+        cache.sync_application(1)
+        changes = cache.get_changes(seqno, 'proj:app:1')
+        assert [ change.vm for change in changes ] == ['web', 'db']
+        assert cache.get_changes(seqno, 'proj:app:2') == []
+        env.api.get_application.side_effect = lambda id: None
+        assert cache.sync_application(1) is None
+        assert cache.get_application(1) is None
+
+    def test_sync_application_vm_fields(self):
+        vm = {'id': 10, 'name': 'web', 'loadingStatus': 'SAVING',
+              'dynamicMetadata': {'state': 'STARTED'}}
+        env.api.get_application.side_effect = \
+                lambda id: {'id': id, 'name': 'proj:app:1', 'vms': [vm]}
+        app = cache.get_application(1)
+        oldvm = app['vms'][0]
+        vm = {'id': 10, 'name': 'web', 'externalIp': '10.0.0.1',
+              'dynamicMetadata': {'state': 'STARTED'}}
+        cache.sync_application(1)
+        assert app['vms'][0] is oldvm
+        assert oldvm['externalIp'] == '10.0.0.1'
+        assert 'loadingStatus' not in oldvm
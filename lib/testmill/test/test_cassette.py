@@ -0,0 +1,65 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+
+from nose.tools import assert_raises
+
+from testmill import cassette, fakeapi, ravello
+from testmill.test import *
+
+
+@unittest
+class TestCassette(TestSuite):
+    """Test recording and replaying API requests."""
+
+    def teardown(self):
+        cassette.eject()
+        super(TestCassette, self).teardown()
+
+    def session(self, url):
+        api = ravello.RavelloClient()
+        api.connect(url)
+        api.login('test', 'test')
+        apps = api.get_applications()
+        app = api.get_application(apps[0]['id'])
+        api.stop_vms(app, app['vms'])
+        apps = [ api.get_application(app['id']) for app in apps ]
+        api.close()
+        return apps
+
+    def test_record_and_replay(self):
+        fake = fakeapi.FakeRavello()
+        fake.populate(applications=3, vms=2)
+        server = fakeapi.start_server(fake)
+        fname = os.path.join(testenv.tempdir, 'cassette.json')
+        with cassette.use(fname, 'record') as tape:
+            recorded = self.session(server.url)
+        server.shutdown()
+        server.server_close()
+        assert len(tape.interactions) == fake.requests
+        with open(fname) as fin:
+            data = json.load(fin)
+        assert 'JSESSIONID=cassette' in json.dumps(data)
+        urls = [ ia['url'] for ia in data['interactions'] ]
+        assert urls[0] == '/services/login'
+        with cassette.use(fname) as tape:
+            replayed = self.session(server.url)
+            api = ravello.RavelloClient()
+            api.connect(server.url)
+            assert_raises(cassette.CassetteError, api.get_blueprints)
+        assert replayed == recorded
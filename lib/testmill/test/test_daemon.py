@@ -0,0 +1,115 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import time
+import socket
+
+import mock
+
+from testmill import daemon
+from testmill.state import env
+from testmill.test import *
+
+
+@unittest
+class TestDaemon(TestSuite):
+    """Test the ravtest daemon."""
+
+    def test_frames(self):
+        s1, s2 = socket.socketpair()
+        daemon.write_frame(s1, daemon.FRAME_STDOUT, b'foo')
+        daemon.write_frame(s1, daemon.FRAME_EXIT)
+        assert daemon.read_frame(s2) == (daemon.FRAME_STDOUT, b'foo')
+        assert daemon.read_frame(s2) == (daemon.FRAME_EXIT, b'')
+        s1.close()
+        try:
+            daemon.read_frame(s2)
+        except EOFError:
+            pass
+        else:
+            assert False, 'EOFError not raised'
+        s2.close()
+
+    def test_should_forward(self):
+        assert daemon.should_forward(['ps', '-a'])
+        assert daemon.should_forward(['-u', 'user', 'run', 'app'])
+        assert not daemon.should_forward(['run', '-i', 'app'])
+        assert not daemon.should_forward(['ssh', 'app', 'vm'])
+        assert not daemon.should_forward(['login'])
+        assert not daemon.should_forward(['clean'])
+        assert daemon.should_forward(['-y', 'clean'])
+        assert not daemon.should_forward(['--help'])
+        assert not daemon.should_forward(['--version', 'ps'])
+
+    def test_do_not_forward_from_worker(self):
+        env._daemon_worker = True
+        assert not daemon.should_forward(['ps'])
+
+    def run_request(self, argv):
+        s1, s2 = socket.socketpair()
+        request = {'argv': argv, 'environ': dict(os.environ),
+                   'cwd': os.getcwd()}
+        daemon.run_request(s1, request, None)
+        s1.close()
+        output = {daemon.FRAME_STDOUT: b'', daemon.FRAME_STDERR: b''}
+        while True:
+            typ, data = daemon.read_frame(s2)
+            if typ == daemon.FRAME_EXIT:
+                break
+            output[typ] += data
+        s2.close()
+        status = json.loads(data.decode())
+        return status, output[daemon.FRAME_STDOUT], \
+                    output[daemon.FRAME_STDERR]
+
+    def test_help(self):
+        status, stdout, stderr = self.run_request(['ps', '--help'])
+        assert status == 0
+        assert b'usage: ravtest' in stdout + stderr
+
+    def test_usage_error(self):
+        status, stdout, stderr = self.run_request(['ps', '--no-such-option'])
+        assert status != 0
+        assert stderr
+
+    def test_login_in_handler(self):
+        # A slow login must not hold up the daemon.
+        def create_session(args):
+            time.sleep(1)
+            return {'api': None, 'created': time.time()}
+        server = daemon.Daemon(os.path.join(testenv.tempdir, 'sock'))
+        server.listener = socket.socket(socket.AF_UNIX)
+        s1, s2 = socket.socketpair()
+        request = {'argv': ['ps'], 'environ': {}, 'cwd': os.getcwd()}
+        daemon.write_frame(s1, daemon.FRAME_REQUEST,
+                           json.dumps(request).encode())
+        with mock.patch('testmill.daemon.create_session', create_session), \
+                    mock.patch('testmill.daemon.run_request',
+                               return_value=0):
+            t1 = time.time()
+            server.handle_connection(s2)
+            assert time.time() - t1 < 0.5
+            assert server.get_session(request) is None
+            while server.pending:
+                for fd in list(server.pending):
+                    server.read_session(fd)
+        assert server.get_session(request)['api'] is None
+        for pid in server.children:
+            os.waitpid(pid, 0)
+        s1.close(); s2.close()
+        server.listener.close()
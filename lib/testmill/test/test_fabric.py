@@ -31,6 +31,7 @@ class TestFabric(TestSuite):
 
     @classmethod
     def setup_class(cls):
+        super(TestFabric, cls).setup_class()
         fab.env.ravello_api_user = testenv.username
         fab.env.ravello_api_password = testenv.password
         testenv.app_name = None
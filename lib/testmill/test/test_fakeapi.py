@@ -0,0 +1,88 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+from nose.tools import assert_raises
+
+from testmill import fakeapi, ravello
+from testmill.test import *
+
+
+@unittest
+class TestFakeAPI(TestSuite):
+    """Test the fake Ravello API."""
+
+    def setup(self):
+        super(TestFakeAPI, self).setup()
+        self.now = 1000.0
+        self.fake = fakeapi.FakeRavello(clock=lambda: self.now)
+        self.server = fakeapi.start_server(self.fake)
+        self.api = ravello.RavelloClient(service_url=self.server.url)
+        self.api.connect(self.server.url)
+        self.api.login('test', 'test')
+
+    def teardown(self):
+        self.api.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestFakeAPI, self).teardown()
+
+    def vm_states(self, app):
+        app = self.api.get_application(app['id'])
+        return [ vm['dynamicMetadata']['state'] for vm in app['vms'] ]
+
+    def test_login(self):
+        assert self.api._project in self.fake.projects
+        api = ravello.RavelloClient(service_url=self.server.url)
+        api.connect(self.server.url)
+        assert_raises(ravello.AuthenticationError, api.login, 'test', 'bad')
+        api = ravello.RavelloClient(service_url=self.server.url,
+                                    token='JSESSIONID=invalid')
+        api.connect(self.server.url)
+        assert_raises(ravello.AuthenticationError, api.login)
+
+    def test_listings(self):
+        self.fake.populate(applications=20, vms=2, images=3)
+        apps = self.api.get_applications(prefix='bench:')
+        assert len(apps) == 20
+        app = self.api.get_application(apps[0]['id'])
+        assert len(app['vms']) == 2
+        assert app['totalStartedVms'] == 2
+        assert len(self.api.get_images(public=False)) == 3
+        assert self.api.get_application(1) is None
+
+    def test_lifecycle(self):
+        image = self.fake.add_image('ubuntu')
+        vm = ravello.update_luids(self.api.get_image(image['id']))
+        vm['name'] = 'vm1'
+        app = self.api.create_application({'name': 'proj:app:1',
+                                           'vms': [vm]})
+        assert app['name'] == 'proj:app:1'
+        self.api.publish_application(app)
+        assert self.vm_states(app) == ['PUBLISHING']
+        self.now += self.fake.publish_time
+        assert self.vm_states(app) == ['STARTING']
+        self.now += self.fake.start_time
+        assert self.vm_states(app) == ['STARTED']
+        app = self.api.get_application(app['id'])
+        self.api.stop_vms(app, app['vms'])
+        assert self.vm_states(app) == ['STOPPING']
+        self.now += self.fake.stop_time
+        assert self.vm_states(app) == ['STOPPED']
+        bp = self.api.create_blueprint('bp', app)
+        assert self.api.get_blueprint(bp['id'])['vms'][0]['loadingStatus'] \
+                    == 'SAVING'
+        self.api.remove_application(app)
+        assert self.api.get_application(app['id']) is None
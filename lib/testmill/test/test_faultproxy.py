@@ -0,0 +1,138 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import time
+import socket
+
+from nose.tools import assert_raises
+
+from testmill import fakeapi, faultproxy, ravello
+from testmill.test import *
+
+
+@unittest
+class TestFaultProxy(TestSuite):
+    """Test the fault injection proxy."""
+
+    def setup(self):
+        super(TestFaultProxy, self).setup()
+        self.fake = fakeapi.FakeRavello()
+        self.fake.populate(applications=20, vms=2)
+        self.server = fakeapi.start_server(self.fake)
+        self.proxy = faultproxy.FaultProxy(self.server.url).start()
+        self.api = ravello.RavelloClient(service_url=self.proxy.url,
+                                         retries=3)
+        self.api.connect(self.proxy.url)
+        self.api.login('test', 'test')
+
+    def teardown(self):
+        self.api.close()
+        self.proxy.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestFaultProxy, self).teardown()
+
+    def disconnect(self):
+        # Unlike close(), this keeps the session.
+        self.api.connection.close()
+        self.api.connection = None
+
+    def test_parse_latency(self):
+        assert faultproxy.parse_latency('50ms')() == 0.05
+        assert faultproxy.parse_latency(0.2)() == 0.2
+        value = faultproxy.parse_latency('uniform:10ms,20ms')()
+        assert 0.01 <= value <= 0.02
+        assert faultproxy.parse_latency('normal:1s,1s')() >= 0
+        assert faultproxy.parse_latency('exponential:10ms')() >= 0
+        assert_raises(ValueError, faultproxy.parse_latency, 'normal:1s')
+        assert faultproxy.parse_size('64k') == 65536
+        assert faultproxy.parse_size('1.5m') == 1572864
+
+    def test_proxy(self):
+        apps = self.api.get_applications()
+        assert len(apps) == 20
+        assert self.proxy.connections == 1
+        assert self.proxy.bytes_down > 0 and self.proxy.bytes_up > 0
+
+    def test_latency(self):
+        self.api.hello()
+        with self.proxy.conditions(latency='50ms'):
+            t1 = time.time()
+            self.api.hello()
+            elapsed = time.time() - t1
+        assert elapsed >= 0.1
+        t1 = time.time()
+        self.api.hello()
+        assert time.time() - t1 < 0.1
+
+    def test_bandwidth(self):
+        self.api.hello()
+        bandwidth = 64 * 1024
+        nbytes = self.proxy.bytes_down
+        throttled = self.proxy.throttled_down
+        with self.proxy.conditions(bandwidth=bandwidth):
+            t1 = time.time()
+            self.api.get_applications()
+            elapsed = time.time() - t1
+        nbytes = self.proxy.bytes_down - nbytes
+        throttled = self.proxy.throttled_down - throttled
+        # Check against the proxy's own accounting rather than against
+        # wall clock time alone, which is unreliable on a loaded machine.
+        assert nbytes > 0
+        assert abs(throttled - float(nbytes) / bandwidth) < 1e-6
+        # The response is held back at least that long.
+        assert elapsed >= throttled * 0.9
+
+    def test_reset_is_retried(self):
+        self.api.hello()
+        # Reset the keep-alive connection, and the one after.
+        self.api.connection.sock.shutdown(socket.SHUT_RDWR)
+        self.proxy.reset_next(1)
+        apps = self.api.get_applications()
+        assert len(apps) == 20
+        assert self.api._total_retries >= 1
+        assert self.proxy.resets == 1
+
+    def test_request_after_close(self):
+        # close() drops the session. The next request logs in again.
+        self.api.close()
+        assert len(self.api.get_applications()) == 20
+
+    def test_reset_gives_up(self):
+        self.disconnect()
+        with self.proxy.conditions(reset_rate=1.0):
+            assert_raises(ravello.RavelloError, self.api.get_applications)
+        assert self.api._total_retries == 3
+        summary = self.api.metrics.summary()
+        assert summary['GET /applications']['retries'] == 3
+
+    def test_reset_mid_response(self):
+        self.disconnect()
+        self.proxy.set(reset_rate=1.0, reset_after=100)
+        # Every retry is reset as well.
+        assert_raises(ravello.RavelloError, self.api.get_applications)
+        self.proxy.set(reset_rate=0.0)
+        assert len(self.api.get_applications()) == 20
+
+    def test_handshake_delay(self):
+        self.disconnect()
+        self.proxy.set(handshake_delay=0.1, handshake_rounds=1)
+        t1 = time.time()
+        self.api.hello()
+        assert time.time() - t1 >= 0.1
+        t1 = time.time()
+        self.api.hello()
+        assert time.time() - t1 < 0.1
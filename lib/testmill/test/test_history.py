@@ -0,0 +1,103 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+from xml.etree import ElementTree
+
+import mock
+
+from testmill import history
+from testmill.test import *
+
+
+def make_task(name, duration, exit_code=0):
+    return {'name': name, 'start': 100.0, 'end': 100.0 + duration,
+            'duration': duration, 'exit_code': exit_code,
+            'output_bytes': 10, 'output_lines': 1}
+
+
+@unittest
+class TestHistory(TestSuite):
+    """Test the run history."""
+
+    def setup(self):
+        super(TestHistory, self).setup()
+        self.patcher = mock.patch('testmill.util.get_config_dir',
+                                  return_value=testenv.tempdir)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+        fname = history.history_file()
+        if os.path.exists(fname):
+            os.unlink(fname)
+        super(TestHistory, self).teardown()
+
+    def create_record(self, test_id, errors=0):
+        app = {'id': 1, 'name': 'proj:app:1'}
+        appdef = {'name': 'app'}
+        results = {'vm1': [make_task('sysinit', 20), make_task('execute', 5)],
+                   'vm2': [make_task('sysinit', 30),
+                           make_task('execute', 2, errors)]}
+        phases = {'create': 1.0, 'wait': 60.0, 'tasks': 40.0}
+        return history.create_record(test_id, app, appdef, 'proj', 100.0,
+                                     201.0, phases, results, errors)
+
+    def test_create_record(self):
+        record = self.create_record('abc')
+        assert record['status'] == 'passed'
+        assert record['duration'] == 101.0
+        assert record['phases']['sysinit'] == 30
+        assert record['phases']['execute'] == 5
+        names = [ name for name,secs in history.get_phases(record) ]
+        assert names == ['create', 'wait', 'tasks', 'sysinit', 'execute']
+
+    def test_create_record_aborted(self):
+        appdef = {'name': 'app'}
+        record = history.create_record('abc', None, appdef, 'proj', 100.0,
+                                       130.0, {'create': 30.0}, {}, None,
+                                       'create')
+        assert record['status'] == 'error'
+        assert record['failed_phase'] == 'create'
+        assert record['instance'] is None
+        assert record['errors'] == 0
+        assert history.get_phases(record) == [('create', 30.0)]
+
+    def test_save_and_find(self):
+        assert history.get_records() == []
+        for i in range(5):
+            history.save_record(self.create_record('id{0}'.format(i)))
+        with open(history.history_file(), 'a') as fout:
+            fout.write('{"test_id": "partial')
+        records = history.get_records(2)
+        assert [ r['test_id'] for r in records ] == ['id3', 'id4']
+        assert len(history.get_records()) == 5
+        assert history.find_record('id2')['test_id'] == 'id2'
+        assert history.find_record('id')['test_id'] == 'id4'
+        assert history.find_record('other') is None
+
+    def test_junit(self):
+        record = self.create_record('abc', errors=1)
+        root = ElementTree.fromstring(history.to_junit(record))
+        assert root.tag == 'testsuites'
+        assert root.get('tests') == '4'
+        assert root.get('failures') == '1'
+        suites = root.findall('testsuite')
+        assert [ s.get('name') for s in suites ] == ['vm1', 'vm2']
+        cases = suites[1].findall('testcase')
+        assert cases[0].find('failure') is None
+        failure = cases[1].find('failure')
+        assert failure.get('message') == 'Task exited with status 1.'
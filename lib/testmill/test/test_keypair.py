@@ -21,6 +21,7 @@ from nose.tools import assert_raises
 import stat
 from testmill.test import *
 from testmill import keypair, util
+from testmill.state import env
 
 
 @integrationtest
@@ -63,3 +64,18 @@ class TestKeypair(TestSuite):
             pubkey = keypair.load_keypair()
         assert 'id' in pubkey
         assert 'name' in pubkey
+
+
+@unittest
+class TestCheckKeypair(TestSuite):
+
+    def test_check_keypair(self):
+        env.public_key = {'id': 1, 'name': 'key1'}
+        env.api = mock.Mock()
+        env.api.get_pubkeys.return_value = [{'id': 1, 'name': 'key1'}]
+        with mock.patch('testmill.login.update_session') as update:
+            assert keypair.check_keypair()
+            assert not update.called
+            env.api.get_pubkeys.return_value = [{'id': 2, 'name': 'key2'}]
+            assert not keypair.check_keypair()
+            update.assert_called_once_with(pubkey=None)
@@ -0,0 +1,73 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+
+import mock
+from nose import SkipTest
+
+from testmill import lease
+from testmill.state import env
+from testmill.test import *
+
+
+@unittest
+class TestLease(TestSuite):
+    """Test application leases."""
+
+    def setup(self):
+        super(TestLease, self).setup()
+        if lease.fcntl is None:
+            raise SkipTest('leases are not supported on this platform')
+        env.debug = False
+        self.patcher = mock.patch('testmill.util.get_config_dir',
+                                  return_value=testenv.tempdir)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+        for fd in getattr(env, '_leases', {}).values():
+            os.close(fd)
+        super(TestLease, self).teardown()
+
+    def test_acquire(self):
+        app = {'id': 1, 'name': 'proj:app:1'}
+        assert lease.acquire(app)
+        assert lease.acquire(app)
+        assert not lease.is_leased(app)
+        # A different file description conflicts, like another process.
+        assert lease._lock(app) is None
+        lease.release(app)
+        assert not lease.is_leased(app)
+        fd = lease._lock(app)
+        assert fd is not None
+        # Pretend that our parent holds the lease.
+        os.write(fd, '{0}\n'.format(os.getppid()).encode('ascii'))
+        assert lease.is_leased(app)
+        assert not lease.acquire(app)
+        os.close(fd)
+        assert lease.acquire(app)
+
+    def test_is_leased_stale(self):
+        app = {'id': 2, 'name': 'proj:app:2'}
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        fname = os.path.join(lease.lease_dir(), '2.lease')
+        with open(fname, 'w') as fout:
+            fout.write('{0}\n'.format(pid))
+        assert not lease.is_leased(app)
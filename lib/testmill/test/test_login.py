@@ -14,9 +14,12 @@
 
 from __future__ import absolute_import, print_function
 
+import time
 import mock
 
+from testmill import login
 from testmill.main import main
+from testmill.ravello import RavelloClient
 from testmill.state import env
 from testmill.test import *
 
@@ -45,3 +48,48 @@ class TestLogin(TestSuite):
         status = main(['-u', testenv.username, '-p', 'invalid',
                        '-s', testenv.service_url, 'login'])
         assert status != 0
+
+
+@unittest
+class TestSession(TestSuite):
+    """Test the session metadata cache."""
+
+    def test_update_and_load(self):
+        tmphome = tempdir()
+        env.api = RavelloClient(token='token1')
+        with mock.patch('testmill.util.get_config_dir', lambda: tmphome):
+            assert login.load_session() is None
+            login.update_session(project=10)
+            login.update_session(pubkey={'id': 20})
+            session = login.load_session()
+            assert session['project'] == 10
+            assert session['pubkey'] == {'id': 20}
+            assert login.load_session(token='token1') == session
+
+    def test_other_credentials(self):
+        tmphome = tempdir()
+        env.api = RavelloClient(token='token1')
+        with mock.patch('testmill.util.get_config_dir', lambda: tmphome):
+            login.update_session(project=10)
+            assert login.load_session(token='token2') is None
+            assert login.load_session(username='user') is None
+            env.api = RavelloClient(service_url='http://localhost/',
+                                    token='token1')
+            assert login.load_session() is None
+
+    def test_expired(self):
+        tmphome = tempdir()
+        env.api = RavelloClient(token='token1')
+        with mock.patch('testmill.util.get_config_dir', lambda: tmphome):
+            login.update_session(project=10)
+            login.update_session(expires=time.time() - 1)
+            assert login.load_session() is None
+
+    def test_remove(self):
+        tmphome = tempdir()
+        env.api = RavelloClient(token='token1')
+        with mock.patch('testmill.util.get_config_dir', lambda: tmphome):
+            login.update_session(project=10)
+            login.remove_session()
+            assert login.load_session() is None
+            login.remove_session()
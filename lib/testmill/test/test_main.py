@@ -0,0 +1,77 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import subprocess
+
+from testmill import main
+from testmill.test import *
+
+
+# Modules that are expensive to import, and that should not be loaded
+# until a sub-command that needs them is dispatched.
+heavy_modules = ('fabric', 'paramiko', 'yaml', 'multiprocessing',
+                 'testmill.tasks', 'testmill.application')
+
+
+def imported_modules(code):
+    """Run ``code`` in a fresh interpreter and return the set of modules
+    that are loaded afterwards, and the time it took in seconds."""
+    script = 'import sys, time\n' \
+             't1 = time.time()\n' \
+             '{0}\n' \
+             't2 = time.time()\n' \
+             'sys.stdout.write(repr((t2-t1, sorted(sys.modules))))\n' \
+             .format(code)
+    environ = os.environ.copy()
+    environ['PYTHONPATH'] = os.path.join(testenv.topdir, 'lib')
+    child = subprocess.Popen([sys.executable, '-c', script], env=environ,
+                             stdout=subprocess.PIPE)
+    stdout, _ = child.communicate()
+    assert child.returncode == 0
+    elapsed, modules = eval(stdout)
+    return elapsed, set(modules)
+
+
+@unittest
+class TestMain(TestSuite):
+    """Test the main entry point."""
+
+    def test_import_main(self):
+        elapsed, modules = imported_modules('import testmill.main')
+        for modname in heavy_modules:
+            assert modname not in modules, modname
+        print('import testmill.main: {0:.3f} secs'.format(elapsed))
+
+    def test_version_does_not_load_subcommands(self):
+        code = 'import testmill.main\n' \
+               'try:\n' \
+               '    testmill.main.main(["--version"])\n' \
+               'except SystemExit:\n' \
+               '    pass'
+        elapsed, modules = imported_modules(code)
+        for modname in heavy_modules:
+            assert modname not in modules, modname
+        for name in main.subcommands:
+            assert main.subcommands[name][0] not in modules
+        print('ravtest --version: {0:.3f} secs'.format(elapsed))
+
+    def test_load_subcommand(self):
+        for name in main.subcommands:
+            command, add_args = main.load_subcommand(name)
+            assert callable(command)
+            assert callable(add_args)
@@ -0,0 +1,87 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import sys
+
+if sys.version_info[0] == 3:
+    import io
+else:
+    import StringIO as io
+
+from testmill import output
+from testmill.test import *
+
+
+@unittest
+class TestTaskOutput(TestSuite):
+    """Test streaming task output."""
+
+    def test_lines(self):
+        out = output.TaskOutput(tail=3)
+        out.write('line 1\r\nli')
+        out.write('ne 2\r\n')
+        assert list(out.lines) == ['line 1', 'line 2']
+        out.write('line 3\nline 4\nline')
+        assert out.getvalue() == 'line 2\nline 3\nline 4\nline'
+        out.close()
+        assert list(out.lines) == ['line 3', 'line 4', 'line']
+        assert out.total_lines == 5
+        assert out.omitted_lines == 2
+
+    def test_carriage_return(self):
+        out = output.TaskOutput()
+        out.write('10%\r20%\r')
+        assert list(out.lines) == ['10%']
+        assert out.getvalue() == '10%\n20%'
+        out.write('\ndone\r\n')
+        assert list(out.lines) == ['10%', '20%', 'done']
+
+    def test_long_line(self):
+        out = output.TaskOutput()
+        size = output.max_line_length
+        out.write('x' * size)
+        assert out.total_lines == 0
+        out.write('xx')
+        assert out.total_lines == 1
+        assert out.partial == ''
+        assert len(out.lines[0]) == size + 2
+
+    def test_echo(self):
+        stdout = io.StringIO()
+        saved, sys.stdout = sys.stdout, stdout
+        try:
+            out = output.TaskOutput('web | ', echo=True)
+            out.write('foo\nba')
+            assert stdout.getvalue() == 'web | foo\n'
+            out.close()
+        finally:
+            sys.stdout = saved
+        assert stdout.getvalue() == 'web | foo\nweb | ba\n'
+
+    def test_logfile(self):
+        logfile = output.log_file_name(testenv.tempdir, 'test', 'web', 'exec')
+        out = output.TaskOutput(logfile=logfile, tail=1)
+        for i in range(10):
+            out.write('line {0}\n'.format(i))
+        out.close()
+        with open(logfile) as fin:
+            assert len(fin.readlines()) == 10
+        assert out.getvalue() == 'line 9'
+
+    def test_prefix(self):
+        assert output.format_prefix('web', width=5, color=False) == 'web   | '
+        prefix = output.format_prefix('db', 1, color=True)
+        assert prefix.startswith('\033[36m')
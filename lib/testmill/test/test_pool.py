@@ -0,0 +1,63 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import mock
+
+from testmill import pool
+from testmill.state import env
+from testmill.test import *
+
+
+@unittest
+class TestPool(TestSuite):
+    """Test the warm pool."""
+
+    def setup(self):
+        super(TestPool, self).setup()
+        env.quiet = True
+        self.apps = [ {'id': 1, 'name': 'proj:app:1'},
+                      {'id': 2, 'name': 'proj:app:2'} ]
+        patcher = mock.patch.multiple('testmill.application',
+                    find_reusable_applications=lambda appdef: self.apps,
+                    create_new_application=self.create,
+                    publish_application=lambda app: app)
+        patcher.start()
+        self.patcher = patcher
+        self.lease_patcher = mock.patch('testmill.lease.is_leased',
+                                        lambda app: app['id'] == 4)
+        self.lease_patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+        self.lease_patcher.stop()
+        super(TestPool, self).teardown()
+
+    def create(self, appdef):
+        appid = len(self.apps) + 1
+        app = {'id': appid, 'name': 'proj:app:{0}'.format(appid)}
+        self.apps.append(app)
+        return app
+
+    def test_fill_pool(self):
+        assert pool.fill_pool({'name': 'app'}, 2) == []
+        created = pool.fill_pool({'name': 'app'}, 3)
+        assert [ app['id'] for app in created ] == [3]
+        created = pool.fill_pool({'name': 'app'}, 3, exclude=[1])
+        assert [ app['id'] for app in created ] == [4]
+        # Instance 4 is leased by another process.
+        assert len(pool.get_pool({'name': 'app'})) == 3
+        created = pool.fill_pool({'name': 'app'}, 3, exclude=[1])
+        assert [ app['id'] for app in created ] == [5]
@@ -30,6 +30,7 @@ class TestPS(TestSuite):
 
     @classmethod
     def setup_class(cls):
+        super(TestPS, cls).setup_class()
         args = get_common_args()
         args += ['-m', 'platformtest.yml', 'run', 'platformtest', '--dry-run']
         with env.new():  # do not pollute test-global env
@@ -56,6 +57,7 @@ class TestPS(TestSuite):
         args += ['-m', 'platformtest.yml', '-y', 'clean', '-b']
         with env.new():
             main(args)
+        super(TestPS, cls).teardown_class()
 
     def test_ps(self):
         stdout = compat.StringIO()
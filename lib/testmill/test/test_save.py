@@ -28,6 +28,7 @@ class TestSave(TestSuite):
 
     @classmethod
     def setup_class(cls):
+        super(TestSave, cls).setup_class()
         args = get_common_args()
         args += ['-m', 'platformtest.yml', 'run', 'platformtest', '--dry-run']
         with env.new():  # do not pollute test-global env
@@ -59,3 +60,4 @@ class TestSave(TestSuite):
         args += ['-m', 'platformtest.yml', '-y', 'clean', '-b']
         with env.new():
             main(args)
+        super(TestSave, cls).teardown_class()
@@ -31,6 +31,7 @@ class TestSSH(TestSuite):
 
     @classmethod
     def setup_class(cls):
+        super(TestSSH, cls).setup_class()
         args = get_common_args()
         args += ['-m', 'platformtest.yml', 'run', 'platformtest', '--dry-run']
         with env.new():  # do not pollute global test env
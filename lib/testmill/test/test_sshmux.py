@@ -0,0 +1,142 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import time
+
+import mock
+from nose.tools import assert_raises
+
+from testmill import sshmux, application, error
+from testmill.state import env
+from testmill.test import *
+
+
+real_ssh = sshmux._ssh
+
+
+@unittest
+class TestSSHMux(TestSuite):
+    """Test the multiplexed ssh connections."""
+
+    def setup(self):
+        super(TestSSHMux, self).setup()
+        env._openssh = '/usr/bin/ssh'
+        env.private_key_file = 'id_ravello'
+        patcher = mock.patch('testmill.util.get_config_dir',
+                             return_value=testenv.tempdir)
+        patcher.start()
+        self.patchers = [patcher]
+        patcher = mock.patch('testmill.sshmux._ssh', return_value=0)
+        self.ssh = patcher.start()
+        self.patchers.append(patcher)
+
+    def teardown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        super(TestSSHMux, self).teardown()
+
+    def test_control_path(self):
+        path = sshmux.control_path('10.0.0.1')
+        dirname, fname = os.path.split(path)
+        assert len(fname) == 16
+        assert os.stat(dirname).st_mode & 0o777 == 0o700
+        assert sshmux.control_path('10.0.0.2') != path
+        assert sshmux.control_path('10.0.0.1', 'root') != path
+
+    def test_ssh_options(self):
+        options = sshmux.ssh_options('10.0.0.1', persist=60)
+        assert 'ControlMaster=auto' in options
+        assert 'ControlPersist=60' in options
+        path = sshmux.control_path('10.0.0.1')
+        assert 'ControlPath={0}'.format(path) in options
+        env._openssh = None
+        options = sshmux.ssh_options('10.0.0.1')
+        assert 'ControlMaster=auto' not in options
+        assert 'id_ravello' in options
+
+    def test_start_master(self):
+        assert sshmux.start_master('10.0.0.1')
+        argv = self.ssh.call_args[0][0]
+        assert argv[-4:] == ['-M', '-N', '-f', 'ravello@10.0.0.1']
+        # A running master is reused.
+        open(sshmux.control_path('10.0.0.1'), 'w').close()
+        self.ssh.reset_mock()
+        assert sshmux.start_master('10.0.0.1')
+        assert self.ssh.call_count == 1
+        assert '-O' in self.ssh.call_args[0][0]
+        sshmux.stop_master('10.0.0.1')
+        assert self.ssh.call_args[0][0][-2:] == ['exit', '10.0.0.1']
+
+    def test_start_masters_reaped(self):
+        proc = mock.Mock()
+        proc.poll.return_value = None
+        self.ssh.return_value = proc
+        sshmux.start_masters(['10.0.0.1', '10.0.0.2'])
+        assert env._master_procs == [proc, proc]
+        proc.poll.return_value = 0
+        self.ssh.return_value = 0
+        assert not sshmux.master_running('10.0.0.3')
+        assert env._master_procs == []
+
+    def test_not_supported(self):
+        env._openssh = None
+        assert not sshmux.start_master('10.0.0.1')
+        assert not sshmux.master_running('10.0.0.1')
+        assert self.ssh.call_count == 0
+
+    def test_check_ssh_auth(self):
+        assert application.check_ssh_auth('10.0.0.1')
+        argv = self.ssh.call_args[0][0]
+        assert argv[-2] == 'ravello@10.0.0.1'
+        assert argv[-1].startswith('test ')
+        self.ssh.return_value = 255
+        assert not application.check_ssh_auth('10.0.0.1')
+
+    def test_ssh_timeout(self):
+        env._openssh = '/bin/sleep'
+        env.debug = False
+        t1 = time.time()
+        assert real_ssh(['10'], timeout=0.2) != 0
+        assert time.time() - t1 < 5
+
+    def test_wait_for_ssh_auth_timeout(self):
+        app = {'vms': [{'name': 'vm1',
+                        'dynamicMetadata': {'externalIp': '10.0.0.1'}}]}
+        def check_ssh_auth(addr):
+            time.sleep(3)
+            return True
+        with mock.patch('testmill.application.check_ssh_auth',
+                        check_ssh_auth), \
+                    mock.patch('testmill.keypair.check_keypair',
+                               return_value=True), \
+                    mock.patch('testmill.console.show_progress'):
+            t1 = time.time()
+            assert_raises(error.ProgramError,
+                          application.wait_until_application_accepts_ssh_auth,
+                          app, ['vm1'], timeout=0.5, poll_timeout=0.1)
+            assert time.time() - t1 < 2
+
+    def test_ssh_command(self):
+        argv = sshmux.ssh_command('10.0.0.1', 'ls', tty=True)
+        assert argv[0] == '/usr/bin/ssh'
+        assert argv[-3:] == ['-tt', 'ravello@10.0.0.1', 'ls']
+        argv = sshmux.scp_command('/tmp/x', '10.0.0.1:runs')
+        assert argv[-2:] == ['/tmp/x', 'ravello@10.0.0.1:runs']
+        argv = sshmux.scp_command('10.0.0.1:runs/y', '/tmp/y')
+        assert argv[-2:] == ['ravello@10.0.0.1:runs/y', '/tmp/y']
+        # These never start a master, which would keep their pipes open.
+        assert 'ControlMaster=no' in argv
@@ -0,0 +1,101 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+
+import mock
+from nose.tools import assert_raises
+
+from testmill import tasks, error
+from testmill.test import *
+
+if sys.version_info[0] == 3:
+    import io
+else:
+    import StringIO as io
+
+
+def local_command(host, command, user=None, tty=False):
+    return ['/bin/sh', '-c', command]
+
+def local_copy(source, dest, user=None):
+    return ['cp', source.split(':')[-1], dest.split(':')[-1]]
+
+
+@unittest
+class TestOpenSSHExecutor(TestSuite):
+    """Test the OpenSSH transport, with local commands instead of ssh."""
+
+    def setup(self):
+        super(TestOpenSSHExecutor, self).setup()
+        self.patchers = [mock.patch('testmill.sshmux.ssh_command',
+                                    local_command),
+                         mock.patch('testmill.sshmux.scp_command',
+                                    local_copy)]
+        for patcher in self.patchers:
+            patcher.start()
+        patcher = mock.patch('testmill.sshmux.start_master')
+        self.start_master = patcher.start()
+        self.patchers.append(patcher)
+        self.executor = tasks.OpenSSHExecutor()
+
+    def teardown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        super(TestOpenSSHExecutor, self).teardown()
+
+    def test_put_get(self):
+        remote = os.path.join(testenv.tempdir, 'script.sh')
+        self.executor.put(io.StringIO(u'echo hello\n'), remote)
+        with open(remote) as fin:
+            assert fin.read() == 'echo hello\n'
+        local = os.path.join(testenv.tempdir, 'copy.sh')
+        self.executor.get(remote, local)
+        buf = io.StringIO()
+        self.executor.get(local, buf)
+        assert buf.getvalue() == 'echo hello\n'
+        assert_raises(error.ProgramError, self.executor.get,
+                      local + '.none', io.StringIO())
+        # The master connection is started once, before the first command.
+        assert self.start_master.call_count == 1
+
+    def test_run(self):
+        out = io.StringIO()
+        ret = self.executor.run('echo foo; echo bar >&2; exit 3',
+                                shell=False, warn_only=True, stdout=out)
+        assert ret.return_code == 3
+        assert ret.failed
+        assert out.getvalue() == 'foo\nbar\n'
+        assert ret == 'foo\nbar'
+        ret = self.executor.run('seq 1000', shell=False, quiet=True,
+                                capture_buffer_size=10)
+        assert ret.succeeded
+        assert ret == '999\n1000'
+        assert_raises(error.ProgramError, self.executor.run, 'false',
+                      shell=False, quiet=False, stdout=io.StringIO())
+
+    def test_run_pty(self):
+        # The pty line endings are normalized, also when a "\r\n" is
+        # split over two reads.
+        out = io.StringIO()
+        command = 'printf "a\\r"; sleep 0.2; printf "\\nb\\r\\n"'
+        ret = self.executor.run(command, shell=False, pty=True, stdout=out)
+        assert out.getvalue() == 'a\nb\n'
+        assert ret == 'a\nb'
+        ret = self.executor.run('printf "a\\r\\nb"', shell=False, pty=False,
+                                quiet=True)
+        assert ret == 'a\r\nb'
@@ -0,0 +1,83 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+
+from testmill import tracing
+from testmill.test import *
+
+
+@tracing.traced('test')
+def traced_function(x):
+    with tracing.span('inner', arg=x):
+        return x * 2
+
+
+@unittest
+class TestTracing(TestSuite):
+    """Test span tracing."""
+
+    def teardown(self):
+        tracing.disable()
+        tracing._trace_file = None
+        super(TestTracing, self).teardown()
+
+    def test_disabled(self):
+        assert not tracing.enabled()
+        assert traced_function(2) == 4
+        assert tracing.finish() == 0
+
+    def test_enable_fails(self):
+        fname = os.path.join(testenv.tempdir, 'nonexistent', 'trace.json')
+        try:
+            tracing.enable(fname)
+        except EnvironmentError:
+            pass
+        else:
+            assert False, 'no error raised'
+        assert not tracing.enabled()
+        assert tracing.finish() == 0
+
+    def test_trace(self):
+        fname = os.path.join(testenv.tempdir, 'trace.json')
+        tracing.enable(fname)
+        assert tracing.enabled()
+        tracing.set_process_name('test process')
+        with tracing.span('outer', 'test'):
+            assert traced_function(3) == 6
+        try:
+            with tracing.span('failing'):
+                raise ValueError
+        except ValueError:
+            pass
+        assert tracing.finish() == 4
+        assert not tracing.enabled()
+        assert not os.path.exists(fname + '.events')
+        with open(fname) as fin:
+            trace = json.load(fin)
+        events = trace['traceEvents']
+        assert events[0]['ph'] == 'M'
+        assert events[0]['args']['name'] == 'test process'
+        spans = events[1:]
+        assert [ ev['name'] for ev in spans ] == \
+                    ['outer', 'traced_function', 'inner', 'failing']
+        outer, func, inner = spans[:3]
+        assert func['cat'] == 'test'
+        assert inner['args'] == {'arg': 3}
+        assert outer['ts'] <= func['ts'] <= inner['ts']
+        assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+        os.unlink(fname)
@@ -0,0 +1,145 @@
+# Copyright 2012-2013 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+
+
+# Tracing records the start and duration of "spans": named, possibly nested
+# sections of code such as API requests, wait loops and remote commands.
+# The result is written in the Chrome trace event format, which can be
+# loaded in chrome://tracing or https://ui.perfetto.dev.
+#
+# Spans are recorded by the process that runs them. Because tasks run in
+# child processes, every span is appended immediately as a single line to
+# a temporary events file that is shared by all processes. When the run is
+# finished, finish() collects the events into the trace file.
+#
+# When tracing is disabled, span() only costs a function call.
+
+_events_fd = None
+_trace_file = None
+
+
+def enable(fname):
+    """Enable tracing. The trace is written to ``fname`` by
+    :func:`finish`."""
+    global _events_fd, _trace_file
+    trace_file = os.path.abspath(fname)
+    events_file = '{0}.events'.format(trace_file)
+    _events_fd = os.open(events_file, os.O_WRONLY|os.O_CREAT|os.O_TRUNC|
+                                      os.O_APPEND, 0o600)
+    _trace_file = trace_file
+
+
+def disable():
+    """Disable tracing in this process. Events that were already recorded
+    are kept."""
+    global _events_fd
+    if _events_fd is not None:
+        os.close(_events_fd)
+    _events_fd = None
+
+
+def enabled():
+    """Return whether tracing is enabled."""
+    return _events_fd is not None
+
+
+def _emit(event):
+    """Record a single trace event."""
+    line = json.dumps(event) + '\n'
+    os.write(_events_fd, line.encode('utf-8'))
+
+
+@contextlib.contextmanager
+def span(name, cat='testmill', **args):
+    """Context manager that records the code it wraps as a span with name
+    ``name`` and category ``cat``. Keyword arguments are added to the span
+    as arguments."""
+    if _events_fd is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        event = {'name': name, 'cat': cat, 'ph': 'X',
+                 'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+                 'pid': os.getpid(), 'tid': threading.current_thread().ident}
+        if args:
+            event['args'] = args
+        if _events_fd is not None:
+            _emit(event)
+
+
+def set_process_name(name):
+    """Set the name under which the spans of this process are shown."""
+    if _events_fd is None:
+        return
+    _emit({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+           'args': {'name': name}})
+
+
+def traced(cat='testmill', name=None):
+    """Decorator that records every call to the decorated function as a
+    span. The span is named after the function, unless ``name`` is
+    provided."""
+    def decorate(func):
+        spanname = name or func.__name__
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with span(spanname, cat):
+                return func(*args, **kwargs)
+        return wrapped
+    return decorate
+
+
+def finish():
+    """Collect the events that were recorded by all processes and write
+    the trace file. Tracing is disabled afterwards. Return the number of
+    events."""
+    global _trace_file
+    if _trace_file is None:
+        return 0
+    disable()
+    events_file = '{0}.events'.format(_trace_file)
+    events = []
+    with open(events_file) as fin:
+        for line in fin:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    os.unlink(events_file)
+    spans = [ ev for ev in events if ev['ph'] != 'M' ]
+    # Enclosing spans first, so that nesting is right for equal start times
+    spans.sort(key=lambda ev: (ev['ts'], -ev['dur']))
+    names = [ ev for ev in events if ev['ph'] == 'M' ]
+    named = set((ev['pid'] for ev in names))
+    if os.getpid() not in named:
+        names.append({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                      'args': {'name': 'ravtest'}})
+    trace = {'traceEvents': names + spans, 'displayTimeUnit': 'ms'}
+    with open(_trace_file, 'w') as fout:
+        json.dump(trace, fout)
+    _trace_file = None
+    return len(spans)
@@ -17,7 +17,6 @@ from __future__ import absolute_import, print_function
 import os
 import sys
 import stat
-import yaml
 import subprocess
 
 from testmill import inflect
@@ -25,6 +24,7 @@ from testmill import inflect
 
 def prettify(obj):
     """Pretty print a parsed YAML document."""
+    import yaml  # imported here as it is slow to load
     Dumper = yaml.SafeDumper
     Dumper.ignore_aliases = lambda self, data: True
     return yaml.dump(obj, Dumper=Dumper, default_flow_style=False,
@@ -186,3 +186,15 @@ def format_timedelta(t):
         count = t//86400
         unit = inflect.plural_noun('day', count)
         return '{0} {1}'.format(count, unit)
+
+
+_time_units = { 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800 }
+
+def parse_timedelta(s):
+    """Parse a time interval like "30m", "12h" or "2d" and return it in
+    seconds. A number without a unit is in seconds. Raise a ValueError if
+    ``s`` is not a valid interval."""
+    s = s.strip().lower()
+    if s and s[-1] in _time_units:
+        return int(s[:-1]) * _time_units[s[-1]]
+    return int(s)
@@ -113,8 +113,9 @@ if __name__ == '__main__':
     setup(
         package_dir = { '': 'lib' },
         packages = ['testmill'],
-        install_requires = ['fabric>=1.5.3', 'pyyaml', 'argparse'],
-        entry_points = { 'console_scripts': ['ravtest = testmill.main:main'] },
+        install_requires = ['fabric>=1.11', 'pyyaml', 'argparse'],
+        entry_points = { 'console_scripts': ['ravtest = testmill.main:main',
+                            'ravtest-bench = testmill.bench:main'] },
         package_data = { 'testmill': ['*.yml', '*.sh'] },
         **version_info
     )